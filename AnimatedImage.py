@@ -0,0 +1,344 @@
+import time
+import typing
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from PyQt5.QtGui import QImage, QImageReader
+from PyQt5.QtCore import Qt, QObject, QSize, QTimer, pyqtSignal
+
+from BoardPack import *
+from Instrumentation import *
+from UnitTesting import *
+
+
+class AnimationFrame(typing.NamedTuple):
+    image: QImage
+    # shown for [ms]
+    delay: int
+    index: int
+
+
+def isAnimated(path: str) -> bool:
+    # from the header only: a GIF may still have a single frame
+    reader, device = openImageReader(path)
+    return reader is not None and reader.supportsAnimation()
+
+
+# Frames of an animated image (GIF, animated WebP...) decoded as a stream:
+# a worker decodes the next frames ahead, scaled to the shown size, and only
+# MAX_FRAMES of them are kept. The frames are shown by the AnimationClock at
+# the time each one is due (see advance). Paused, the frames are dropped and
+# the file closed; playing again goes on from the frame shown last.
+class AnimatedImage(QObject):
+    MAX_FRAMES: int = 6
+    # shorter delays are not honored by browsers either
+    MIN_DELAY_MS: int = 20
+    DEFAULT_DELAY_MS: int = 100
+    # late by more than this (e.g. a slow decode): restart the schedule from
+    # now instead of rushing through the frames missed
+    MAX_LAG_S: float = 0.25
+
+    _executor: ThreadPoolExecutor = None
+
+    # frame to show (QImage, about the size set with setSize)
+    frame_ready: typing.ClassVar[pyqtSignal] = pyqtSignal(object)
+
+    def __init__(self, path: str, parent: QObject = None) -> None:
+        super().__init__(parent)
+        self._path = path
+        self._lock = threading.Lock()
+        self._frames: deque[AnimationFrame] = deque()
+        self._size: QSize = None
+        self._playing = False
+        self._static = False
+        # bumped on pause: the frames decoded meanwhile are dropped
+        self._generation = 0
+        self._pending: Future = None
+        # due time of the next frame (time.monotonic)
+        self._due = 0.0
+        self._shown_index = -1
+        # worker side: (generation, reader, device, index of the next frame)
+        self._stream: tuple = None
+
+    @classmethod
+    def executor(cls) -> ThreadPoolExecutor:
+        # a single worker for all the animations: frames are small and the
+        # decode workers stay free for the images being opened
+        if cls._executor is None:
+            cls._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="CuteLookFrames")
+        return cls._executor
+
+    def setSize(self, size: QSize) -> None:
+        # frames decoded from now on are scaled to size
+        with self._lock:
+            self._size = QSize(size)
+
+    def isPlaying(self) -> bool:
+        return self._playing
+
+    def isStatic(self) -> bool:
+        # a single frame: nothing to play
+        return self._static
+
+    def frameBytes(self) -> int:
+        with self._lock:
+            return sum(frame.image.sizeInBytes() for frame in self._frames)
+
+    def play(self) -> None:
+        if self._playing or self._static:
+            return
+        self._playing = True
+        self._due = time.monotonic()
+        self._refill()
+        AnimationClock.instance().add(self)
+
+    def pause(self) -> None:
+        if not self._playing:
+            return
+        self._playing = False
+        AnimationClock.instance().remove(self)
+        with self._lock:
+            self._generation += 1
+            self._frames.clear()
+
+    def advance(self, now: float) -> None:
+        # called by the clock: show the last frame due, dropping those before
+        if self._static:
+            self.pause()
+            return
+        shown = None
+        with self._lock:
+            while self._frames and now >= self._due:
+                shown = self._frames.popleft()
+                self._due += shown.delay / 1000
+            low = len(self._frames) <= self.MAX_FRAMES // 2
+        if shown is not None:
+            if now - self._due > self.MAX_LAG_S:
+                self._due = now
+            self._shown_index = shown.index
+            self.frame_ready.emit(shown.image)
+        if low:
+            self._refill()
+
+    def _refill(self) -> None:
+        if self._pending is not None and not self._pending.done():
+            return
+        with self._lock:
+            generation = self._generation
+        self._pending = self.executor().submit(self._decode, generation, self._shown_index + 1)
+
+    def _decode(self, generation: int, resume_index: int) -> None:
+        with span("frames", self._path):
+            self._decodeFrames(generation, resume_index)
+
+    def _decodeFrames(self, generation: int, resume_index: int) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return
+            size = self._size
+        if self._stream is None or self._stream[0] != generation:
+            # paused meanwhile, or first frames: the stream starts again
+            self._stream = self._openStream(generation, resume_index)
+        generation, reader, device, index = self._stream
+        if reader is None:
+            return
+        restarted = False
+        while True:
+            with self._lock:
+                if generation != self._generation or len(self._frames) >= self.MAX_FRAMES:
+                    break
+            image = reader.read()
+            if image.isNull():
+                if index <= 1 or restarted:
+                    # a single frame (or a broken file): nothing to play
+                    self._static = index <= 1
+                    break
+                # looping: from the first frame again
+                reader, device = openImageReader(self._path)
+                index = 0
+                restarted = True
+                continue
+            delay = reader.nextImageDelay()
+            delay = max(delay, self.MIN_DELAY_MS) if delay > 0 else self.DEFAULT_DELAY_MS
+            if size is not None and size.isValid() and image.size() != size:
+                image = image.scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            with self._lock:
+                if generation == self._generation:
+                    self._frames.append(AnimationFrame(image, delay, index))
+            index += 1
+            restarted = False
+        self._stream = (generation, reader, device, index)
+
+    def _openStream(self, generation: int, resume_index: int) -> tuple:
+        reader, device = openImageReader(self._path)
+        if reader is None:
+            return (generation, None, None, 0)
+        # frames can't be sought in most formats: decoded and dropped
+        index = 0
+        while index < resume_index and reader.canRead():
+            if reader.read().isNull():
+                reader, device = openImageReader(self._path)
+                index = 0
+                break
+            index += 1
+        return (generation, reader, device, index)
+
+
+# Single timer driving all the animations playing: each animation keeps its
+# own schedule (see AnimatedImage.advance), so the timer jitter doesn't add
+# up and frames due together are shown in the same tick.
+class AnimationClock(QObject):
+    TICK_MS: int = 10
+
+    _instance: "AnimationClock" = None
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._animations: list[AnimatedImage] = []
+        self._timer = QTimer(self)
+        self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.setInterval(self.TICK_MS)
+        self._timer.timeout.connect(self._tick)
+
+    @classmethod
+    def instance(cls) -> "AnimationClock":
+        if cls._instance is None:
+            cls._instance = AnimationClock()
+        return cls._instance
+
+    def add(self, animation: AnimatedImage) -> None:
+        if animation not in self._animations:
+            self._animations.append(animation)
+        self._timer.start()
+
+    def remove(self, animation: AnimatedImage) -> None:
+        if animation in self._animations:
+            self._animations.remove(animation)
+        if not self._animations:
+            self._timer.stop()
+
+    def playing(self) -> int:
+        return len(self._animations)
+
+    def _tick(self) -> None:
+        now = time.monotonic()
+        for animation in list(self._animations):
+            animation.advance(now)
+
+
+"""
+Unit Tests
+"""
+import os
+import struct
+
+from PyQt5.QtCore import QCoreApplication
+
+test_data = {
+    "gif_file": "./test_animation.gif",
+    "still_file": "./test_still.gif",
+}
+
+
+def makeGif(path: str, colors: list[tuple[int, int, int]], side: int, delay_cs: int) -> None:
+    # one frame per color, filled with it. The LZW stream clears the table
+    # before each pixel: codes stay 3 bits long
+    palette = (colors + [(0, 0, 0)] * 4)[:4]
+    data = b"GIF89a" + struct.pack("<HHBBB", side, side, 0x81, 0, 0)
+    data += b"".join(bytes(c) for c in palette)
+    # loop forever
+    data += b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00"
+    for index in range(len(colors)):
+        data += b"\x21\xf9\x04\x04" + struct.pack("<H", delay_cs) + b"\x00\x00"
+        data += b"\x2c" + struct.pack("<HHHHB", 0, 0, side, side, 0)
+        codes = [4, index] * (side * side) + [5]
+        bits = 0
+        count = 0
+        packed = bytearray()
+        for code in codes:
+            bits |= code << count
+            count += 3
+            while count >= 8:
+                packed.append(bits & 0xFF)
+                bits >>= 8
+                count -= 8
+        if count:
+            packed.append(bits & 0xFF)
+        data += b"\x02"
+        for start in range(0, len(packed), 255):
+            block = packed[start : start + 255]
+            data += bytes([len(block)]) + block
+        data += b"\x00"
+    data += b"\x3b"
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def playFor(seconds: float) -> None:
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        QCoreApplication.processEvents()
+        time.sleep(0.002)
+
+
+@TestFunction
+def animatedImage_streamed_frames():
+    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+    makeGif(test_data["gif_file"], colors, 8, 5)
+    animation = AnimatedImage(test_data["gif_file"])
+    animation.setSize(QSize(4, 4))
+    shown = []
+    animation.frame_ready.connect(lambda image: shown.append(image))
+    try:
+        assert isAnimated(test_data["gif_file"]), "GIF not seen as animated"
+        animation.play()
+        playFor(0.5)
+        assert len(shown) >= 6, f"{len(shown)} frames in 0.5 s, 50 ms each"
+        assert shown[0].size() == QSize(4, 4), f"frame not scaled {shown[0].size()}"
+        pixels = [QColor(image.pixel(0, 0)).getRgb()[:3] for image in shown[:4]]
+        assert pixels == colors + colors[:1], f"wrong frames or loop {pixels}"
+        assert animation.frameBytes() <= AnimatedImage.MAX_FRAMES * 4 * 4 * 4, "too many frames"
+
+        animation.pause()
+        assert animation.frameBytes() == 0, "frames kept while paused"
+        count = len(shown)
+        playFor(0.1)
+        assert len(shown) == count, "frames shown while paused"
+        assert AnimationClock.instance().playing() == 0, "clock still running"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        animation.pause()
+        os.remove(test_data["gif_file"])
+
+
+@TestFunction
+def animatedImage_single_frame():
+    makeGif(test_data["still_file"], [(10, 20, 30)], 4, 10)
+    animation = AnimatedImage(test_data["still_file"])
+    try:
+        animation.play()
+        playFor(0.2)
+        assert animation.isStatic(), "single frame GIF played"
+        assert not animation.isPlaying(), "single frame GIF still playing"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        animation.pause()
+        os.remove(test_data["still_file"])
+
+
+if __name__ == "__main__":
+    from PyQt5.QtGui import QColor
+
+    app = QCoreApplication([])
+    test_list = [
+        animatedImage_streamed_frames,
+        animatedImage_single_frame,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
@@ -0,0 +1,248 @@
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PyQt5.QtGui import QImage, QPainter, QColor, QPen
+from PyQt5.QtCore import Qt, QRectF
+
+from ReferenceBoardModels import *
+from ImagePyramid import *
+from UnitTesting import *
+
+
+# formats seen by numpy as 4 bytes per pixel: B, G, R, A (little endian)
+ARRAY_FORMATS = [
+    QImage.Format_RGB32,
+    QImage.Format_ARGB32,
+    QImage.Format_ARGB32_Premultiplied,
+]
+
+# whole image, as normalized region
+FULL_REGION: dict[str, float] = {"x": 0.0, "y": 0.0, "w": 1.0, "h": 1.0}
+
+
+def imageArray(image: QImage) -> np.ndarray:
+    # (height, width, 4) view of the pixels of image, no copy: the array is
+    # valid as long as image is alive (and not modified)
+    assert image.format() in ARRAY_FORMATS, f"unsupported image format {image.format()}"
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    rows = np.frombuffer(bits, np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, : image.width() * 4].reshape(image.height(), image.width(), 4)
+
+
+def extractPalette(
+    pixels: np.ndarray, colors: int, iterations: int = 10
+) -> tuple[np.ndarray, np.ndarray]:
+    # k-means of pixels (N, 3), returns the centers (colors, 3) and the
+    # fraction of the pixels of each one, most used first
+    # seeds: the most populated cells of a coarse (4 bits per channel) histogram
+    cells = (pixels.astype(np.uint16) >> 4) @ np.array([256, 16, 1], np.uint16)
+    counts = np.bincount(cells, minlength=4096)
+    seeds = np.argsort(counts)[::-1][: min(colors, np.count_nonzero(counts))]
+    centers = np.stack([seeds >> 8, (seeds >> 4) & 15, seeds & 15], axis=1)
+    centers = centers.astype(np.float32) * 16 + 8
+    samples = pixels.astype(np.float32)
+    for i in range(iterations):
+        # squared distances (N, colors) without the (N, colors, 3) temporary,
+        # less |sample|^2: the same for all the centers
+        distances = (centers * centers).sum(axis=1)[None, :] - 2 * samples @ centers.T
+        labels = distances.argmin(axis=1)
+        sums = np.stack(
+            [np.bincount(labels, samples[:, c], len(centers)) for c in range(3)], axis=1
+        )
+        sizes = np.bincount(labels, minlength=len(centers)).astype(np.float32)
+        used = sizes > 0
+        new_centers = centers.copy()
+        new_centers[used] = sums[used] / sizes[used, None]
+        if np.allclose(new_centers, centers, atol=0.5):
+            centers = new_centers
+            break
+        centers = new_centers
+    sizes = np.bincount(labels, minlength=len(centers)).astype(np.float32)
+    order = np.argsort(sizes)[::-1]
+    order = order[sizes[order] > 0]
+    return centers[order], sizes[order] / sizes.sum()
+
+
+# Palette of the main colors of an image (or of a region of it), computed on
+# a sample of its pixels. Results are cached per image and region: asking the
+# same swatch again costs nothing.
+class AutoColorSwatch:
+    COLORS: int = 5
+    # pixels sampled from the region: plenty for a handful of colors
+    SAMPLE_PIXELS: int = 16 * 1024
+    MAX_CACHED: int = 256
+
+    _instance: "AutoColorSwatch" = None
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[tuple, ColorSwatchModel] = OrderedDict()
+
+    @classmethod
+    def instance(cls) -> "AutoColorSwatch":
+        if cls._instance is None:
+            cls._instance = AutoColorSwatch()
+        return cls._instance
+
+    def swatch(
+        self, pyramid: ImagePyramid, region: dict[str, float] = None, colors: int = COLORS
+    ) -> ColorSwatchModel:
+        # region: normalized (0..1) x, y, w, h - the whole image by default
+        region = dict(region if region is not None else FULL_REGION)
+        image_key = pyramid.cacheKey() if pyramid.cacheKey() is not None else id(pyramid)
+        key = (image_key, tuple(round(region[k], 4) for k in "xywh"), colors)
+        with self._lock:
+            swatch = self._cache.get(key)
+            if swatch is not None:
+                self._cache.move_to_end(key)
+                return swatch.model_copy(deep=True)
+
+        swatch = self.extract(self._sampledLevel(pyramid, region), region, colors)
+        with self._lock:
+            self._cache[key] = swatch
+            while len(self._cache) > self.MAX_CACHED:
+                self._cache.popitem(last=False)
+        return swatch.model_copy(deep=True)
+
+    def _sampledLevel(self, pyramid: ImagePyramid, region: dict[str, float]) -> QImage:
+        # the smallest level still having enough pixels in the region
+        area = region["w"] * region["h"]
+        for i in reversed(range(pyramid.levelCount())):
+            level = pyramid.level(i)
+            if level.width() * level.height() * area >= self.SAMPLE_PIXELS:
+                return level
+        return pyramid.level(0)
+
+    @classmethod
+    def extract(
+        cls, image: QImage, region: dict[str, float] = None, colors: int = COLORS
+    ) -> ColorSwatchModel:
+        region = dict(region if region is not None else FULL_REGION)
+        if image.format() not in ARRAY_FORMATS:
+            # the only copy: for the uncommon formats
+            image = image.convertToFormat(QImage.Format_ARGB32)
+        pixels = imageArray(image)
+        h, w = pixels.shape[:2]
+        x0, y0 = int(region["x"] * w), int(region["y"] * h)
+        x1 = max(int((region["x"] + region["w"]) * w), x0 + 1)
+        y1 = max(int((region["y"] + region["h"]) * h), y0 + 1)
+        # evenly spaced samples: a strided view, only the samples are copied
+        step = max(1, math.ceil(math.sqrt((x1 - x0) * (y1 - y0) / cls.SAMPLE_PIXELS)))
+        samples = pixels[y0:y1:step, x0:x1:step]
+        opaque = samples[..., 3] > 0
+        # BGR(A) -> RGB
+        rgb = samples[..., 2::-1][opaque]
+        if len(rgb) == 0:
+            return ColorSwatchModel(region=region)
+        centers, weights = extractPalette(rgb, colors)
+        return ColorSwatchModel(
+            region=region,
+            colors=[QColor(*map(int, c.round())).name() for c in centers],
+            weights=[round(float(wt), 4) for wt in weights],
+        )
+
+
+def paintColorSwatch(painter: QPainter, rect: QRectF, swatch: ColorSwatchModel) -> None:
+    # a strip of cells as wide as the share of each color
+    painter.save()
+    painter.setPen(Qt.NoPen)
+    x = rect.x()
+    for color, weight in zip(swatch.colors, swatch.weights):
+        width = rect.width() * weight
+        painter.fillRect(QRectF(x, rect.y(), width, rect.height()), QColor(color))
+        x += width
+    painter.setPen(QPen(QColor("white"), 1))
+    painter.setBrush(Qt.NoBrush)
+    painter.drawRect(rect)
+    painter.restore()
+
+
+"""
+Unit Tests
+"""
+import time
+
+
+def makeStripes(w: int, h: int) -> QImage:
+    # left half red, right quarters green and blue
+    image = QImage(w, h, QImage.Format_RGB32)
+    image.fill(0xFFFF0000)
+    painter = QPainter(image)
+    painter.fillRect(w // 2, 0, w // 4, h, QColor(0, 255, 0))
+    painter.fillRect(3 * w // 4, 0, w - 3 * w // 4, h, QColor(0, 0, 255))
+    painter.end()
+    return image
+
+
+@TestFunction
+def imageArray_no_copy():
+    image = QImage(30, 10, QImage.Format_RGB32)
+    image.fill(0xFF102030)
+    pixels = imageArray(image)
+    try:
+        assert pixels.shape == (10, 30, 4), f"wrong shape {pixels.shape}"
+        assert tuple(pixels[0, 0]) == (0x30, 0x20, 0x10, 0xFF), "wrong pixel"
+        # same memory: a change of the image shows up in the array
+        image.setPixel(3, 2, 0xFFFFFFFF)
+        assert tuple(imageArray(image)[2, 3, :3]) == (255, 255, 255), "array is a copy"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def autoColorSwatch_palette():
+    swatch = AutoColorSwatch.extract(makeStripes(400, 100), colors=3)
+    try:
+        assert swatch.colors[0] == "#ff0000", f"wrong main color {swatch.colors}"
+        assert set(swatch.colors) == {"#ff0000", "#00ff00", "#0000ff"}, (
+            f"wrong colors {swatch.colors}"
+        )
+        assert abs(swatch.weights[0] - 0.5) < 0.02, f"wrong weights {swatch.weights}"
+        region = {"x": 0.5, "y": 0.0, "w": 0.25, "h": 1.0}
+        swatch = AutoColorSwatch.extract(makeStripes(400, 100), region, colors=3)
+        assert swatch.colors == ["#00ff00"], f"wrong region colors {swatch.colors}"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def autoColorSwatch_cache_and_speed():
+    # 24 MP of noise: the worst case for the k-means
+    image = QImage(6000, 4000, QImage.Format_RGB32)
+    bits = image.bits()
+    bits.setsize(image.sizeInBytes())
+    np.frombuffer(bits, np.uint8)[:] = np.random.default_rng(0).integers(
+        0, 256, image.sizeInBytes(), np.uint8
+    )
+    start = time.perf_counter()
+    AutoColorSwatch.extract(image)
+    elapsed = time.perf_counter() - start
+    swatches = AutoColorSwatch()
+    pyramid = ImagePyramid(image)
+    first = swatches.swatch(pyramid)
+    start = time.perf_counter()
+    second = swatches.swatch(pyramid)
+    cached = time.perf_counter() - start
+    try:
+        assert elapsed < 0.05, f"24 MP swatch in {elapsed * 1000:.1f} ms"
+        assert first == second, "cached swatch differs"
+        assert cached < 0.001, f"cached swatch in {cached * 1000:.1f} ms"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    test_list = [
+        imageArray_no_copy,
+        autoColorSwatch_palette,
+        autoColorSwatch_cache_and_speed,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
@@ -0,0 +1,228 @@
+import os
+import json
+import pathlib
+
+from pydantic import ValidationError
+
+from ReferenceBoardModels import *
+from Instrumentation import *
+from UnitTesting import *
+
+
+# Append-only log of the changes made to a board since its last save, kept
+# next to the board file ("<board>.journal"). Each change is a single JSON
+# line, so its cost depends on the change and not on the size of the board.
+# After a crash the journal is replayed on top of the last saved board.
+#
+# records:
+#   {"op": "add_image", "name": str, "image": ReferenceImageModel}
+#   {"op": "set_image", "name": str, "image": ReferenceImageModel}
+#   {"op": "delete_image", "name": str}
+#   {"op": "rename_image", "name": str, "new_name": str}
+#   {"op": "rename", "name": str}
+class BoardJournal:
+    SUFFIX: str = ".journal"
+    # the journal is written into the board after this many records (0: no journal)
+    compact_records: int = 500
+
+    def __init__(self, board_path: pathlib.Path) -> None:
+        self._path = self.journalPath(board_path)
+        self._file = None
+        self._records = 0
+
+    @classmethod
+    def journalPath(cls, board_path: pathlib.Path) -> pathlib.Path:
+        return board_path.with_name(f"{board_path.name}{cls.SUFFIX}")
+
+    @classmethod
+    def hasNewerJournal(cls, board_path: pathlib.Path) -> bool:
+        journal_path = cls.journalPath(board_path)
+        try:
+            journal_stat = journal_path.stat()
+            board_mtime = board_path.stat().st_mtime_ns
+        except OSError:
+            return False
+        return journal_stat.st_size > 0 and journal_stat.st_mtime_ns >= board_mtime
+
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    def records(self) -> int:
+        return self._records
+
+    def append(self, record: dict) -> None:
+        if self._file is None:
+            self._file = open(self._path, "a", encoding="utf-8")
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        # survives a crash of the application (not of the system)
+        self._file.flush()
+        self._records += 1
+
+    def addImage(self, name: str, image: ReferenceImageModel) -> None:
+        self.append({"op": "add_image", "name": name, "image": image.model_dump()})
+
+    def setImage(self, name: str, image: ReferenceImageModel) -> None:
+        self.append({"op": "set_image", "name": name, "image": image.model_dump()})
+
+    def deleteImage(self, name: str) -> None:
+        self.append({"op": "delete_image", "name": name})
+
+    def renameImage(self, name: str, new_name: str) -> None:
+        self.append({"op": "rename_image", "name": name, "new_name": new_name})
+
+    def rename(self, name: str) -> None:
+        self.append({"op": "rename", "name": name})
+
+    def truncate(self, keep_after: int = None) -> None:
+        # drop the records now part of the saved board (the first keep_after)
+        self.close()
+        kept = []
+        if keep_after is not None and keep_after < self._records:
+            kept = self._readLines()[keep_after:]
+        if kept:
+            with open(self._path, "w", encoding="utf-8") as f:
+                f.writelines(kept)
+        else:
+            self._path.unlink(missing_ok=True)
+        self._records = len(kept)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def replay(self, board: ReferenceBoardModel) -> int:
+        # apply the journal to board, returns the number of changes applied
+        lines = self._readLines()
+        applied = []
+        for line in lines:
+            try:
+                self.apply(board, json.loads(line))
+                applied.append(line if line.endswith("\n") else f"{line}\n")
+            except (ValueError, KeyError, ValidationError) as e:
+                # e.g. last record partially written by a crash
+                log.warning(f"skipping journal record: {e}")
+        if len(applied) != len(lines):
+            # new records must not be appended to a broken one
+            with open(self._path, "w", encoding="utf-8") as f:
+                f.writelines(applied)
+        self._records = len(applied)
+        return self._records
+
+    @staticmethod
+    def apply(board: ReferenceBoardModel, record: dict) -> None:
+        op = record["op"]
+        images = board.reference_images
+        if op in ["add_image", "set_image"]:
+            images[record["name"]] = ReferenceImageModel.model_validate(record["image"])
+        elif op == "delete_image":
+            images.pop(record["name"], None)
+        elif op == "rename_image":
+            images[record["new_name"]] = images.pop(record["name"])
+        elif op == "rename":
+            board.board_name = record["name"]
+        else:
+            raise ValueError(f"unknown journal record: {op}")
+
+    def _readLines(self) -> list[str]:
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                return f.readlines()
+        except OSError:
+            return []
+
+
+"""
+Unit Tests
+"""
+
+test_data = {
+    "board_file_name": pathlib.Path("./test_journal.refboard"),
+}
+
+
+@TestFunction
+def boardJournal_replay():
+    journal = BoardJournal(test_data["board_file_name"])
+    try:
+        journal.addImage("pippo", ReferenceImageModel(path="./pippo.png"))
+        journal.addImage("pluto", ReferenceImageModel(path="./pluto.png"))
+        journal.setImage("pippo", ReferenceImageModel(path="./pippo.png", zoom=2))
+        journal.renameImage("pluto", "paperino")
+        journal.deleteImage("pippo")
+        journal.rename("journal")
+        journal.close()
+        # crash while writing the last record
+        with open(journal.path(), "a", encoding="utf-8") as f:
+            f.write('{"op": "add_im')
+
+        board = ReferenceBoardModel()
+        applied = BoardJournal(test_data["board_file_name"]).replay(board)
+        assert applied == 6, f"{applied} records applied"
+        assert board.board_name == "journal", "board rename not replayed"
+        assert list(board.reference_images.keys()) == ["paperino"], (
+            f"wrong images {board.reference_images.keys()}"
+        )
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        journal.path().unlink(missing_ok=True)
+
+
+@TestFunction
+def boardJournal_truncate():
+    journal = BoardJournal(test_data["board_file_name"])
+    try:
+        journal.rename("one")
+        journal.rename("two")
+        saved_records = journal.records()
+        # change made while the board was being saved
+        journal.rename("three")
+        journal.truncate(saved_records)
+        board = ReferenceBoardModel()
+        assert BoardJournal(test_data["board_file_name"]).replay(board) == 1, (
+            "saved records not dropped"
+        )
+        assert board.board_name == "three", "unsaved record dropped"
+        journal.truncate()
+        assert not journal.path().exists(), "journal not removed"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        journal.close()
+        journal.path().unlink(missing_ok=True)
+
+
+@TestFunction
+def boardJournal_newer():
+    board_path = test_data["board_file_name"]
+    journal = BoardJournal(board_path)
+    try:
+        board_path.write_text("{}", encoding="utf-8")
+        assert not BoardJournal.hasNewerJournal(board_path), "no journal expected"
+        journal.rename("newer")
+        journal.close()
+        stat = board_path.stat()
+        os.utime(journal.path(), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert BoardJournal.hasNewerJournal(board_path), "newer journal not found"
+        os.utime(board_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert not BoardJournal.hasNewerJournal(board_path), "old journal replayed"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        board_path.unlink(missing_ok=True)
+        journal.path().unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    test_list = [
+        boardJournal_replay,
+        boardJournal_truncate,
+        boardJournal_newer,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
@@ -0,0 +1,450 @@
+import os
+import copy
+import json
+import mmap
+import struct
+import typing
+import shutil
+import hashlib
+import pathlib
+import threading
+
+from PyQt5.QtGui import QImage, QImageReader
+from PyQt5.QtCore import QByteArray, QBuffer, QIODevice, QCoreApplication
+
+from ReferenceBoardModels import *
+from ImageCache import ImageKey, ImageCache
+from Instrumentation import *
+from UnitTesting import *
+
+
+# Image paths of a packed board: the image is found by the hash of its content
+# in the packs opened by the application ("refpack:<sha256>")
+PACK_SCHEME = "refpack:"
+
+# image ready to be packed: (content or path of the file, original file name)
+PackedImage = tuple[memoryview | str, str]
+
+
+# Single file board: the board JSON and the images it shows. Each image is
+# stored once, named by the hash of its content, so the board can be moved
+# around and copies of the same image don't waste space.
+#
+# layout (little endian):
+#   header: magic, version, board offset/length, index offset/length
+#   images content, one after the other
+#   board JSON (image paths are "refpack:<sha256>")
+#   index JSON: {"<sha256>": {"offset": int, "length": int, "name": str}}
+#
+# The file is memory mapped: images are decoded straight from the mapping,
+# only the pages actually read are loaded from the disk.
+class BoardPack:
+    SUFFIX: str = ".refpack"
+    MAGIC: bytes = b"CUTEPACK"
+    VERSION: int = 1
+    _HEADER: struct.Struct = struct.Struct("<8sIQQQQ")
+
+    # open packs ((resolved path, mtime, size): [pack, users]) images are
+    # looked up in. A file rewritten meanwhile is opened again
+    _open_packs: dict[tuple, list] = {}
+    _lock: threading.Lock = threading.Lock()
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self._path = pathlib.Path(path)
+        self._key = self.fileKey(self._path)
+        with open(self._path, "rb") as f:
+            # the mapping stays valid once the file is closed (and replaced)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < self._HEADER.size:
+            raise ValueError(f"not a packed board: {self._path}")
+        magic, version, board_offset, board_length, index_offset, index_length = (
+            self._HEADER.unpack_from(self._map)
+        )
+        if magic != self.MAGIC:
+            raise ValueError(f"not a packed board: {self._path}")
+        if version > self.VERSION:
+            raise ValueError(f"unsupported packed board version {version}: {self._path}")
+        if max(board_offset + board_length, index_offset + index_length) > len(self._map):
+            raise ValueError(f"truncated packed board: {self._path}")
+        self._board = (board_offset, board_length)
+        self._index: dict[str, dict] = json.loads(
+            self._map[index_offset : index_offset + index_length]
+        )
+
+    @classmethod
+    def open(cls, path: pathlib.Path) -> "BoardPack":
+        # shared by the boards opening the same file
+        key = cls.fileKey(pathlib.Path(path))
+        with cls._lock:
+            entry = cls._open_packs.get(key)
+            if entry is None:
+                entry = cls._open_packs[key] = [BoardPack(path), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def close(self) -> None:
+        with self._lock:
+            entry = self._open_packs.get(self._key)
+            if entry is None or entry[0] is not self:
+                return
+            entry[1] -= 1
+            if entry[1] == 0:
+                # unmapped once the images being decoded are done with it
+                del self._open_packs[self._key]
+
+    @staticmethod
+    def fileKey(path: pathlib.Path) -> tuple[str, int, int]:
+        stat = path.stat()
+        return (path.resolve().as_posix(), stat.st_mtime_ns, stat.st_size)
+
+    @classmethod
+    def isPackFile(cls, path: pathlib.Path) -> bool:
+        try:
+            with open(path, "rb") as f:
+                return f.read(len(cls.MAGIC)) == cls.MAGIC
+        except OSError:
+            return False
+
+    @staticmethod
+    def isPackedImage(path: str) -> bool:
+        return path.startswith(PACK_SCHEME)
+
+    @staticmethod
+    def imagePath(digest: str) -> str:
+        return f"{PACK_SCHEME}{digest}"
+
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    def boardJson(self) -> bytes:
+        offset, length = self._board
+        return self._map[offset : offset + length]
+
+    def board(self) -> ReferenceBoardModel:
+        return ReferenceBoardModel.model_validate_json(self.boardJson())
+
+    def images(self) -> dict[str, dict]:
+        return self._index
+
+    def imageData(self, digest: str) -> memoryview | None:
+        entry = self._index.get(digest)
+        if entry is None:
+            return None
+        offset = entry["offset"]
+        return memoryview(self._map)[offset : offset + entry["length"]]
+
+    @classmethod
+    def findImage(cls, path: str) -> tuple[memoryview, str] | None:
+        # (content, original file name) of a packed image, from any open pack
+        if not cls.isPackedImage(path):
+            return None
+        digest = path[len(PACK_SCHEME) :]
+        with cls._lock:
+            packs = [entry[0] for entry in cls._open_packs.values()]
+        for pack in packs:
+            data = pack.imageData(digest)
+            if data is not None:
+                return data, pack._index[digest].get("name", digest)
+        return None
+
+    @classmethod
+    def imageExists(cls, path: str) -> bool:
+        if cls.isPackedImage(path):
+            return cls.findImage(path) is not None
+        return os.path.isfile(path)
+
+    @classmethod
+    def imageKey(cls, path: str) -> ImageKey | None:
+        # the content never changes: the hash is enough to identify it
+        image = cls.findImage(path)
+        if image is None:
+            return None
+        return (path, 0, len(image[0]))
+
+    @classmethod
+    def imageDevice(cls, path: str) -> QBuffer | None:
+        # a device reading the packed image in place (no copy)
+        image = cls.findImage(path)
+        if image is None:
+            return None
+        device = QBuffer()
+        device.setData(QByteArray.fromRawData(image[0]))
+        # the raw data is not owned by the device: the view keeps the mapping
+        # alive while the device is read, even once the pack is closed
+        device.mapped_data = image[0]
+        device.open(QIODevice.ReadOnly)
+        return device
+
+    @classmethod
+    def packImages(cls, board: dict) -> tuple[dict, dict[str, PackedImage]]:
+        # board (plain python data) with the image paths replaced by the hash of
+        # their content, and the content to store for each hash
+        packed_board = copy.deepcopy(board)
+        images: dict[str, PackedImage] = {}
+        for name, image in packed_board["reference_images"].items():
+            path = image["path"]
+            packed_image = cls.findImage(path)
+            if packed_image is not None:
+                digest = path[len(PACK_SCHEME) :]
+            else:
+                digest = cls._fileDigest(path)
+                packed_image = (path, pathlib.Path(path).name)
+            if digest is None:
+                log.warning(f'image "{name}" not packed, can\'t read: {path}')
+                continue
+            images.setdefault(digest, packed_image)
+            image["path"] = cls.imagePath(digest)
+        return packed_board, images
+
+    @classmethod
+    def write(
+        cls, f: typing.BinaryIO, board_json: bytes, images: dict[str, PackedImage]
+    ) -> None:
+        # board_json: board with packed image paths (see packImages)
+        f.write(b"\0" * cls._HEADER.size)
+        index = {}
+        offset = cls._HEADER.size
+        for digest, (data, file_name) in images.items():
+            if isinstance(data, str):
+                with open(data, "rb") as image_file:
+                    shutil.copyfileobj(image_file, f)
+            else:
+                f.write(data)
+            length = f.tell() - offset
+            index[digest] = {"offset": offset, "length": length, "name": file_name}
+            offset += length
+        board_offset = offset
+        f.write(board_json)
+        index_json = json.dumps(index, separators=(",", ":")).encode("utf-8")
+        f.write(index_json)
+        f.seek(0)
+        f.write(
+            cls._HEADER.pack(
+                cls.MAGIC,
+                cls.VERSION,
+                board_offset,
+                len(board_json),
+                board_offset + len(board_json),
+                len(index_json),
+            )
+        )
+        f.seek(0, os.SEEK_END)
+
+    @classmethod
+    def extractImages(cls, board: dict, board_path: pathlib.Path) -> dict:
+        # board (plain python data) with the packed images written as files in
+        # a directory next to board_path ("<board>_images")
+        images = board["reference_images"].values()
+        if not any(cls.isPackedImage(image["path"]) for image in images):
+            return board
+        images_dir = board_path.parent / f"{board_path.stem}_images"
+        extracted_board = copy.deepcopy(board)
+        for name, image in extracted_board["reference_images"].items():
+            packed_image = cls.findImage(image["path"])
+            if packed_image is None:
+                continue
+            data, file_name = packed_image
+            digest = image["path"][len(PACK_SCHEME) :]
+            # the hash prefix keeps apart different images with the same name
+            image_path = images_dir / f"{digest[:12]}-{pathlib.Path(file_name).name}"
+            if not (image_path.is_file() and image_path.stat().st_size == len(data)):
+                images_dir.mkdir(parents=True, exist_ok=True)
+                with open(image_path, "wb") as image_file:
+                    image_file.write(data)
+            image["path"] = image_path.absolute().as_posix()
+        return extracted_board
+
+    @staticmethod
+    def _fileDigest(path: str) -> str | None:
+        # files are only mapped while hashed: thousands of images would use up
+        # the file descriptors
+        try:
+            with open(path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    return hashlib.sha256(data).hexdigest()
+        except (OSError, ValueError):
+            # ValueError: empty file
+            return None
+
+
+def openImageReader(path: str) -> tuple[QImageReader | None, QIODevice | None]:
+    # (reader, the device it reads for packed images: kept with the reader)
+    if BoardPack.isPackedImage(path):
+        device = BoardPack.imageDevice(path)
+        if device is None:
+            return None, None
+        return QImageReader(device), device
+    return QImageReader(path), None
+
+
+def imageFileKey(path: str) -> ImageKey | None:
+    # identity of a packed or a plain image file (None: missing)
+    if BoardPack.isPackedImage(path):
+        return BoardPack.imageKey(path)
+    return ImageCache.fileKey(path)
+
+
+"""
+Unit Tests
+"""
+
+import gc
+
+test_data = {
+    "work_dir": pathlib.Path("./test_pack"),
+}
+
+
+def makeTestImages() -> dict:
+    work_dir = test_data["work_dir"]
+    work_dir.mkdir(exist_ok=True)
+    board = ReferenceBoardModel(board_name="packed")
+    for name, color in [("red", 0xFFFF0000), ("copy_of_red", 0xFFFF0000), ("blue", 0xFF0000FF)]:
+        image = QImage(32, 16, QImage.Format_RGB32)
+        image.fill(color)
+        image_path = work_dir / f"{name}.png"
+        image.save(image_path.as_posix())
+        board.reference_images[name] = ReferenceImageModel(path=image_path.as_posix())
+    board.reference_images["missing"] = ReferenceImageModel(path="./not_existing.png")
+    return board.model_dump()
+
+
+def writePack(board: dict, path: pathlib.Path) -> None:
+    packed_board, images = BoardPack.packImages(board)
+    with open(path, "wb") as f:
+        BoardPack.write(f, json.dumps(packed_board).encode("utf-8"), images)
+
+
+@TestFunction
+def boardPack_write_open():
+    pack_path = test_data["work_dir"] / "board.refpack"
+    pack = None
+    try:
+        writePack(makeTestImages(), pack_path)
+        assert BoardPack.isPackFile(pack_path), "pack not recognized"
+        pack = BoardPack.open(pack_path)
+        board = pack.board()
+        assert board.board_name == "packed", "wrong board name"
+        assert len(pack.images()) == 2, f"{len(pack.images())} images stored, 2 expected"
+        images = board.reference_images
+        assert images["red"].path == images["copy_of_red"].path, "same image not deduplicated"
+        assert BoardPack.isPackedImage(images["blue"].path), "image not packed"
+        assert images["missing"].path == "./not_existing.png", "missing image path lost"
+        assert BoardPack.imageExists(images["blue"].path), "packed image not found"
+        device = BoardPack.imageDevice(images["blue"].path)
+        image = QImageReader(device).read()
+        assert image.size().width() == 32, "packed image not decoded"
+        assert image.pixel(0, 0) == 0xFF0000FF, "wrong packed image content"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        if pack is not None:
+            pack.close()
+        shutil.rmtree(test_data["work_dir"], ignore_errors=True)
+
+
+@TestFunction
+def boardPack_device_outlives_pack():
+    pack_path = test_data["work_dir"] / "board.refpack"
+    try:
+        writePack(makeTestImages(), pack_path)
+        pack = BoardPack.open(pack_path)
+        device = BoardPack.imageDevice(pack.board().reference_images["blue"].path)
+        # board closed while the image is being decoded
+        pack.close()
+        del pack
+        gc.collect()
+        image = QImageReader(device).read()
+        assert image.pixel(0, 0) == 0xFF0000FF, "packed image not read once the pack closed"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        shutil.rmtree(test_data["work_dir"], ignore_errors=True)
+
+
+@TestFunction
+def boardPack_reopen_rewritten():
+    pack_path = test_data["work_dir"] / "board.refpack"
+    packs = []
+    try:
+        board = makeTestImages()
+        writePack(board, pack_path)
+        packs.append(BoardPack.open(pack_path))
+        # rewritten while still open by another board
+        board["board_name"] = "rewritten"
+        writePack(board, pack_path)
+        packs.append(BoardPack.open(pack_path))
+        assert packs[1] is not packs[0], "stale pack returned"
+        assert packs[1].board().board_name == "rewritten", "old content read"
+        packs.append(BoardPack.open(pack_path))
+        assert packs[2] is packs[1], "same file not shared"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        for pack in packs:
+            pack.close()
+        shutil.rmtree(test_data["work_dir"], ignore_errors=True)
+
+
+@TestFunction
+def boardPack_extract():
+    pack_path = test_data["work_dir"] / "board.refpack"
+    pack = None
+    try:
+        writePack(makeTestImages(), pack_path)
+        pack = BoardPack.open(pack_path)
+        board_path = test_data["work_dir"] / "unpacked" / "board.refboard"
+        board = BoardPack.extractImages(pack.board().model_dump(), board_path)
+        for name in ["red", "copy_of_red", "blue"]:
+            path = pathlib.Path(board["reference_images"][name]["path"])
+            assert path.is_file(), f"{name} not extracted"
+            assert path.parent.name == "board_images", f"{name} extracted to {path}"
+        assert QImage(board["reference_images"]["blue"]["path"]).pixel(0, 0) == 0xFF0000FF, (
+            "wrong extracted image"
+        )
+        blue_path = pack.board().reference_images["blue"].path
+        pack.close()
+        pack = None
+        assert not BoardPack.imageExists(blue_path), "image of a closed pack found"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        if pack is not None:
+            pack.close()
+        shutil.rmtree(test_data["work_dir"], ignore_errors=True)
+
+
+@TestFunction
+def boardPack_bad_file():
+    path = pathlib.Path("./test_bad.refpack")
+    try:
+        path.write_bytes(b'{"board_name": "json"}')
+        assert not BoardPack.isPackFile(path), "json board recognized as pack"
+        try:
+            BoardPack(path)
+            assert False, "bad pack opened"
+        except ValueError:
+            pass
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        path.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    app = QCoreApplication([])
+    test_list = [
+        boardPack_write_open,
+        boardPack_device_outlives_pack,
+        boardPack_reopen_rewritten,
+        boardPack_extract,
+        boardPack_bad_file,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
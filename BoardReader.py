@@ -0,0 +1,146 @@
+import json
+import pathlib
+
+from pydantic import ValidationError
+
+from ReferenceBoardModels import *
+from BoardPack import *
+from Instrumentation import *
+from UnitTesting import *
+
+
+# Problems found while opening a board: the entries that could not be loaded
+# are listed here instead of rejecting the whole board.
+class BoardLoadReport:
+    def __init__(self, board_path: pathlib.Path = None) -> None:
+        self.board_path = board_path
+        # (image name, error message)
+        self.errors: list[tuple[str, str]] = []
+
+    def add(self, name: str, error: str) -> None:
+        log.warning(f'image "{name}" not loaded: {error}')
+        self.errors.append((name, error))
+
+    def isEmpty(self) -> bool:
+        return len(self.errors) == 0
+
+    def summary(self, max_lines: int = 10) -> str:
+        lines = [f'"{name}": {error}' for name, error in self.errors[:max_lines]]
+        if len(self.errors) > max_lines:
+            lines.append(f"... and {len(self.errors) - max_lines} more")
+        return "\n".join(lines)
+
+
+# Builds the board from its JSON validating each image entry on its own: a
+# broken entry is reported and skipped. Image entries are only checked for
+# the path here, they are fully validated (see validateImage) when loaded.
+def parseBoard(json_board: bytes | str, report: BoardLoadReport) -> ReferenceBoardModel:
+    data = json.loads(json_board)
+    if not isinstance(data, dict):
+        raise ValueError("a board must be a JSON object")
+    images = data.pop("reference_images", {})
+    board = ReferenceBoardModel.model_validate(data)
+    if not isinstance(images, dict):
+        report.add("*", "image list is not a JSON object")
+        return board
+    for name, image in images.items():
+        if not isinstance(image, dict) or not isinstance(image.get("path"), str):
+            report.add(name, "image path missing")
+            continue
+        # no validation: default values filled in, the others taken as they are
+        board.reference_images[name] = ReferenceImageModel.model_construct(**image)
+    return board
+
+
+def validateImage(image: ReferenceImageModel) -> ReferenceImageModel:
+    # raises ValidationError
+    return ReferenceImageModel.model_validate(vars(image))
+
+
+def validationError(e: ValidationError) -> str:
+    # one line per wrong field: "zoom: Input should be a valid number"
+    return "; ".join(
+        f'{".".join(map(str, error["loc"]))}: {error["msg"]}' for error in e.errors()
+    )
+
+
+def readBoard(
+    board_path: pathlib.Path, report: BoardLoadReport
+) -> tuple[ReferenceBoardModel, bytes, BoardPack | None]:
+    # (board, its JSON, the open pack for packed boards)
+    with span("parse", board_path):
+        if BoardPack.isPackFile(board_path):
+            board_pack = BoardPack.open(board_path)
+            json_board = board_pack.boardJson()
+            return parseBoard(json_board, report), json_board, board_pack
+        with open(board_path, "rb") as f:
+            json_board = f.read()
+        return parseBoard(json_board, report), json_board, None
+
+
+"""
+Unit Tests
+"""
+
+test_data = {
+    "json_refboard": '{"board_name": "test", "reference_images": {'
+    '"pippo": {"path": "./pippo.png", "zoom": "2"}, '
+    '"pluto": {"path": "./pluto.png", "zoom": "big"}, '
+    '"paperino": {"zoom": 1}, '
+    '"topolino": "./topolino.png"}}',
+}
+
+
+@TestFunction
+def boardReader_bad_entries():
+    report = BoardLoadReport()
+    try:
+        board = parseBoard(test_data["json_refboard"], report)
+        assert board.board_name == "test", "wrong board name"
+        assert list(board.reference_images.keys()) == ["pippo", "pluto"], (
+            f"wrong images {list(board.reference_images.keys())}"
+        )
+        assert [name for name, error in report.errors] == ["paperino", "topolino"], (
+            f"wrong report {report.errors}"
+        )
+        assert validateImage(board.reference_images["pippo"]).zoom == 2, "not validated"
+        try:
+            validateImage(board.reference_images["pluto"])
+            assert False, "bad zoom validated"
+        except ValidationError:
+            pass
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def boardReader_bad_board():
+    for json_board in ['["not", "a", "board"]', '{"board_name": ', '{"board_name": []}']:
+        try:
+            parseBoard(json_board, BoardLoadReport())
+        except (ValueError, ValidationError):
+            continue
+        print(f"ERROR: broken board loaded: {json_board}")
+        raise TestFailedException()
+
+
+@TestFunction
+def boardReader_many_images():
+    images = ", ".join(f'"{i}": {{"path": "./{i}.png"}}' for i in range(5000))
+    report = BoardLoadReport()
+    board = parseBoard(f'{{"reference_images": {{{images}}}}}', report)
+    if len(board.reference_images) != 5000 or not report.isEmpty():
+        print(f"ERROR: {len(board.reference_images)} images loaded")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    test_list = [
+        boardReader_bad_entries,
+        boardReader_bad_board,
+        boardReader_many_images,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
@@ -0,0 +1,272 @@
+import os
+import json
+import typing
+import hashlib
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QObject, QCoreApplication, pyqtSignal
+
+from ReferenceBoardModels import *
+from BoardPack import *
+from Instrumentation import *
+from UnitTesting import *
+
+
+# write data to path through a temporary file: path holds either the old or
+# the new content, never a partial one
+# data: the content, or a function writing it to the (binary) file
+def writeAtomic(
+    path: pathlib.Path, data: bytes | typing.Callable[[typing.BinaryIO], None]
+) -> None:
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            if callable(data):
+                data(f)
+            else:
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    # make the rename itself durable
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+# Saves boards in background: the model is copied (as plain python data) in
+# the GUI thread, while serialization and writing happen on a worker thread.
+# A save producing the same content of the last one is skipped.
+# Boards are saved as packed boards (BoardPack) when the path ends with
+# ".refpack": the images are stored in the board. Saving a packed board with
+# another extension extracts its images next to the board.
+class BoardWriter(QObject):
+    # all the saves go through a single thread: writes to a file keep their order
+    _executor: ThreadPoolExecutor = ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="CuteLookSave"
+    )
+
+    # (path, True if written, False if unchanged)
+    board_saved: typing.ClassVar[pyqtSignal] = pyqtSignal(str, bool)
+    # (path, error message)
+    save_failed: typing.ClassVar[pyqtSignal] = pyqtSignal(str, str)
+
+    def __init__(self, compact: bool = False) -> None:
+        # no Qt parent: pending saves keep the writer alive
+        super().__init__()
+        self._compact = compact
+        self._lock = threading.Lock()
+        self._saved_digests: dict[str, str] = {}
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def serialize(self, board: dict) -> bytes:
+        if self._compact:
+            json_output = json.dumps(board, ensure_ascii=False, separators=(",", ":"))
+        else:
+            json_output = json.dumps(board, ensure_ascii=False, indent=4)
+        return json_output.encode("utf-8")
+
+    def rememberSaved(self, path: pathlib.Path, data: bytes) -> None:
+        # content known to be in path (e.g. just read from it)
+        with self._lock:
+            self._saved_digests[path.absolute().as_posix()] = self.digest(data)
+
+    def save(self, model: ReferenceBoardModel, path: pathlib.Path):
+        snapshot = model.model_dump()
+        return self._executor.submit(self._write, snapshot, path)
+
+    def _write(self, snapshot: dict, path: pathlib.Path) -> None:
+        key = path.absolute().as_posix()
+        try:
+            packed = path.suffix == BoardPack.SUFFIX
+            if packed:
+                snapshot, images = BoardPack.packImages(snapshot)
+            else:
+                snapshot = BoardPack.extractImages(snapshot, path)
+            data = self.serialize(snapshot)
+            digest = self.digest(data)
+            with self._lock:
+                saved_digest = self._saved_digests.get(key)
+            if saved_digest is None and path.is_file():
+                saved_digest = self.digest(self._readBoard(path))
+            if saved_digest == digest and path.is_file():
+                log.info(f"board unchanged, not written: {path}")
+                self.board_saved.emit(key, False)
+                return
+            with span("save", path):
+                if packed:
+                    writeAtomic(path, lambda f: BoardPack.write(f, data, images))
+                else:
+                    writeAtomic(path, data)
+            with self._lock:
+                self._saved_digests[key] = digest
+        except Exception as e:
+            log.error(f'can\'t save board to "{path}": {e}')
+            self.save_failed.emit(key, str(e))
+            return
+        self.board_saved.emit(key, True)
+
+    @staticmethod
+    def _readBoard(path: pathlib.Path) -> bytes:
+        # board JSON saved in path
+        if BoardPack.isPackFile(path):
+            return BoardPack(path).boardJson()
+        with open(path, "rb") as f:
+            return f.read()
+
+
+"""
+Unit Tests
+"""
+import shutil
+
+from PyQt5.QtGui import QImage
+
+test_data = {
+    "board_file_name": pathlib.Path("./test_writer.refboard"),
+}
+
+
+def makeBoard() -> ReferenceBoardModel:
+    board = ReferenceBoardModel(board_name="writer")
+    board.reference_images["pippo"] = ReferenceImageModel(path="./pippo.png")
+    return board
+
+
+@TestFunction
+def boardWriter_save_ok():
+    path = test_data["board_file_name"]
+    results = []
+    writer = BoardWriter()
+    writer.board_saved.connect(lambda p, written: results.append(written))
+    try:
+        board = makeBoard()
+        writer.save(board, path).result()
+        # modified after the save request: not part of the saved board
+        board.board_name = "changed"
+        with open(path, "r", encoding="utf-8") as f:
+            saved = ReferenceBoardModel.model_validate_json(f.read())
+        assert saved == makeBoard(), "saved board differs"
+        assert not path.with_name(f".{path.name}.tmp").exists(), "tmp file left"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        path.unlink(missing_ok=True)
+
+
+@TestFunction
+def boardWriter_skip_unchanged():
+    path = test_data["board_file_name"]
+    results = []
+    writer = BoardWriter()
+    writer.board_saved.connect(lambda p, written: results.append(written))
+    try:
+        writer.save(makeBoard(), path).result()
+        mtime = path.stat().st_mtime_ns
+        writer.save(makeBoard(), path).result()
+        assert path.stat().st_mtime_ns == mtime, "unchanged board written again"
+        # unknown to a new writer, same content on disk
+        other_writer = BoardWriter()
+        other_writer.board_saved.connect(lambda p, written: results.append(written))
+        other_writer.save(makeBoard(), path).result()
+        QCoreApplication.processEvents()
+        assert results == [True, False, False], f"unexpected results {results}"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        path.unlink(missing_ok=True)
+
+
+@TestFunction
+def boardWriter_compact():
+    path = test_data["board_file_name"]
+    writer = BoardWriter(compact=True)
+    try:
+        writer.save(makeBoard(), path).result()
+        with open(path, "r", encoding="utf-8") as f:
+            json_board = f.read()
+        assert "\n" not in json_board and " " not in json_board, "not compact"
+        assert ReferenceBoardModel.model_validate_json(json_board) == makeBoard(), (
+            "compact board differs"
+        )
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        path.unlink(missing_ok=True)
+
+
+@TestFunction
+def boardWriter_pack():
+    path = pathlib.Path("./test_writer.refpack")
+    image_path = pathlib.Path("./test_writer.png")
+    pack = None
+    try:
+        image = QImage(16, 16, QImage.Format_RGB32)
+        image.fill(0xFF00FF00)
+        image.save(image_path.as_posix())
+        board = ReferenceBoardModel(board_name="writer")
+        board.reference_images["pippo"] = ReferenceImageModel(path=image_path.as_posix())
+        writer = BoardWriter()
+        writer.save(board, path).result()
+        image_path.unlink()
+        pack = BoardPack.open(path)
+        packed_path = pack.board().reference_images["pippo"].path
+        assert BoardPack.imageExists(packed_path), "image not packed"
+        # unpacked again, from the open pack
+        board.reference_images["pippo"].path = packed_path
+        unpacked_path = pathlib.Path("./test_writer.refboard")
+        writer.save(board, unpacked_path).result()
+        unpacked = ReferenceBoardModel.model_validate_json(unpacked_path.read_text())
+        image_path = pathlib.Path(unpacked.reference_images["pippo"].path)
+        assert QImage(image_path.as_posix()).pixel(0, 0) == 0xFF00FF00, "image not unpacked"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        if pack is not None:
+            pack.close()
+        path.unlink(missing_ok=True)
+        pathlib.Path("./test_writer.refboard").unlink(missing_ok=True)
+        if image_path.parent.name == "test_writer_images":
+            shutil.rmtree(image_path.parent, ignore_errors=True)
+        image_path.unlink(missing_ok=True)
+
+
+@TestFunction
+def boardWriter_failure():
+    errors = []
+    writer = BoardWriter()
+    writer.save_failed.connect(lambda p, e: errors.append(e))
+    writer.save(makeBoard(), pathlib.Path("./not_existing_dir/board.refboard")).result()
+    QCoreApplication.processEvents()
+    if len(errors) != 1:
+        print("ERROR: save failure not reported")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    app = QCoreApplication([])
+    test_list = [
+        boardWriter_save_ok,
+        boardWriter_skip_unchanged,
+        boardWriter_compact,
+        boardWriter_pack,
+        boardWriter_failure,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
@@ -0,0 +1,292 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PyQt5.QtWidgets import QWidget
+from PyQt5.QtGui import QImage, QPixmap, QPainter, QColor, QPen, QFont
+from PyQt5.QtCore import Qt, QPoint, QRect, QRectF, QSize
+
+from AutoColorSwatch import imageArray, ARRAY_FORMATS
+from ImagePyramid import *
+from UnitTesting import *
+
+
+# Table of the sums of the values above and on the left of each pixel: the
+# sum (and so the average) over any rectangle takes 4 lookups, whatever its
+# size. Sums are uint32 and may wrap around: the differences are still exact
+# as long as a rectangle sums to less than 2^32 (255 * 2^24 pixels), which
+# halves the memory compared to uint64.
+class SummedAreaTable:
+    def __init__(self, values: np.ndarray) -> None:
+        # values: (height, width, channels)
+        h, w, channels = values.shape
+        self._table = np.zeros((h + 1, w + 1, channels), np.uint32)
+        np.cumsum(values, axis=0, dtype=np.uint32, out=self._table[1:, 1:])
+        np.cumsum(self._table[1:, 1:], axis=1, dtype=np.uint32, out=self._table[1:, 1:])
+
+    @classmethod
+    def fromImage(cls, image: QImage, mask: np.ndarray = None) -> "SummedAreaTable":
+        # RGB channels, followed by the masked RGB and the mask (0 or 1) if given
+        if image.format() not in ARRAY_FORMATS:
+            image = image.convertToFormat(QImage.Format_ARGB32)
+        rgb = imageArray(image)[..., 2::-1]
+        if mask is None:
+            return SummedAreaTable(rgb)
+        values = np.empty(rgb.shape[:2] + (7,), np.uint8)
+        values[..., :3] = rgb
+        np.multiply(rgb, mask[..., None], out=values[..., 3:6])
+        values[..., 6] = mask
+        return SummedAreaTable(values)
+
+    def isMasked(self) -> bool:
+        return self._table.shape[2] == 7
+
+    def width(self) -> int:
+        return self._table.shape[1] - 1
+
+    def height(self) -> int:
+        return self._table.shape[0] - 1
+
+    def byteCount(self) -> int:
+        return self._table.nbytes
+
+    def sum(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        # sum of each channel over [x0, x1) x [y0, y1)
+        t = self._table
+        return t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0]
+
+    def window(self, x: int, y: int, radius: int) -> tuple[int, int, int, int]:
+        # square of side 2 * radius + 1 centered in (x, y), clipped to the table
+        x0, y0 = max(x - radius, 0), max(y - radius, 0)
+        x1, y1 = min(x + radius + 1, self.width()), min(y + radius + 1, self.height())
+        return x0, y0, x1, y1
+
+    def average(self, x: int, y: int, radius: int) -> np.ndarray:
+        # RGB average. For masked tables the window stops at the pixels out of
+        # the mask: it shrinks to the largest square around (x, y) fully in
+        # the mask (a few lookups, binary search). Outside of the mask the
+        # average is of the pixels in the mask, if any.
+        if self.isMasked():
+            if self._inMask(x, y, 0):
+                low, high = 0, radius
+                while low < high:
+                    middle = (low + high + 1) // 2
+                    if self._inMask(x, y, middle):
+                        low = middle
+                    else:
+                        high = middle - 1
+                radius = low
+            else:
+                sums = self.sum(*self.window(x, y, radius))
+                if sums[6] > 0:
+                    return sums[3:6] / sums[6]
+        x0, y0, x1, y1 = self.window(x, y, radius)
+        area = max((x1 - x0) * (y1 - y0), 1)
+        return self.sum(x0, y0, x1, y1)[:3] / area
+
+    def _inMask(self, x: int, y: int, radius: int) -> bool:
+        x0, y0, x1, y1 = self.window(x, y, radius)
+        return self.sum(x0, y0, x1, y1)[6] == (x1 - x0) * (y1 - y0)
+
+
+# Averaged color under the pointer, for the magnified color picker. The
+# summed area tables of the last images picked from are kept: moving the
+# pointer, or changing the radius, costs the same for any radius.
+# Once the edge map of the image is ready the average stops at the edges
+# around the pointer: colors across an edge don't leak in.
+class ColorPicker:
+    MAX_TABLES: int = 4
+
+    _instance: "ColorPicker" = None
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._tables: OrderedDict[tuple, SummedAreaTable] = OrderedDict()
+
+    @classmethod
+    def instance(cls) -> "ColorPicker":
+        if cls._instance is None:
+            cls._instance = ColorPicker()
+        return cls._instance
+
+    def table(self, pyramid: ImagePyramid, level: int) -> SummedAreaTable:
+        image_key = pyramid.cacheKey() if pyramid.cacheKey() is not None else id(pyramid)
+        edge_map = pyramid.edgeMap()
+        key = (image_key, pyramid.size().width(), level, edge_map is not None)
+        with self._lock:
+            table = self._tables.get(key)
+            if table is not None:
+                self._tables.move_to_end(key)
+                return table
+        image = pyramid.level(level)
+        mask = None
+        if edge_map is not None:
+            mask = edge_map.mask(image.width(), image.height())
+        table = SummedAreaTable.fromImage(image, mask)
+        with self._lock:
+            self._tables[key] = table
+            while len(self._tables) > self.MAX_TABLES:
+                self._tables.popitem(last=False)
+        return table
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tables.clear()
+
+    def pick(self, table: SummedAreaTable, x: int, y: int, radius: int) -> QColor:
+        r, g, b = np.round(table.average(x, y, radius)).astype(int)
+        return QColor(int(r), int(g), int(b))
+
+
+# size x size pixels around center, each shown as magnification x magnification
+# screen pixels: only the pixels around center are copied
+def magnifiedClip(image: QImage, center: QPoint, size: int, magnification: int) -> QImage:
+    half = size // 2
+    clip = image.copy(QRect(center.x() - half, center.y() - half, size, size))
+    return clip.scaled(size * magnification, size * magnification, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+
+
+# Fixed size magnified view of the pixels under the pointer, annotated with
+# the picked color and the averaging window
+class MagnifierWidget(QWidget):
+    CLIP_PIXELS: int = 15
+    MAGNIFICATION: int = 8
+    CAPTION_HEIGHT: int = 20
+    # from the pointer
+    OFFSET: int = 20
+
+    def __init__(self, parent: QWidget = None) -> None:
+        super().__init__(parent)
+        self._clip = QPixmap()
+        self._color = QColor()
+        self._radius = 0
+        side = self.CLIP_PIXELS * self.MAGNIFICATION
+        self.setFixedSize(side, side + self.CAPTION_HEIGHT)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+
+    def setPicked(self, clip: QImage, color: QColor, radius: int) -> None:
+        self._clip = QPixmap.fromImage(clip)
+        self._color = color
+        self._radius = radius
+        self.update()
+
+    def follow(self, global_pos: QPoint) -> None:
+        # next to the pointer, always inside the parent
+        parent = self.parentWidget()
+        pos = parent.mapFromGlobal(global_pos) + QPoint(self.OFFSET, self.OFFSET)
+        if pos.x() + self.width() > parent.width():
+            pos.setX(pos.x() - self.width() - 2 * self.OFFSET)
+        if pos.y() + self.height() > parent.height():
+            pos.setY(pos.y() - self.height() - 2 * self.OFFSET)
+        self.move(max(pos.x(), 0), max(pos.y(), 0))
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        side = self.CLIP_PIXELS * self.MAGNIFICATION
+        painter.fillRect(self.rect(), QColor(32, 32, 32))
+        painter.drawPixmap(0, 0, self._clip)
+        # averaging window (as far as it fits the clip)
+        m = self.MAGNIFICATION
+        half = self.CLIP_PIXELS // 2
+        window = min(self._radius, half)
+        painter.setPen(QPen(QColor("white"), 1))
+        painter.drawRect((half - window) * m, (half - window) * m, (2 * window + 1) * m, (2 * window + 1) * m)
+        caption = QRectF(0, side, side, self.CAPTION_HEIGHT)
+        painter.fillRect(QRectF(2, side + 2, self.CAPTION_HEIGHT - 4, self.CAPTION_HEIGHT - 4), self._color)
+        font = QFont(painter.font())
+        font.setPointSize(8)
+        painter.setFont(font)
+        painter.drawText(
+            caption.adjusted(self.CAPTION_HEIGHT, 0, 0, 0),
+            Qt.AlignVCenter | Qt.AlignLeft,
+            f"{self._color.name()}  r={self._radius}",
+        )
+
+
+"""
+Unit Tests
+"""
+import time
+from EdgeMap import EdgeMap
+
+
+@TestFunction
+def summedAreaTable_average():
+    rng = np.random.default_rng(1)
+    values = rng.integers(0, 256, (60, 80, 3), np.uint8)
+    table = SummedAreaTable(values)
+    try:
+        for x, y, radius in [(0, 0, 0), (10, 20, 3), (79, 59, 5), (40, 30, 100)]:
+            x0, y0, x1, y1 = table.window(x, y, radius)
+            expected = values[y0:y1, x0:x1].reshape(-1, 3).mean(axis=0)
+            assert np.allclose(table.average(x, y, radius), expected), (
+                f"wrong average in ({x}, {y}) r={radius}"
+            )
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def summedAreaTable_wrap_around():
+    # cumulative sums well past 2^32: rectangles are still exact
+    values = np.full((5000, 5000, 1), 255, np.uint8)
+    table = SummedAreaTable(values)
+    if table.sum(4000, 4000, 4100, 4100)[0] != 255 * 100 * 100:
+        print("ERROR: wrong sum after wrap around")
+        raise TestFailedException()
+
+
+@TestFunction
+def colorPicker_edge_mask():
+    # red on the left, blue on the right, the pointer next to the border
+    image = QImage(200, 100, QImage.Format_RGB32)
+    image.fill(0xFFFF0000)
+    painter = QPainter(image)
+    painter.fillRect(100, 0, 100, 100, QColor(0, 0, 255))
+    painter.end()
+    pyramid = ImagePyramid(image)
+    picker = ColorPicker()
+    plain = picker.pick(picker.table(pyramid, 0), 95, 50, 10)
+    pyramid.setEdgeMap(EdgeMap.fromImage(image))
+    masked = picker.pick(picker.table(pyramid, 0), 95, 50, 10)
+    try:
+        assert plain.blue() > 0, "blue not averaged without edge map"
+        assert masked.name() == "#ff0000", f"blue leaked through the edge: {masked.name()}"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def colorPicker_constant_time():
+    image = QImage(2000, 1500, QImage.Format_RGB32)
+    image.fill(0xFF336699)
+    picker = ColorPicker()
+    table = picker.table(ImagePyramid(image), 0)
+    timings = {}
+    for radius in [0, 500]:
+        start = time.perf_counter()
+        for i in range(1000):
+            color = picker.pick(table, 1000 + i % 7, 700, radius)
+        timings[radius] = time.perf_counter() - start
+    try:
+        assert color.name() == "#336699", f"wrong color {color.name()}"
+        assert timings[500] < timings[0] * 3, f"radius dependent cost {timings}"
+        clip = magnifiedClip(image, QPoint(0, 0), 15, 8)
+        assert clip.size() == QSize(120, 120), "wrong clip size"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    test_list = [
+        summedAreaTable_average,
+        summedAreaTable_wrap_around,
+        colorPicker_edge_mask,
+        colorPicker_constant_time,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
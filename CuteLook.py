@@ -1,86 +1,329 @@
 #!/usr/bin/env python3
 
+import time
+
+# startup timings are measured from here, before any other import
+LAUNCHED = time.perf_counter()
+
 import sys
+import argparse
 from pathlib import Path
 
-from ReferenceImageView import *
-from ReferenceBoardView import *
-from ReferenceBoard import *
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QCoreApplication, QTimer
+
+from SingleInstance import *
+from Instrumentation import *
 from UnitTesting import *
 
+# The settings and the boards modules (pydantic models, views, loaders) are
+# imported where they are first needed: a second instance hands its board
+# over without loading them, the first one gets its window up sooner.
+
 
 class CuteLook:
-    _boards: dict[int, ReferenceBoard] = {}
+    def __init__(
+        self, board_path: str = "", settings: "CuteLookSettings" = None
+    ) -> None:
+        from CuteLookSettings import CuteLookSettings
+        from BoardJournal import BoardJournal
+        from ImageLoader import ImageLoader
+        from ImageCache import ImageCache
+        from PreviewCache import PreviewCache
+        from MemoryGovernor import MemoryGovernor
+        from TiledImage import TiledImage, TileStore
 
-    def __init__(self, board_path: str = "") -> None:
         super().__init__()
-        print(f"board_path: {board_path}")
+        self._settings = settings if settings is not None else CuteLookSettings()
+        self._boards: dict[int, "ReferenceBoard"] = {}
+        # ids are not reused: a closed board may still have events pending
+        self._next_board_id = 0
+        # images of all the boards within a single memory budget
+        self._governor = MemoryGovernor(self._settings.memory_budget_mb * 1024 * 1024)
+        SpanRecorder.instance().setEnabled(
+            self._settings.instrumentation or self._settings.instrumentation_overlay
+        )
+        ImageLoader.setMaxWorkers(self._settings.decode_workers)
+        log.info(f"decode workers: {ImageLoader.maxWorkers()}")
+        ImageCache.instance().setBudget(self._settings.image_cache_mb * 1024 * 1024)
+        PreviewCache.setInstance(previewCacheFromSettings(self._settings))
+        TiledImage.min_pixels = self._settings.tiled_image_mpx * 1000 * 1000
+        TileStore.setInstance(TileStore(None, self._settings.tile_cache_mb * 1024 * 1024))
+        BoardJournal.compact_records = self._settings.journal_compact_records
+        # once the board is shown (before its images are loaded): the index
+        # imports numpy
+        QTimer.singleShot(0, self._setupLibraryIndex)
         self.boardFactory(board_path)
 
-    def boardFactory(self, path: str):
-        print(f"CuteLook - boardFactory ({path})")
+    def _setupLibraryIndex(self) -> None:
+        from LibraryIndex import LibraryIndex
+
+        LibraryIndex.setInstance(LibraryIndex(enabled=self._settings.library_index))
+
+    def boardFactory(self, path: str) -> "ReferenceBoard":
+        from ReferenceBoardModels import ReferenceBoardModel
+        from ReferenceBoardView import ReferenceBoardView
+        from ReferenceBoard import ReferenceBoard
+        from BoardReader import BoardLoadReport, readBoard
+        from BoardWriter import BoardWriter
+        from BoardJournal import BoardJournal
+
         # 1. create the model
         board_model = None
         board_path = Path(path)
         is_new = True
+        board_journal = None
+        board_writer = BoardWriter(self._settings.compact_save)
+
+        board_pack = None
+        load_report = BoardLoadReport(board_path)
 
         if board_path.exists() and board_path.is_file():
-            print(f"Opening board: {board_path}")
-            with open(board_path, "r", encoding="utf-8") as f:
-                json_board = f.read()
-            board_model = ReferenceBoardModel.model_validate_json(json_board)
+            log.info(f"opening board: {board_path}")
+            board_model, json_board, board_pack = readBoard(board_path, load_report)
+            board_writer.rememberSaved(board_path, json_board)
             is_new = False
+
+            # recover the changes not saved (e.g. after a crash)
+            if BoardJournal.compact_records:
+                board_journal = BoardJournal(board_path)
+                if BoardJournal.hasNewerJournal(board_path):
+                    recovered = board_journal.replay(board_model)
+                    log.info(f"recovered {recovered} changes from {board_journal.path()}")
+                    # recovered changes are not saved in the board yet
+                    is_new = recovered > 0
+                else:
+                    board_journal.truncate()
         else:
-            print("Creating new empty board")
+            log.info("creating new empty board")
             board_model = ReferenceBoardModel()
             board_path = Path("")
 
         # 1.1 get the board id for this session
-        next_id = len(self._boards)
+        next_id = self._next_board_id
+        self._next_board_id += 1
 
         # 2. create the view
-        board_view = ReferenceBoardView(next_id)
+        board_view = ReferenceBoardView(next_id, self._settings)
 
         # 3. create the controller
-        new_board = ReferenceBoard(next_id, board_model, board_view)
-        new_board.updateModifiedStatus(is_new)
-        new_board.setBoardPath(board_path)
+        new_board = ReferenceBoard(
+            next_id, board_model, board_view, board_writer, board_pack, load_report
+        )
+        # broken image entries are dropped on save
+        new_board.updateModifiedStatus(is_new or not load_report.isEmpty())
+        new_board.setBoardPath(board_path, board_journal)
 
         # 4. connect relevant view's signals to manager (this)
-        print(f"CuteLook - connect signals")
         board_view.close_board.connect(self.closeBoard)
         board_view.new_board.connect(self.openBoard)
 
-        # 5. store the board
+        # 5. store the board, its images count in the memory budget
         self._boards[next_id] = new_board
+        self._governor.addBoard(next_id, board_view)
+        return new_board
 
     def closeBoard(self, board_id: int) -> None:
-        print("CuteLook - closeBoard")
+        from ImageCache import ImageCache
+
         try:
+            board_bytes = self._governor.boardBytes(board_id)
             if self._boards[board_id].close():
-                print(f"removing board {board_id}")
+                self._governor.removeBoard(board_id)
                 del self._boards[board_id]
-                print(f"...removed")
+                log.info(
+                    f"board {board_id} closed, {board_bytes / (1024 * 1024):.1f} MB of images"
+                    f" released, image cache: {ImageCache.instance().stats()}"
+                )
             if not len(self._boards):
-                print("Last board closed: exit")
+                log.info("last board closed: exit")
                 # the one below should not be needed
                 # QApplication::instance().quit()
 
         except Exception as e:
-            print(f'Excepltion cought while closing board "{board_id}":\n\t{e}')
+            log.error(f'exception caught while closing board "{board_id}": {e}')
 
-    # callback for UI open_board action
+    # callback for UI open_board action, and for the boards handed over by
+    # other instances (see SingleInstance)
     def openBoard(self, board_path: str) -> None:
-        print(f"CuteLook - openBoard ({board_path})")
-        self.boardFactory(board_path)
+        board = self.boardFactory(board_path)
+        board.view().raise_()
+        board.view().activateWindow()
+
+    def isLoading(self) -> bool:
+        return any(board.isLoading() for board in self._boards.values())
+
+    def memoryGovernor(self) -> "MemoryGovernor":
+        return self._governor
+
+
+def convertBoard(source: Path, destination: Path, compact: bool = False) -> None:
+    from pydantic import ValidationError
+    from BoardReader import BoardLoadReport, readBoard, validateImage, validationError
+    from BoardWriter import BoardWriter
+
+    # pack (to ".refpack") or unpack (to any other extension) a board
+    report = BoardLoadReport(source)
+    board_model, json_board, board_pack = readBoard(source, report)
+    # broken entries are not converted
+    for image_name, image_model in list(board_model.reference_images.items()):
+        try:
+            board_model.reference_images[image_name] = validateImage(image_model)
+        except ValidationError as e:
+            del board_model.reference_images[image_name]
+            report.add(image_name, validationError(e))
+    errors = []
+    board_writer = BoardWriter(compact)
+    board_writer.save_failed.connect(lambda path, error: errors.append(error))
+    try:
+        board_writer.save(board_model, destination).result()
+    finally:
+        if board_pack is not None:
+            board_pack.close()
+    QCoreApplication.processEvents()
+    if errors:
+        raise OSError(errors[0])
+
+
+def reportStartup(cute_look: CuteLook, report: StartupReport) -> None:
+    # printed once the images of the boards are loaded
+    if cute_look.isLoading():
+        QTimer.singleShot(10, lambda: reportStartup(cute_look, report))
+        return
+    report.mark("images loaded")
+    print("\n".join(report.lines()))
+
+
+def previewCacheFromSettings(settings: "CuteLookSettings") -> "PreviewCache":
+    from PreviewCache import PreviewCache
+
+    directory = None
+    if settings.preview_cache_dir != "":
+        directory = Path(settings.preview_cache_dir)
+    return PreviewCache(directory, settings.preview_cache_mb * 1024 * 1024)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CuteLook reference boards")
+    parser.add_argument("board", nargs="?", default="", help="board to open")
+    parser.add_argument(
+        "--preview-cache-info",
+        action="store_true",
+        help="print the status of the previews cache and exit",
+    )
+    parser.add_argument(
+        "--clear-preview-cache",
+        action="store_true",
+        help="remove all the cached previews and exit",
+    )
+    parser.add_argument(
+        "--index-library",
+        metavar="DIR",
+        help="index the images of the boards in DIR (and below), print the duplicates and exit",
+    )
+    parser.add_argument(
+        "--pack",
+        metavar="PACKED_BOARD",
+        help="save the board, with its images, as a packed board (.refpack) and exit",
+    )
+    parser.add_argument(
+        "--unpack",
+        metavar="BOARD",
+        help="save a packed board as a .refboard, extracting its images, and exit",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=list(LOG_LEVELS.keys()),
+        help="console messages, overrides the settings",
+    )
+    parser.add_argument(
+        "--new-instance",
+        action="store_true",
+        help="don't hand the board over to a running instance (single instance mode)",
+    )
+    parser.add_argument(
+        "--startup-report",
+        action="store_true",
+        help="print the time taken by each step of the startup",
+    )
+    args = parser.parse_args()
+    report = StartupReport(LAUNCHED)
+    report.mark("command line")
+
+    command = (
+        args.pack
+        or args.unpack
+        or args.preview_cache_info
+        or args.clear_preview_cache
+        or args.index_library
+    )
+    if not command and not args.new_instance and SingleInstance.sendBoard(args.board):
+        # a running instance opens the board
+        if args.startup_report:
+            report.mark("board handed over")
+            print("\n".join(report.lines()))
+        sys.exit(0)
+
+    from CuteLookSettings import CuteLookSettings
+
+    settings = CuteLookSettings.load()
+    setupLogging(args.log_level if args.log_level else settings.log_level)
+    report.mark("settings")
+
+    if args.pack or args.unpack:
+        from BoardPack import BoardPack
+
+        destination = Path(args.pack) if args.pack else Path(args.unpack)
+        if args.pack and destination.suffix != BoardPack.SUFFIX:
+            parser.error(f"packed boards must end with {BoardPack.SUFFIX}")
+        if args.unpack and destination.suffix == BoardPack.SUFFIX:
+            parser.error(f"unpacked boards can't end with {BoardPack.SUFFIX}")
+        app = QCoreApplication(sys.argv)
+        try:
+            convertBoard(Path(args.board), destination, settings.compact_save)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+        print(f"board saved to: {destination}")
+        sys.exit(0)
+
+    if args.preview_cache_info or args.clear_preview_cache:
+        preview_cache = previewCacheFromSettings(settings)
+        if args.clear_preview_cache:
+            preview_cache.clear()
+        for name, value in preview_cache.stats().items():
+            print(f"{name}: {value}")
+        sys.exit(0)
+
+    if args.index_library:
+        from LibraryIndex import LibraryIndex
+
+        app = QCoreApplication(sys.argv)
+        library = LibraryIndex()
+        boards = sorted(Path(args.index_library).rglob("*.refboard"))
+        print(f"{library.updateBoards(boards)} images indexed from {len(boards)} boards")
+        for name, value in library.stats().items():
+            print(f"{name}: {value}")
+        groups = library.duplicateGroups()
+        for group in groups:
+            print("\nduplicates:\n\t" + "\n\t".join(group))
+        print(f"{len(groups)} groups of duplicates")
+        sys.exit(0)
+
     app = QApplication(sys.argv)
+    report.mark("application")
+
+    ref_board = args.board
+    if ref_board != "":
+        log.info(f"loading reference board: {ref_board}")
+    cl = CuteLook(ref_board, settings)
+    report.mark("board window")
+
+    instance = SingleInstance()
+    if settings.single_instance and not args.new_instance and instance.listen():
+        instance.open_board.connect(cl.openBoard)
 
-    ref_board = ""
-    if len(sys.argv) > 1:
-        ref_board = sys.argv[1]
-        print(f"Loading refernece board: {ref_board}")
-    cl = CuteLook(ref_board)
+    if args.startup_report:
+        QTimer.singleShot(0, lambda: report.mark("event loop started"))
+        QTimer.singleShot(0, lambda: reportStartup(cl, report))
     sys.exit(app.exec_())
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+from pathlib import Path
+
+import numpy as np
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QImage, QWheelEvent
+from PyQt5.QtCore import Qt, QPoint, QPointF, QEventLoop
+
+from CuteLook import *
+from ReferenceBoard import *
+from CuteLookSettings import *
+from UnitTesting import *
+
+try:
+    import resource
+except ImportError:
+    # not on Windows: no peak RSS there
+    resource = None
+
+
+# Measures the hot paths of CuteLook on synthetic boards, without showing
+# anything (Qt offscreen platform): opening a board, loading its images,
+# zooming them with the wheel and saving the board.
+# Each run is repeated; timings are reported as percentiles, together with
+# the peak memory of the process. Results can be compared with a baseline
+# (a previous run): a metric slower than the baseline by more than the
+# threshold is a regression.
+
+
+def percentile(values: list[float], q: float) -> float:
+    # nearest rank
+    ordered = sorted(values)
+    rank = max(int(np.ceil(q / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(values: list[float]) -> dict[str, float]:
+    return {
+        "count": len(values),
+        "min": round(min(values), 3),
+        "p50": round(percentile(values, 50), 3),
+        "p90": round(percentile(values, 90), 3),
+        "p99": round(percentile(values, 99), 3),
+        "max": round(max(values), 3),
+        "mean": round(sum(values) / len(values), 3),
+    }
+
+
+def peakRssMb() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    if sys.platform == "darwin":
+        return round(peak / (1024 * 1024), 1)
+    return round(peak / 1024, 1)
+
+
+def compareResults(results: dict, baseline: dict, threshold: float) -> list[str]:
+    # regressions of the median of each metric (and of the peak RSS) against
+    # the baseline, one message each
+    regressions = []
+    for name, metric in results["metrics"].items():
+        base = baseline.get("metrics", {}).get(name)
+        if base is None or base["p50"] <= 0:
+            continue
+        if metric["p50"] > base["p50"] * (1 + threshold):
+            regressions.append(
+                f"{name}: p50 {metric['p50']} ms, baseline {base['p50']} ms "
+                f"(+{(metric['p50'] / base['p50'] - 1) * 100:.0f}%)"
+            )
+    rss, base_rss = results.get("peak_rss_mb"), baseline.get("peak_rss_mb")
+    if rss is not None and base_rss and rss > base_rss * (1 + threshold):
+        regressions.append(
+            f"peak_rss_mb: {rss} MB, baseline {base_rss} MB (+{(rss / base_rss - 1) * 100:.0f}%)"
+        )
+    return regressions
+
+
+def makeImages(directory: Path, count: int, width: int, height: int) -> list[Path]:
+    # gradients with noise: JPEG files of realistic size. Files already there
+    # (from a previous run) are reused.
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        path = directory / f"bench_{width}x{height}_{i:04}.jpg"
+        paths.append(path)
+        if path.is_file():
+            continue
+        image = QImage(width, height, QImage.Format_RGB32)
+        bits = image.bits()
+        bits.setsize(image.sizeInBytes())
+        pixels = np.frombuffer(bits, np.uint8).reshape(height, image.bytesPerLine() // 4, 4)
+        gradient = np.linspace(0, 200, width, dtype=np.float32)[None, :]
+        for channel in range(3):
+            noise = rng.integers(0, 56, (height, width), np.uint8)
+            pixels[:, :width, channel] = (gradient + channel * 20 * i % 55).astype(np.uint8) + noise
+        pixels[..., 3] = 255
+        image.save(path.as_posix(), "JPG", 90)
+    return paths
+
+
+def makeBoard(board_path: Path, images: list[Path], view_size: int) -> None:
+    board = ReferenceBoardModel(board_name="benchmark")
+    for i, path in enumerate(images):
+        board.reference_images[f"image{i}"] = ReferenceImageModel(
+            path=path.absolute().as_posix(),
+            view_size={"w": view_size, "h": view_size},
+            view_position={"w": (i % 16) * 24, "h": (i % 16) * 24},
+        )
+    board_path.write_text(board.model_dump_json(indent=2), encoding="utf-8")
+
+
+class Benchmark:
+    LOAD_TIMEOUT_S: float = 120.0
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self._args = args
+        self._timings: dict[str, list[float]] = {
+            "open_board_ms": [],
+            "load_images_ms": [],
+            "wheel_zoom_ms": [],
+            "save_board_ms": [],
+        }
+
+    def run(self) -> dict:
+        args = self._args
+        work_dir = Path(args.work_dir)
+        width, height = (int(v) for v in args.size.lower().split("x"))
+        images = makeImages(work_dir / "images", args.images, width, height)
+        board_path = work_dir / "benchmark.refboard"
+        makeBoard(board_path, images, args.view_size)
+
+        # decoded images are not reused across the runs: each one decodes
+        settings = CuteLookSettings(render_mode="widgets", preview_cache_mb=0)
+        cute_look = CuteLook("", settings)
+        for i in range(args.repeat):
+            ImageCache.instance().clear()
+            self._runOnce(cute_look, board_path)
+            print(f"run {i + 1}/{args.repeat} done")
+
+        return {
+            "config": {
+                "images": args.images,
+                "size": args.size,
+                "view_size": args.view_size,
+                "repeat": args.repeat,
+                "zoom_steps": args.zoom_steps,
+                "decode_workers": ImageLoader.maxWorkers(),
+            },
+            "platform": f"{platform.system()} {platform.machine()} Python {platform.python_version()}",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "metrics": {name: summarize(v) for name, v in self._timings.items() if v},
+            "peak_rss_mb": peakRssMb(),
+        }
+
+    def _runOnce(self, cute_look: CuteLook, board_path: Path) -> None:
+        app = QApplication.instance()
+        start = time.perf_counter()
+        board = cute_look.boardFactory(board_path.as_posix())
+        self._timings["open_board_ms"].append((time.perf_counter() - start) * 1000)
+
+        # loading goes on in background, driven by the event loop
+        while board.isLoading():
+            if time.perf_counter() - start > self.LOAD_TIMEOUT_S:
+                raise TimeoutError(f"board not loaded in {self.LOAD_TIMEOUT_S} s")
+            app.processEvents(QEventLoop.AllEvents, 10)
+        self._timings["load_images_ms"].append((time.perf_counter() - start) * 1000)
+
+        # in and out: the images get back to their size
+        widgets = list(board.view().openedImages().values())[: self._args.zoom_images]
+        for widget in widgets:
+            for step in range(self._args.zoom_steps):
+                delta = 120 if step % 2 == 0 else -120
+                event = QWheelEvent(
+                    QPointF(10, 10),
+                    QPointF(10, 10),
+                    QPoint(0, 0),
+                    QPoint(0, delta),
+                    Qt.NoButton,
+                    Qt.NoModifier,
+                    Qt.NoScrollPhase,
+                    False,
+                )
+                step_start = time.perf_counter()
+                widget.wheelEvent(event)
+                self._timings["wheel_zoom_ms"].append((time.perf_counter() - step_start) * 1000)
+        app.processEvents()
+
+        # a change the writer can't skip as unchanged
+        board.getModel().board_name = f"benchmark {time.time()}"
+        board.updateModifiedStatus(True)
+        start = time.perf_counter()
+        board.save()
+        while board.isSaving():
+            app.processEvents(QEventLoop.AllEvents, 1)
+        self._timings["save_board_ms"].append((time.perf_counter() - start) * 1000)
+
+        cute_look.closeBoard(board.boardId())
+        app.processEvents()
+
+
+"""
+Unit Tests
+"""
+
+
+@TestFunction
+def benchmark_percentiles():
+    values = [float(v) for v in range(1, 101)]
+    summary = summarize(values)
+    try:
+        assert summary["p50"] == 50 and summary["p90"] == 90, f"wrong percentiles {summary}"
+        assert summary["p99"] == 99 and summary["max"] == 100, f"wrong percentiles {summary}"
+        assert percentile([3.0], 90) == 3.0, "wrong single value percentile"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def benchmark_regressions():
+    baseline = {"metrics": {"a": {"p50": 10.0}, "b": {"p50": 10.0}}, "peak_rss_mb": 100.0}
+    results = {
+        "metrics": {"a": {"p50": 11.0}, "b": {"p50": 13.0}, "c": {"p50": 1.0}},
+        "peak_rss_mb": 130.0,
+    }
+    regressions = compareResults(results, baseline, 0.2)
+    try:
+        assert len(regressions) == 2, f"wrong regressions {regressions}"
+        assert regressions[0].startswith("b:"), f"wrong regression {regressions[0]}"
+        assert regressions[1].startswith("peak_rss_mb:"), f"wrong regression {regressions[1]}"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CuteLook benchmarks (offscreen)")
+    parser.add_argument("--images", type=int, default=50, help="images in the board")
+    parser.add_argument("--size", default="2000x1500", help="image resolution, WxH")
+    parser.add_argument("--view-size", type=int, default=256, help="shown size of the images")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each measure")
+    parser.add_argument("--zoom-steps", type=int, default=20, help="wheel steps per image")
+    parser.add_argument("--zoom-images", type=int, default=10, help="images zoomed per run")
+    parser.add_argument(
+        "--work-dir", default="./benchmark_data", help="synthetic boards and images"
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="slowdown against the baseline failing the run (0.2: 20%%)",
+    )
+    parser.add_argument(
+        "--update-baseline", action="store_true", help="write the results as the baseline"
+    )
+    parser.add_argument("--test", action="store_true", help="run the unit tests and exit")
+    args = parser.parse_args()
+
+    if args.test:
+        p, f = RunTest([benchmark_percentiles, benchmark_regressions])
+        exit(f)
+
+    # nothing is shown
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QApplication(sys.argv)
+    results = Benchmark(args).run()
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        Path(args.output).write_text(report, encoding="utf-8")
+
+    if args.baseline:
+        baseline_path = Path(args.baseline)
+        if args.update_baseline or not baseline_path.is_file():
+            baseline_path.write_text(report, encoding="utf-8")
+            print(f"baseline written: {baseline_path}")
+            sys.exit(0)
+        baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+        if baseline.get("config") != results["config"]:
+            print("WARNING: the baseline was taken with a different configuration")
+        regressions = compareResults(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"ERROR: regression: {regression}")
+        sys.exit(1 if regressions else 0)
+    sys.exit(0)
@@ -0,0 +1,122 @@
+import os
+import pathlib
+
+from typing import Literal
+
+from pydantic import BaseModel, ValidationError
+from Instrumentation import *
+from UnitTesting import *
+
+
+# Application wide settings, read once at startup
+class CuteLookSettings(BaseModel):
+    # how images are drawn: "widgets" (one per image) or "scene" (single canvas)
+    render_mode: Literal["widgets", "scene"] = "widgets"
+    # number of threads decoding images in background (0: one per core)
+    decode_workers: int = 0
+    # memory budget of the decoded images cache shared by all the boards
+    image_cache_mb: int = 1024
+    # size cap of the on disk previews cache (0: disabled)
+    preview_cache_mb: int = 512
+    # previews cache location ("": per user cache directory)
+    preview_cache_dir: str = ""
+    # save boards without indentation (smaller, faster to write)
+    compact_save: bool = False
+    # unsaved changes are logged next to the board and saved into it after
+    # this many changes (0: disabled)
+    journal_compact_records: int = 500
+    # hidden images release their pixels after this delay [s]
+    release_hidden_image_s: float = 30.0
+    # images from this many megapixels up, zoomed in past their decoded
+    # resolution, are drawn from tiles cut once and cached on disk (0: never)
+    tiled_image_mpx: int = 100
+    # size cap of the on disk tiles cache (0: disabled)
+    tile_cache_mb: int = 4096
+    # memory for the images of all the boards, decoded and shown; over it the
+    # least recently viewed images are reduced (0: no limit)
+    memory_budget_mb: int = 4096
+    # messages shown on the console: "off", "error", "warning", "info", "debug"
+    log_level: Literal["off", "error", "warning", "info", "debug"] = "warning"
+    # record the timings of the hot paths (logged at debug level)
+    instrumentation: bool = False
+    # show the timings and the image memory over the boards (F12 toggles it)
+    instrumentation_overlay: bool = False
+    # index the images of the boards opened and saved, to tell the images
+    # added to a board that are already in others (see LibraryIndex)
+    library_index: bool = True
+    # the first CuteLook opens the boards of the next ones (see SingleInstance)
+    single_instance: bool = False
+
+    @staticmethod
+    def settingsPath() -> pathlib.Path:
+        config_home = os.environ.get("XDG_CONFIG_HOME", "")
+        if config_home == "":
+            config_home = pathlib.Path.home() / ".config"
+        return pathlib.Path(config_home) / "cutelook" / "settings.json"
+
+    @classmethod
+    def load(cls, path: pathlib.Path = None) -> "CuteLookSettings":
+        if path is None:
+            path = cls.settingsPath()
+        if not (path.exists() and path.is_file()):
+            return cls()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return cls.model_validate_json(f.read())
+        except (OSError, ValidationError) as e:
+            log.warning(f"invalid settings file {path}, using defaults:\n\t{e}")
+            return cls()
+
+
+"""
+Unit Tests
+"""
+
+
+@TestFunction
+def settings_default():
+    settings = CuteLookSettings.load(pathlib.Path("./not_existing_settings.json"))
+    if settings.decode_workers != 0:
+        print("ERROR: unexpected default for decode_workers")
+        raise TestFailedException()
+
+
+@TestFunction
+def settings_from_file():
+    file_name = pathlib.Path("./test_settings.json")
+    with open(file_name, "w", encoding="utf-8") as f:
+        f.write('{"decode_workers": 3}')
+    try:
+        settings = CuteLookSettings.load(file_name)
+        assert settings.decode_workers == 3, "decode_workers not read from file"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        os.remove(file_name)
+
+
+@TestFunction
+def settings_bad_file():
+    file_name = pathlib.Path("./test_settings.json")
+    with open(file_name, "w", encoding="utf-8") as f:
+        f.write('{"decode_workers": "many"}')
+    try:
+        settings = CuteLookSettings.load(file_name)
+        assert settings.decode_workers == 0, "bad settings should fall back to defaults"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        os.remove(file_name)
+
+
+if __name__ == "__main__":
+    test_list = [
+        settings_default,
+        settings_from_file,
+        settings_bad_file,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
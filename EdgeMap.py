@@ -0,0 +1,239 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import numpy as np
+from PyQt5.QtGui import QImage
+
+from AutoColorSwatch import imageArray, ARRAY_FORMATS
+from ImageCache import ImageCache
+from ImagePyramid import *
+from UnitTesting import *
+
+
+def edgeStrength(image: QImage) -> np.ndarray:
+    # Sobel gradient magnitude, the strongest of the color channels (edges
+    # between colors of the same brightness count too), (height, width) uint8
+    if image.format() not in ARRAY_FORMATS:
+        image = image.convertToFormat(QImage.Format_ARGB32)
+    pixels = imageArray(image)
+    strength = np.zeros(pixels.shape[:2], np.float32)
+    for channel in range(3):
+        p = np.pad(pixels[..., channel].astype(np.float32), 1, mode="edge")
+        gx = (p[:-2, 2:] + 2 * p[1:-1, 2:] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[1:-1, :-2] + p[2:, :-2])
+        gy = (p[2:, :-2] + 2 * p[2:, 1:-1] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[:-2, 1:-1] + p[:-2, 2:])
+        np.maximum(strength, np.hypot(gx, gy), out=strength)
+    # a step of 255 gives 1020
+    return np.minimum(strength / 4, 255).astype(np.uint8)
+
+
+# Strong edges of an image, computed once on a reduced level. Besides the
+# edge mask, the edges of each column (row) are kept as cumulative counts:
+# the edge pixels on any vertical (horizontal) segment take 2 lookups.
+class EdgeMap:
+    # gradient strength of a strong edge (a step of about 50 in a channel)
+    THRESHOLD: int = 48
+    # fraction of a rectangle side lying on edges to snap it there
+    SNAP_COVERAGE: float = 0.5
+
+    def __init__(self, strength: np.ndarray) -> None:
+        edges = strength >= self.THRESHOLD
+        # grown by one pixel: the blended pixels along an edge belong to it
+        grown = edges.copy()
+        grown[1:] |= edges[:-1]
+        grown[:-1] |= edges[1:]
+        grown[:, 1:] |= edges[:, :-1]
+        grown[:, :-1] |= edges[:, 1:]
+        self._edges = grown
+        h, w = edges.shape
+        # the counts fit: maps are at most MAP_SIZE (see EdgeMapService)
+        self._columns = np.zeros((h + 1, w), np.uint16)
+        np.cumsum(edges, axis=0, out=self._columns[1:])
+        self._rows = np.zeros((h, w + 1), np.uint16)
+        np.cumsum(edges, axis=1, out=self._rows[:, 1:])
+
+    @classmethod
+    def fromImage(cls, image: QImage) -> "EdgeMap":
+        return EdgeMap(edgeStrength(image))
+
+    def width(self) -> int:
+        return self._edges.shape[1]
+
+    def height(self) -> int:
+        return self._edges.shape[0]
+
+    def byteCount(self) -> int:
+        return self._edges.nbytes + self._columns.nbytes + self._rows.nbytes
+
+    def isEdge(self, x: int, y: int) -> bool:
+        return bool(self._edges[y, x])
+
+    def mask(self, width: int, height: int) -> np.ndarray:
+        # (height, width) 1 out of the edges, 0 on them (nearest pixel)
+        ys = np.arange(height) * self.height() // height
+        xs = np.arange(width) * self.width() // width
+        return (~self._edges[ys[:, None], xs[None, :]]).astype(np.uint8)
+
+    def snapRegion(self, region: dict[str, float], tolerance: float) -> dict[str, float]:
+        # region (normalized) with each side moved to the strongest edge line
+        # within tolerance (normalized), if any
+        w, h = self.width(), self.height()
+        x0, x1 = round(region["x"] * w), round((region["x"] + region["w"]) * w)
+        y0, y1 = round(region["y"] * h), round((region["y"] + region["h"]) * h)
+        dx, dy = max(round(tolerance * w), 1), max(round(tolerance * h), 1)
+        x0, x1 = self._snap(x0, dx, w, y0, y1, vertical=True), self._snap(x1, dx, w, y0, y1, vertical=True)
+        y0, y1 = self._snap(y0, dy, h, x0, x1, vertical=False), self._snap(y1, dy, h, x0, x1, vertical=False)
+        if x1 <= x0 or y1 <= y0:
+            return dict(region)
+        return {"x": x0 / w, "y": y0 / h, "w": (x1 - x0) / w, "h": (y1 - y0) / h}
+
+    def _snap(self, side: int, tolerance: int, size: int, start: int, end: int, vertical: bool) -> int:
+        # side: column (vertical) or row of the side, spanning [start, end)
+        if end <= start:
+            return side
+        candidates = np.arange(max(side - tolerance, 0), min(side + tolerance, size - 1) + 1)
+        if len(candidates) == 0:
+            return side
+        # end > start: the unsigned differences don't wrap
+        if vertical:
+            counts = self._columns[end, candidates] - self._columns[start, candidates]
+        else:
+            counts = self._rows[candidates, end] - self._rows[candidates, start]
+        best = counts.argmax()
+        if counts[best] < self.SNAP_COVERAGE * (end - start):
+            return side
+        return int(candidates[best])
+
+
+# Computes the edge maps of the decoded images in background, one at a time,
+# when a view first needs one (a clip selection or the color picker starts):
+# the map is kept with the image (ImagePyramid.edgeMap, counted in its bytes)
+# and is shared, as the image, by all the views showing it. Until it is ready
+# the users go without.
+class EdgeMapService:
+    # largest side of the level the edges are computed on
+    MAP_SIZE: int = 1024
+
+    _instance: "EdgeMapService" = None
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="CuteLookEdges")
+        self._pending: dict[int, Future] = {}
+
+    @classmethod
+    def instance(cls) -> "EdgeMapService":
+        if cls._instance is None:
+            cls._instance = EdgeMapService()
+        return cls._instance
+
+    def request(self, pyramid: ImagePyramid) -> Future | None:
+        # None if the map is already there (or can't be computed)
+        if pyramid.isNull() or pyramid.edgeMap() is not None:
+            return None
+        with self._lock:
+            future = self._pending.get(id(pyramid))
+            if future is None:
+                future = self._executor.submit(self._compute, pyramid)
+                self._pending[id(pyramid)] = future
+            return future
+
+    def _compute(self, pyramid: ImagePyramid) -> EdgeMap:
+        try:
+            edge_map = EdgeMap.fromImage(pyramid.level(self.mapLevel(pyramid)))
+            pyramid.setEdgeMap(edge_map)
+            ImageCache.instance().updateBytes(pyramid)
+            return edge_map
+        finally:
+            with self._lock:
+                del self._pending[id(pyramid)]
+
+    @classmethod
+    def mapLevel(cls, pyramid: ImagePyramid) -> int:
+        # the biggest level not larger than MAP_SIZE
+        for index in range(pyramid.levelCount()):
+            level = pyramid.level(index)
+            if max(level.width(), level.height()) <= cls.MAP_SIZE:
+                return index
+        return pyramid.levelCount() - 1
+
+
+"""
+Unit Tests
+"""
+import time
+from PyQt5.QtGui import QPainter, QColor
+
+
+def makeSquare(w: int, h: int) -> QImage:
+    # white square on black, from (w/4, h/4) to (3w/4, 3h/4)
+    image = QImage(w, h, QImage.Format_RGB32)
+    image.fill(0xFF000000)
+    painter = QPainter(image)
+    painter.fillRect(w // 4, h // 4, w // 2, h // 2, QColor(255, 255, 255))
+    painter.end()
+    return image
+
+
+@TestFunction
+def edgeMap_edges():
+    edge_map = EdgeMap.fromImage(makeSquare(200, 100))
+    try:
+        assert edge_map.isEdge(50, 50), "left side of the square not an edge"
+        assert edge_map.isEdge(100, 25), "top side of the square not an edge"
+        assert not edge_map.isEdge(100, 50), "inside of the square is an edge"
+        assert not edge_map.isEdge(10, 10), "background is an edge"
+        mask = edge_map.mask(400, 200)
+        assert mask.shape == (200, 400), f"wrong mask shape {mask.shape}"
+        assert mask[100, 100] == 0 and mask[100, 200] == 1, "wrong mask"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def edgeMap_snap():
+    edge_map = EdgeMap.fromImage(makeSquare(200, 200))
+    try:
+        # the square is at 0.25 - 0.75
+        region = {"x": 0.22, "y": 0.28, "w": 0.5, "h": 0.5}
+        snapped = edge_map.snapRegion(region, 0.05)
+        for side, value in [("x", 0.25), ("y", 0.25)]:
+            assert abs(snapped[side] - value) <= 0.01, f"{side} not snapped: {snapped}"
+        assert abs(snapped["x"] + snapped["w"] - 0.75) <= 0.01, f"right not snapped: {snapped}"
+        far = {"x": 0.05, "y": 0.05, "w": 0.1, "h": 0.1}
+        assert edge_map.snapRegion(far, 0.02) == far, "snapped without edges"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def edgeMapService_background():
+    pyramid = ImagePyramid(makeSquare(4000, 3000))
+    image_bytes = pyramid.byteCount()
+    start = time.perf_counter()
+    future = EdgeMapService.instance().request(pyramid)
+    requested = time.perf_counter() - start
+    edge_map = future.result(10)
+    try:
+        assert requested < 0.01, f"request took {requested * 1000:.1f} ms"
+        assert pyramid.edgeMap() is edge_map, "edge map not kept with the image"
+        assert max(edge_map.width(), edge_map.height()) <= EdgeMapService.MAP_SIZE, "map too big"
+        assert EdgeMapService.instance().request(pyramid) is None, "edge map computed again"
+        assert pyramid.byteCount() == image_bytes + edge_map.byteCount(), "edge map bytes not counted"
+        # a 1024 x 768 map: mask and uint16 counts
+        assert edge_map.byteCount() < 1024 * 768 * 5 + 4096, f"{edge_map.byteCount()} bytes of edge map"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    test_list = [
+        edgeMap_edges,
+        edgeMap_snap,
+        edgeMapService_background,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
@@ -0,0 +1,386 @@
+import os
+import pathlib
+import threading
+import typing
+from collections import OrderedDict
+
+from ImagePyramid import *
+from UnitTesting import *
+
+
+# File identity: the same file opened by more boards (or more times in a
+# board) maps to the same key, while a modified file gets a new one.
+# (resolved path, modification time [ns], size [bytes])
+ImageKey = tuple[str, int, int]
+
+
+class ImageCacheEntry:
+    def __init__(self, pyramid: ImagePyramid) -> None:
+        self.pyramid = pyramid
+        self.refs = 0
+        self.bytes = pyramid.byteCount()
+
+
+# Process wide cache of decoded images shared by all the boards.
+# Images in use (acquired) are never evicted; the least recently used among
+# the others are dropped once the byte budget is exceeded.
+# A cached reduced resolution image is replaced when a bigger one is needed.
+# Files with the same content (see LibraryIndex) can share one entry: the key
+# of a copy is an alias of the key of the original.
+# Thread safe: decode workers look up and fill the cache directly.
+class ImageCache:
+    DEFAULT_BUDGET_MB: int = 1024
+
+    _instance: "ImageCache" = None
+
+    def __init__(self, budget_bytes: int = DEFAULT_BUDGET_MB * 1024 * 1024) -> None:
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[ImageKey, ImageCacheEntry] = OrderedDict()
+        self._decoding: dict[ImageKey, threading.Event] = {}
+        self._aliases: dict[ImageKey, ImageKey] = {}
+        self._budget = budget_bytes
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @classmethod
+    def instance(cls) -> "ImageCache":
+        if cls._instance is None:
+            cls._instance = ImageCache()
+        return cls._instance
+
+    @staticmethod
+    def fileKey(path: str) -> ImageKey | None:
+        try:
+            resolved = pathlib.Path(path).resolve()
+            stat = os.stat(resolved)
+        except OSError:
+            return None
+        return (resolved.as_posix(), stat.st_mtime_ns, stat.st_size)
+
+    def setBudget(self, budget_bytes: int) -> None:
+        with self._lock:
+            self._budget = budget_bytes
+            self._evict()
+
+    def budget(self) -> int:
+        return self._budget
+
+    def addAlias(self, key: ImageKey, same_as: ImageKey) -> None:
+        # key is decoded (and cached) as same_as
+        with self._lock:
+            same_as = self._aliases.get(same_as, same_as)
+            if key != same_as:
+                self._aliases[key] = same_as
+
+    def lookup(self, key: ImageKey) -> ImagePyramid | None:
+        with self._lock:
+            key = self._aliases.get(key, key)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return entry.pyramid
+
+    def insert(self, key: ImageKey, pyramid: ImagePyramid) -> ImagePyramid:
+        with self._lock:
+            return self._insert(self._aliases.get(key, key), pyramid)
+
+    def getOrDecode(
+        self,
+        key: ImageKey,
+        decode: typing.Callable[[], ImagePyramid],
+        size: QSize = None,
+    ) -> ImagePyramid:
+        # size None: full resolution needed
+        # concurrent requests of the same image wait for a single decode
+        with self._lock:
+            key = self._aliases.get(key, key)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry.pyramid.covers(size):
+                    self._hits += 1
+                    self._entries.move_to_end(key)
+                    return entry.pyramid
+                decoding = self._decoding.get(key)
+                if decoding is None:
+                    self._misses += 1
+                    decoding = self._decoding[key] = threading.Event()
+                    break
+            decoding.wait()
+
+        try:
+            pyramid = decode()
+            if pyramid.isNull():
+                return pyramid
+            with self._lock:
+                return self._insert(key, pyramid)
+        finally:
+            with self._lock:
+                del self._decoding[key]
+            decoding.set()
+
+    def acquire(self, pyramid: ImagePyramid) -> None:
+        key = pyramid.cacheKey()
+        if key is None:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refs += 1
+                return
+            # evicted meanwhile: still in use, track it again. In use before
+            # evicting: over budget the others go, not this one
+            entry = self._entries[key] = ImageCacheEntry(pyramid)
+            entry.refs = 1
+            self._bytes += entry.bytes
+            self._evict()
+
+    def release(self, pyramid: ImagePyramid, evict: bool = False) -> None:
+        # evict: drop the image right away if no longer in use
+        key = pyramid.cacheKey()
+        if key is None:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.refs == 0:
+                return
+            entry.refs -= 1
+            if evict and entry.refs == 0:
+                del self._entries[key]
+                self._bytes -= entry.bytes
+                self._evictions += 1
+                return
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e.refs == 0]:
+                self._bytes -= self._entries.pop(key).bytes
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "entries": len(self._entries),
+                "in_use": sum(1 for e in self._entries.values() if e.refs),
+                "bytes": self._bytes,
+                # kept only in case they are opened again
+                "unused_bytes": sum(e.bytes for e in self._entries.values() if not e.refs),
+                "budget": self._budget,
+            }
+
+    def updateBytes(self, pyramid: ImagePyramid) -> None:
+        # the pyramid grew after being cached (see EdgeMap)
+        with self._lock:
+            entry = self._entries.get(pyramid.cacheKey())
+            if entry is None or entry.pyramid is not pyramid:
+                return
+            self._bytes -= entry.bytes
+            entry.bytes = pyramid.byteCount()
+            self._bytes += entry.bytes
+            self._evict()
+
+    def _insert(self, key: ImageKey, pyramid: ImagePyramid) -> ImagePyramid:
+        pyramid.setCacheKey(key)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            if pyramid.size().width() <= entry.pyramid.size().width():
+                return entry.pyramid
+            # higher resolution: replace the cached one
+            self._bytes -= entry.bytes
+            entry.pyramid = pyramid
+            entry.bytes = pyramid.byteCount()
+            self._bytes += entry.bytes
+            self._evict()
+            return pyramid
+        entry = self._entries[key] = ImageCacheEntry(pyramid)
+        self._bytes += entry.bytes
+        self._evict()
+        return pyramid
+
+    def _evict(self) -> None:
+        if self._bytes <= self._budget:
+            return
+        # oldest first
+        for key in list(self._entries.keys()):
+            if self._bytes <= self._budget:
+                break
+            entry = self._entries[key]
+            if entry.refs == 0:
+                del self._entries[key]
+                self._bytes -= entry.bytes
+                self._evictions += 1
+
+
+"""
+Unit Tests
+"""
+
+
+def makePyramid(w: int, h: int) -> ImagePyramid:
+    image = QImage(w, h, QImage.Format_RGB32)
+    image.fill(0xFF202020)
+    return ImagePyramid(image)
+
+
+@TestFunction
+def imageCache_file_key():
+    file_name = "./test_cache_key.png"
+    makePyramid(16, 16).level(0).save(file_name)
+    try:
+        key = ImageCache.fileKey(file_name)
+        assert key is not None, "no key for existing file"
+        assert key == ImageCache.fileKey(f"./../{pathlib.Path.cwd().name}/{file_name}"), (
+            "same file, different key"
+        )
+        assert ImageCache.fileKey("./not_existing.png") is None, "key for missing file"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        os.remove(file_name)
+
+
+@TestFunction
+def imageCache_hit_miss():
+    cache = ImageCache()
+    key = ("a.png", 1, 1)
+    decoded = []
+
+    def decode():
+        decoded.append(True)
+        return makePyramid(64, 64)
+
+    first = cache.getOrDecode(key, decode)
+    second = cache.getOrDecode(key, decode)
+    stats = cache.stats()
+    if first is not second or len(decoded) != 1 or stats["hits"] != 1 or stats["misses"] != 1:
+        print(f"ERROR: decoded {len(decoded)} times, stats: {stats}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imageCache_alias():
+    cache = ImageCache()
+    original = cache.getOrDecode(("a.png", 1, 1), lambda: makePyramid(64, 64))
+    cache.addAlias(("copy_of_a.png", 2, 1), ("a.png", 1, 1))
+    try:
+        copy = cache.getOrDecode(("copy_of_a.png", 2, 1), lambda: makePyramid(32, 32))
+        assert copy is original, "copy decoded again"
+        assert cache.lookup(("copy_of_a.png", 2, 1)) is original, "alias not looked up"
+        assert cache.stats()["entries"] == 1, "copy cached twice"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imageCache_resolution_upgrade():
+    cache = ImageCache()
+    key = ("a.png", 1, 1)
+
+    def decodeReduced():
+        image = QImage(100, 100, QImage.Format_RGB32)
+        image.fill(0xFF202020)
+        return ImagePyramid(image, source_size=QSize(1000, 1000))
+
+    reduced = cache.getOrDecode(key, decodeReduced, QSize(100, 100))
+    try:
+        assert cache.getOrDecode(key, decodeReduced, QSize(80, 80)) is reduced, (
+            "smaller size should be a hit"
+        )
+        full = cache.getOrDecode(key, lambda: makePyramid(1000, 1000), QSize(500, 500))
+        assert full.size().width() == 1000, "full resolution not decoded"
+        assert cache.lookup(key) is full, "cached image not upgraded"
+        assert cache.stats()["bytes"] == full.byteCount(), "wrong bytes accounting"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imageCache_lru_eviction():
+    one_image = makePyramid(64, 64).byteCount()
+    cache = ImageCache(budget_bytes=one_image * 2)
+    a = cache.insert(("a", 0, 0), makePyramid(64, 64))
+    b = cache.insert(("b", 0, 0), makePyramid(64, 64))
+    cache.lookup(("a", 0, 0))
+    # "b" is the least recently used
+    cache.insert(("c", 0, 0), makePyramid(64, 64))
+    try:
+        assert cache.lookup(("b", 0, 0)) is None, "b should be evicted"
+        assert cache.lookup(("a", 0, 0)) is a, "a should be cached"
+        assert cache.stats()["evictions"] == 1, "one eviction expected"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imageCache_in_use_not_evicted():
+    one_image = makePyramid(64, 64).byteCount()
+    cache = ImageCache(budget_bytes=one_image)
+    a = cache.insert(("a", 0, 0), makePyramid(64, 64))
+    cache.acquire(a)
+    cache.insert(("b", 0, 0), makePyramid(64, 64))
+    try:
+        assert cache.lookup(("a", 0, 0)) is a, "in use image evicted"
+        assert cache.lookup(("b", 0, 0)) is None, "b should be evicted"
+        assert cache.stats()["unused_bytes"] == 0, "in use image counted as unused"
+        cache.release(a)
+        assert cache.stats()["unused_bytes"] == one_image, "released image not unused"
+        cache.setBudget(0)
+        assert cache.stats()["entries"] == 0, "released image not evicted"
+        cache.setBudget(one_image * 10)
+        b = cache.insert(("b", 0, 0), makePyramid(64, 64))
+        cache.acquire(b)
+        cache.release(b, evict=True)
+        assert cache.lookup(("b", 0, 0)) is None, "image not evicted on release"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imageCache_acquire_over_budget():
+    # nothing fits: images are kept only while in use
+    cache = ImageCache(budget_bytes=0)
+    a = cache.getOrDecode(("a", 0, 0), lambda: makePyramid(64, 64))
+    b = cache.getOrDecode(("b", 0, 0), lambda: makePyramid(64, 64))
+    try:
+        assert cache.stats()["entries"] == 0, "unused images kept over budget"
+        cache.acquire(a)
+        cache.acquire(b)
+        assert cache.lookup(("a", 0, 0)) is a, "acquired image not tracked"
+        assert cache.stats()["in_use"] == 2, "acquired images not in use"
+        # reduced and shown again (see MemoryGovernor)
+        cache.release(a, evict=True)
+        cache.acquire(a)
+        assert cache.lookup(("a", 0, 0)) is a, "image acquired again not tracked"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    test_list = [
+        imageCache_file_key,
+        imageCache_hit_miss,
+        imageCache_alias,
+        imageCache_resolution_upgrade,
+        imageCache_lru_eviction,
+        imageCache_in_use_not_evicted,
+        imageCache_acquire_over_budget,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
@@ -0,0 +1,187 @@
+import math
+
+from PyQt5.QtGui import QImage, QPainter
+from PyQt5.QtCore import Qt, QSize, QRectF
+
+from ImagePyramid import *
+from UnitTesting import *
+
+
+# A clip shows a region of an image straight from the pixels the image
+# already decoded: the region is drawn from the best pyramid level, with no
+# copy of it. Clips of an image cost no pixel memory, however many.
+
+
+def regionFromRect(rect: QRectF, size: QSize) -> dict[str, float]:
+    # normalized (0..1) region of rect in an image (or view) of size
+    rect = rect.intersected(QRectF(0, 0, size.width(), size.height()))
+    return {
+        "x": rect.x() / size.width(),
+        "y": rect.y() / size.height(),
+        "w": rect.width() / size.width(),
+        "h": rect.height() / size.height(),
+    }
+
+
+def regionRect(region: dict[str, float], size: QSize) -> QRectF:
+    return QRectF(
+        region["x"] * size.width(),
+        region["y"] * size.height(),
+        region["w"] * size.width(),
+        region["h"] * size.height(),
+    )
+
+
+def resizedRegion(region: dict[str, float], factor: float) -> dict[str, float]:
+    # region scaled around its center, kept inside the image
+    w = min(region["w"] * factor, 1.0)
+    h = min(region["h"] * factor, 1.0)
+    cx = region["x"] + region["w"] / 2
+    cy = region["y"] + region["h"] / 2
+    x = min(max(cx - w / 2, 0.0), 1.0 - w)
+    y = min(max(cy - h / 2, 0.0), 1.0 - h)
+    return {"x": x, "y": y, "w": w, "h": h}
+
+
+def zoomedRegion(center: tuple[float, float], zoom: float) -> dict[str, float]:
+    # region of an image zoomed in a frame showing it whole at zoom 1, around
+    # the normalized center, kept inside the image
+    side = 1.0 / max(zoom, 1.0)
+    x = min(max(center[0] - side / 2, 0.0), 1.0 - side)
+    y = min(max(center[1] - side / 2, 0.0), 1.0 - side)
+    return {"x": x, "y": y, "w": side, "h": side}
+
+
+def subRegion(region: dict[str, float], within: dict[str, float]) -> dict[str, float]:
+    # region of within (e.g. of a zoomed view) as a region of the whole image
+    return {
+        "x": within["x"] + region["x"] * within["w"],
+        "y": within["y"] + region["y"] * within["h"],
+        "w": region["w"] * within["w"],
+        "h": region["h"] * within["h"],
+    }
+
+
+def relativeRegion(region: dict[str, float], within: dict[str, float]) -> dict[str, float]:
+    # region of the whole image as a region of within (inverse of subRegion)
+    return {
+        "x": (region["x"] - within["x"]) / within["w"],
+        "y": (region["y"] - within["y"]) / within["h"],
+        "w": region["w"] / within["w"],
+        "h": region["h"] / within["h"],
+    }
+
+
+def clipImageSize(region: dict[str, float], view_size: QSize) -> QSize:
+    # size of the whole image needed to show region at view_size without upscaling
+    return QSize(
+        math.ceil(view_size.width() / max(region["w"], 1e-6)),
+        math.ceil(view_size.height() / max(region["h"], 1e-6)),
+    )
+
+
+def paintClip(
+    painter: QPainter,
+    target: QRectF,
+    pyramid: ImagePyramid,
+    region: dict[str, float],
+    exposed: QRectF = None,
+    smooth: bool = True,
+) -> None:
+    # draws region of the image in target, only the exposed part of it if given
+    # smooth False: fast scaling (e.g. while panning)
+    level = pyramid.level(pyramid.levelFor(clipImageSize(region, target.size().toSize())))
+    source = regionRect(region, level.size())
+    if exposed is not None:
+        exposed = exposed.intersected(target)
+        sx = source.width() / target.width()
+        sy = source.height() / target.height()
+        source = QRectF(
+            source.x() + (exposed.x() - target.x()) * sx,
+            source.y() + (exposed.y() - target.y()) * sy,
+            exposed.width() * sx,
+            exposed.height() * sy,
+        )
+        target = exposed
+    painter.save()
+    painter.setRenderHint(QPainter.SmoothPixmapTransform, smooth)
+    painter.drawImage(target, level, source)
+    painter.restore()
+
+
+"""
+Unit Tests
+"""
+from PyQt5.QtGui import QColor
+
+
+def makeQuadrants(w: int, h: int) -> QImage:
+    # red, green / blue, white
+    image = QImage(w, h, QImage.Format_RGB32)
+    painter = QPainter(image)
+    painter.fillRect(0, 0, w // 2, h // 2, QColor(255, 0, 0))
+    painter.fillRect(w // 2, 0, w - w // 2, h // 2, QColor(0, 255, 0))
+    painter.fillRect(0, h // 2, w // 2, h - h // 2, QColor(0, 0, 255))
+    painter.fillRect(w // 2, h // 2, w - w // 2, h - h // 2, QColor(255, 255, 255))
+    painter.end()
+    return image
+
+
+@TestFunction
+def imageClip_regions():
+    try:
+        region = regionFromRect(QRectF(50, 25, 100, 50), QSize(200, 100))
+        assert region == {"x": 0.25, "y": 0.25, "w": 0.5, "h": 0.5}, f"wrong region {region}"
+        assert regionRect(region, QSize(400, 200)) == QRectF(100, 50, 200, 100), "wrong rect"
+        grown = resizedRegion({"x": 0.8, "y": 0.1, "w": 0.2, "h": 0.2}, 2)
+        assert grown == {"x": 0.6, "y": 0.0, "w": 0.4, "h": 0.4}, f"not inside {grown}"
+        assert clipImageSize(region, QSize(300, 100)) == QSize(600, 200), "wrong image size"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imageClip_zoomed_regions():
+    try:
+        zoomed = zoomedRegion((0.5, 0.5), 4)
+        assert zoomed == {"x": 0.375, "y": 0.375, "w": 0.25, "h": 0.25}, f"wrong zoom {zoomed}"
+        corner = zoomedRegion((0.95, 0.0), 2)
+        assert corner == {"x": 0.5, "y": 0.0, "w": 0.5, "h": 0.5}, f"not inside {corner}"
+        assert zoomedRegion((0.2, 0.7), 0.5)["w"] == 1.0, "zoomed out of the whole image"
+        region = {"x": 0.5, "y": 0.0, "w": 0.5, "h": 1.0}
+        inner = subRegion(region, corner)
+        assert inner == {"x": 0.75, "y": 0.0, "w": 0.25, "h": 0.5}, f"wrong sub region {inner}"
+        assert relativeRegion(inner, corner) == region, "not the inverse of subRegion"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imageClip_paint():
+    pyramid = ImagePyramid(makeQuadrants(2000, 1000))
+    target = QImage(100, 100, QImage.Format_RGB32)
+    target.fill(0xFF000000)
+    painter = QPainter(target)
+    # bottom right quadrant, only the left half exposed
+    region = {"x": 0.5, "y": 0.5, "w": 0.5, "h": 0.5}
+    paintClip(painter, QRectF(0, 0, 100, 100), pyramid, region, QRectF(0, 0, 50, 100))
+    painter.end()
+    try:
+        assert target.pixelColor(25, 50).name() == "#ffffff", "wrong clip content"
+        assert target.pixelColor(75, 50).name() == "#000000", "not exposed part painted"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    test_list = [
+        imageClip_regions,
+        imageClip_zoomed_regions,
+        imageClip_paint,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
@@ -0,0 +1,249 @@
+import time
+import typing
+import pathlib
+import threading
+
+from PyQt5.QtGui import QImage, QImageReader
+from PyQt5.QtCore import QObject, QSize, QCoreApplication, pyqtSignal
+
+from ImageLoader import *
+from UnitTesting import *
+
+
+# Imports many images (files and directories) at once. The files are checked
+# (header only) on the decode pool, while the results are handed to the GUI
+# thread in batches: adding hundreds of images doesn't mean hundreds of round
+# trips through the event loop. The images are then decoded as usual by the
+# ImageLoader of the board.
+class ImageImporter(QObject):
+    # images delivered together to the GUI thread
+    BATCH_SIZE: int = 32
+    # or after this time, whatever comes first
+    BATCH_INTERVAL_S: float = 0.1
+
+    # (images checked, images to check)
+    progress: typing.ClassVar[pyqtSignal] = pyqtSignal(int, int)
+    # [(path, image size)]
+    images_ready: typing.ClassVar[pyqtSignal] = pyqtSignal(object)
+    # (images imported, [(path, error)], cancelled)
+    finished: typing.ClassVar[pyqtSignal] = pyqtSignal(int, object, bool)
+
+    def __init__(self, inspect: typing.Callable[[pathlib.Path], None] = None) -> None:
+        # no Qt parent: a running import keeps the importer alive
+        super().__init__()
+        self._cancelled = threading.Event()
+        self._thread: threading.Thread = None
+        # called by the checking workers for each image, before it is handed
+        # to the GUI thread (see DuplicateFinder)
+        self._inspect = inspect
+
+    @staticmethod
+    def imageSuffixes() -> set[str]:
+        formats = QImageReader.supportedImageFormats()
+        return {f".{bytes(f).decode('ascii').lower()}" for f in formats}
+
+    @classmethod
+    def expandPaths(cls, paths: list[pathlib.Path], recursive: bool) -> list[pathlib.Path]:
+        # files are taken as they are, directories contribute their images
+        suffixes = cls.imageSuffixes()
+        files = []
+        for path in paths:
+            if path.is_dir():
+                pattern = "**/*" if recursive else "*"
+                files.extend(
+                    sorted(
+                        p
+                        for p in path.glob(pattern)
+                        if p.suffix.lower() in suffixes and p.is_file()
+                    )
+                )
+            else:
+                files.append(path)
+        return files
+
+    def start(self, paths: list[pathlib.Path], recursive: bool = False) -> None:
+        self._cancelled.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(paths, recursive), name="CuteLookImport", daemon=True
+        )
+        self._thread.start()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def isRunning(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self, timeout: float = None) -> None:
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @staticmethod
+    def checkImage(path: pathlib.Path) -> tuple[pathlib.Path, QSize | None, str]:
+        # (path, image size, error) reading the header only
+        if not path.is_file():
+            return path, None, "file not found"
+        reader = QImageReader(path.as_posix())
+        size = reader.size()
+        if not reader.canRead() or not size.isValid():
+            return path, None, reader.errorString()
+        return path, size, ""
+
+    def _checkAndInspect(self, path: pathlib.Path) -> tuple[pathlib.Path, QSize | None, str]:
+        checked = self.checkImage(path)
+        if checked[1] is not None and self._inspect is not None and not self._cancelled.is_set():
+            self._inspect(path)
+        return checked
+
+    def _run(self, paths: list[pathlib.Path], recursive: bool) -> None:
+        files = self.expandPaths(paths, recursive)
+        total = len(files)
+        self.progress.emit(0, total)
+        imported = 0
+        failed = []
+        batch = []
+        last_batch = time.monotonic()
+        results = ImageLoader.executor().map(self._checkAndInspect, files)
+        try:
+            for checked, (path, size, error) in enumerate(results, 1):
+                if self._cancelled.is_set():
+                    break
+                if size is None:
+                    failed.append((path, error))
+                else:
+                    batch.append((path, size))
+                now = time.monotonic()
+                if len(batch) >= self.BATCH_SIZE or now - last_batch >= self.BATCH_INTERVAL_S:
+                    imported += len(batch)
+                    self.images_ready.emit(batch)
+                    self.progress.emit(checked, total)
+                    batch = []
+                    last_batch = now
+        finally:
+            # the checks not started yet are dropped
+            results.close()
+        if batch and not self._cancelled.is_set():
+            imported += len(batch)
+            self.images_ready.emit(batch)
+        self.progress.emit(total, total)
+        self.finished.emit(imported, failed, self._cancelled.is_set())
+
+
+"""
+Unit Tests
+"""
+import shutil
+
+test_data = {
+    "import_dir": pathlib.Path("./test_import"),
+}
+
+
+def makeImages(directory: pathlib.Path, count: int) -> None:
+    directory.mkdir(parents=True, exist_ok=True)
+    image = QImage(40, 20, QImage.Format_RGB32)
+    image.fill(0xFF808080)
+    for i in range(count):
+        image.save((directory / f"img{i:03}.png").as_posix())
+
+
+def runImport(
+    importer: ImageImporter,
+    paths: list,
+    recursive: bool,
+    started: typing.Callable[[], None] = lambda: None,
+) -> dict:
+    result = {"images": [], "batches": 0, "finished": None}
+
+    def onImagesReady(batch):
+        result["images"].extend(batch)
+        result["batches"] += 1
+
+    importer.images_ready.connect(onImagesReady)
+    importer.finished.connect(lambda n, failed, c: result.update(finished=(n, failed, c)))
+    importer.start(paths, recursive)
+    started()
+    importer.wait(10)
+    QCoreApplication.processEvents()
+    return result
+
+
+@TestFunction
+def imageImporter_directory():
+    directory = test_data["import_dir"]
+    try:
+        makeImages(directory, 70)
+        makeImages(directory / "sub", 5)
+        (directory / "notes.txt").write_text("not an image")
+        (directory / "broken.png").write_text("not an image")
+        result = runImport(ImageImporter(), [directory], recursive=False)
+        imported, failed, cancelled = result["finished"]
+        assert imported == 70 and len(result["images"]) == 70, f"{imported} images imported"
+        assert [p.name for p, e in failed] == ["broken.png"], f"wrong failures {failed}"
+        assert result["images"][0][1] == QSize(40, 20), "wrong image size"
+        assert result["batches"] < 70, "images not delivered in batches"
+        result = runImport(ImageImporter(), [directory], recursive=True)
+        assert result["finished"][0] == 75, "subdirectory not imported"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@TestFunction
+def imageImporter_inspect():
+    directory = test_data["import_dir"]
+    inspected = []
+    try:
+        makeImages(directory, 5)
+        (directory / "broken.png").write_text("not an image")
+        result = runImport(ImageImporter(inspected.append), [directory], recursive=False)
+        imported = sorted(p.name for p, size in result["images"])
+        assert sorted(p.name for p in inspected) == imported, f"wrong images inspected {inspected}"
+        assert len(imported) == 5, f"{len(imported)} images imported"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@TestFunction
+def imageImporter_cancel():
+    directory = test_data["import_dir"]
+    try:
+        makeImages(directory, 50)
+        # the checks wait for a busy decode pool
+        ImageLoader.setMaxWorkers(1)
+        blocker = threading.Event()
+        ImageLoader.executor().submit(blocker.wait)
+        importer = ImageImporter()
+
+        def cancel():
+            importer.cancel()
+            blocker.set()
+
+        result = runImport(importer, [directory], recursive=False, started=cancel)
+        imported, failed, cancelled = result["finished"]
+        assert cancelled, "import not cancelled"
+        assert imported == 0, f"{imported} images imported after cancel"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        ImageLoader.setMaxWorkers(0)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    app = QCoreApplication([])
+    PreviewCache.setInstance(PreviewCache(max_bytes=0))
+    test_list = [
+        imageImporter_directory,
+        imageImporter_inspect,
+        imageImporter_cancel,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
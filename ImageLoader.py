@@ -0,0 +1,283 @@
+import os
+import typing
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from PyQt5.QtGui import QImage, QImageReader
+from PyQt5.QtCore import Qt, QObject, QSize, QCoreApplication, pyqtSignal
+
+from ImagePyramid import *
+from ImageCache import *
+from PreviewCache import *
+from BoardPack import *
+from Instrumentation import *
+from UnitTesting import *
+
+
+# Decodes image files on a worker pool shared by all the boards.
+# Decoded images are shared through the ImageCache: a file already decoded
+# (by any board) is not decoded again.
+# When a display size is given the image is decoded directly at (about)
+# that size, instead of the full resolution, and the result is kept in the
+# on disk PreviewCache so the next time the source file is not even read.
+# Decoding produces an ImagePyramid of QImage (safe outside the GUI thread):
+# the receiver is in charge of turning it into QPixmap once back in the GUI
+# thread.
+class ImageLoader(QObject):
+    _executor: ThreadPoolExecutor = None
+    _max_workers: int = 0
+
+    # (job id, decoded ImagePyramid - null on failure)
+    image_loaded: typing.ClassVar[pyqtSignal] = pyqtSignal(int, object)
+
+    def __init__(self) -> None:
+        # no Qt parent: jobs still running keep the loader alive
+        super().__init__()
+        self._lock = threading.RLock()
+        self._next_job_id = 0
+        self._generation = 0
+        self._jobs: dict[int, Future] = {}
+
+    @classmethod
+    def setMaxWorkers(cls, max_workers: int) -> None:
+        if max_workers <= 0:
+            max_workers = os.cpu_count() or 1
+        if cls._executor is not None:
+            if max_workers == cls._max_workers:
+                return
+            # already queued jobs are completed by the old pool
+            cls._executor.shutdown(wait=False)
+        cls._max_workers = max_workers
+        cls._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="CuteLookDecode"
+        )
+
+    @classmethod
+    def maxWorkers(cls) -> int:
+        return cls._max_workers
+
+    @classmethod
+    def executor(cls) -> ThreadPoolExecutor:
+        if cls._executor is None:
+            cls.setMaxWorkers(0)
+        return cls._executor
+
+    def load(self, path: str, size: QSize = None) -> int:
+        # holding the lock, the job can't complete before being tracked
+        with self._lock:
+            job_id = self._next_job_id
+            self._next_job_id += 1
+            future = self.executor().submit(
+                self._decode, job_id, self._generation, path, size
+            )
+            self._jobs[job_id] = future
+        return job_id
+
+    def cancel(self, job_id: int) -> None:
+        with self._lock:
+            future = self._jobs.pop(job_id, None)
+        if future is not None:
+            future.cancel()
+
+    def cancelAll(self) -> None:
+        with self._lock:
+            # running jobs will drop their result
+            self._generation += 1
+            jobs = list(self._jobs.values())
+            self._jobs.clear()
+        for future in jobs:
+            future.cancel()
+
+    def pendingJobs(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+    def _isCancelled(self, generation: int) -> bool:
+        with self._lock:
+            return generation != self._generation
+
+    def _decode(self, job_id: int, generation: int, path: str, size: QSize) -> None:
+        if self._isCancelled(generation):
+            return
+        key = imageFileKey(path)
+        if key is None:
+            pyramid = self._decodeFile(path, size)
+        else:
+            pyramid = ImageCache.instance().getOrDecode(
+                key, lambda: self._decodeFile(path, size, key), size
+            )
+        with self._lock:
+            if generation == self._generation:
+                self.image_loaded.emit(job_id, pyramid)
+            self._jobs.pop(job_id, None)
+
+    def _decodeFile(
+        self, path: str, size: QSize = None, key: ImageKey = None
+    ) -> ImagePyramid:
+        if size is not None and key is not None:
+            pyramid = PreviewCache.instance().load(key, size)
+            if pyramid is not None:
+                return pyramid
+
+        if BoardPack.isPackedImage(path):
+            # read in place from the memory mapped pack
+            device = BoardPack.imageDevice(path)
+            if device is None:
+                log.error(f'can\'t decode "{path}": not in any open pack')
+                return ImagePyramid(QImage())
+            reader = QImageReader(device)
+        else:
+            reader = QImageReader(path)
+        # reading the size only parses the header
+        source_size = reader.size()
+        if size is not None and source_size.isValid():
+            scaled_size = fittedSize(source_size, size)
+            if scaled_size != source_size:
+                reader.setScaledSize(scaled_size)
+        with span("decode", path):
+            image = reader.read()
+        if image.isNull():
+            log.error(f'can\'t decode "{path}": {reader.errorString()}')
+            return ImagePyramid(image)
+        if not source_size.isValid():
+            source_size = image.size()
+        if key is not None and image.size() != source_size:
+            PreviewCache.instance().store(key, image, source_size, reader.supportsAnimation())
+        pyramid = ImagePyramid(image, source_size=source_size)
+        pyramid.setAnimated(reader.supportsAnimation())
+        return pyramid
+
+
+"""
+Unit Tests
+"""
+import time
+import pathlib
+
+test_data = {
+    "image_file_name": "./test_loader.png",
+}
+
+
+def waitJobs(loader: ImageLoader, timeout: float = 5.0) -> None:
+    start = time.monotonic()
+    while loader.pendingJobs() and time.monotonic() - start < timeout:
+        time.sleep(0.01)
+    # deliver the queued results
+    QCoreApplication.processEvents()
+
+
+@TestFunction
+def imageLoader_load_ok():
+    image = QImage(64, 32, QImage.Format_RGB32)
+    image.fill(0xFF00FF00)
+    image.save(test_data["image_file_name"])
+    loaded = {}
+    loader = ImageLoader()
+    loader.image_loaded.connect(lambda i, img: loaded.update({i: img}))
+    try:
+        job_id = loader.load(test_data["image_file_name"])
+        waitJobs(loader)
+        assert job_id in loaded, "image not loaded"
+        assert loaded[job_id].size().width() == 64, "wrong image width"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        os.remove(test_data["image_file_name"])
+
+
+@TestFunction
+def imageLoader_reduced_size():
+    image = QImage(800, 400, QImage.Format_RGB32)
+    image.fill(0xFF00FF00)
+    image.save(test_data["image_file_name"])
+    loaded = {}
+    loader = ImageLoader()
+    loader.image_loaded.connect(lambda i, img: loaded.update({i: img}))
+    try:
+        job_id = loader.load(test_data["image_file_name"], QSize(200, 200))
+        waitJobs(loader)
+        pyramid = loaded[job_id]
+        assert pyramid.size() == QSize(200, 100), f"decoded at {pyramid.size()}"
+        assert pyramid.sourceSize() == QSize(800, 400), "wrong source size"
+        job_id = loader.load(test_data["image_file_name"])
+        waitJobs(loader)
+        assert loaded[job_id].isFullResolution(), "full resolution not loaded"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        os.remove(test_data["image_file_name"])
+
+
+@TestFunction
+def imageLoader_missing_file():
+    loaded = {}
+    loader = ImageLoader()
+    loader.image_loaded.connect(lambda i, img: loaded.update({i: img}))
+    job_id = loader.load("./not_existing_image.png")
+    waitJobs(loader)
+    if job_id not in loaded or not loaded[job_id].isNull():
+        print("ERROR: missing file should be reported as a null image")
+        raise TestFailedException()
+
+
+@TestFunction
+def imageLoader_cancel_all():
+    loaded = {}
+    ImageLoader.setMaxWorkers(1)
+    blocker = threading.Event()
+    ImageLoader.executor().submit(blocker.wait)
+    loader = ImageLoader()
+    loader.image_loaded.connect(lambda i, img: loaded.update({i: img}))
+    for i in range(10):
+        loader.load("./not_existing_image.png")
+    loader.cancelAll()
+    blocker.set()
+    ImageLoader.executor().submit(lambda: None).result()
+    QCoreApplication.processEvents()
+    ImageLoader.setMaxWorkers(0)
+    if len(loaded) != 0 or loader.pendingJobs() != 0:
+        print(f"ERROR: {len(loaded)} cancelled jobs delivered a result")
+        raise TestFailedException()
+
+
+@TestFunction
+def imageLoader_animated_flag():
+    from AnimatedImage import makeGif
+
+    gif_file = "./test_loader.gif"
+    makeGif(gif_file, [(255, 0, 0), (0, 0, 255)], 8, 10)
+    image = QImage(8, 8, QImage.Format_RGB32)
+    image.save(test_data["image_file_name"])
+    loaded = {}
+    loader = ImageLoader()
+    loader.image_loaded.connect(lambda i, img: loaded.update({i: img}))
+    try:
+        gif_job = loader.load(gif_file)
+        png_job = loader.load(test_data["image_file_name"])
+        waitJobs(loader)
+        assert loaded[gif_job].isAnimated(), "animation not reported"
+        assert not loaded[png_job].isAnimated(), "still image reported animated"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        os.remove(gif_file)
+        os.remove(test_data["image_file_name"])
+
+
+if __name__ == "__main__":
+    app = QCoreApplication([])
+    PreviewCache.setInstance(PreviewCache(max_bytes=0))
+    test_list = [
+        imageLoader_load_ok,
+        imageLoader_reduced_size,
+        imageLoader_missing_file,
+        imageLoader_cancel_all,
+        imageLoader_animated_flag,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
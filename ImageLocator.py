@@ -0,0 +1,241 @@
+import os
+import hashlib
+import typing
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QObject, QCoreApplication, pyqtSignal
+
+from BoardPack import *
+from Instrumentation import *
+from UnitTesting import *
+
+
+# Checks and finds image files. File system access is I/O bound (think of a
+# network share): the checks run on many threads, mostly waiting in parallel.
+class ImageLocator:
+    _executor: ThreadPoolExecutor = ThreadPoolExecutor(
+        max_workers=16, thread_name_prefix="CuteLookStat"
+    )
+
+    @classmethod
+    def imagesExist(cls, paths: list[str]) -> list[bool]:
+        return list(cls._executor.map(BoardPack.imageExists, paths))
+
+
+# Index of the files under a directory, used to find images moved there
+# (e.g. a board copied to another machine together with its images).
+# A missing image is matched by file name; among files with the same name
+# the one sharing the longest part of the original path wins. Files left
+# tied are the same image if they have the same size (and the same content,
+# when hash_content is set), otherwise the match is ambiguous.
+class RelinkIndex:
+    def __init__(self, root: pathlib.Path, hash_content: bool = False) -> None:
+        self._root = pathlib.Path(root).absolute()
+        self._hash_content = hash_content
+        # file name (casefolded): [(path, size)]
+        self._files: dict[str, list[tuple[str, int]]] = {}
+
+    def build(self) -> int:
+        # returns the number of files indexed
+        files = 0
+        directories = [self._root]
+        while directories:
+            directory = directories.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                log.warning(f"can't index {directory}: {e}")
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file():
+                        size = entry.stat().st_size
+                        self._files.setdefault(entry.name.casefold(), []).append(
+                            (pathlib.Path(entry.path).as_posix(), size)
+                        )
+                        files += 1
+                except OSError:
+                    continue
+        return files
+
+    def find(self, missing_path: str) -> str | None:
+        missing = pathlib.PurePath(missing_path)
+        candidates = self._files.get(missing.name.casefold(), [])
+        if len(candidates) <= 1:
+            return candidates[0][0] if candidates else None
+
+        scores = [self._commonSuffix(missing, path) for path, size in candidates]
+        best = max(scores)
+        tied = [c for c, score in zip(candidates, scores) if score == best]
+        if len({size for path, size in tied}) > 1:
+            return None
+        if self._hash_content:
+            digests = set(ImageLocator._executor.map(self._digest, [p for p, s in tied]))
+            if len(digests) > 1 or None in digests:
+                return None
+        return tied[0][0]
+
+    def relink(self, missing: dict[str, str]) -> dict[str, str]:
+        # {image name: missing path} -> {image name: found path}
+        found = {}
+        for name, path in missing.items():
+            new_path = self.find(path)
+            if new_path is not None:
+                found[name] = new_path
+        return found
+
+    @staticmethod
+    def _commonSuffix(missing: pathlib.PurePath, path: str) -> int:
+        # number of trailing directories shared with the missing path
+        common = 0
+        parents = pathlib.PurePath(path).parent.parts
+        for a, b in zip(reversed(missing.parent.parts), reversed(parents)):
+            if a.casefold() != b.casefold():
+                break
+            common += 1
+        return common
+
+    @staticmethod
+    def _digest(path: str) -> str | None:
+        try:
+            with open(path, "rb") as f:
+                return hashlib.file_digest(f, "sha256").hexdigest()
+        except OSError:
+            return None
+
+
+# Relinks the missing images of a board on a thread of its own: walking a
+# directory tree (on a network share) can take long, the board stays usable
+# meanwhile. The images found are handed to the GUI thread once done.
+class RelinkSearch(QObject):
+    # ({image name: found path}, files indexed)
+    finished: typing.ClassVar[pyqtSignal] = pyqtSignal(object, int)
+
+    def __init__(self) -> None:
+        # no Qt parent: a running search keeps itself alive
+        super().__init__()
+        self._thread: threading.Thread = None
+
+    def start(self, root: pathlib.Path, missing: dict[str, str], hash_content: bool = False) -> None:
+        self._thread = threading.Thread(
+            target=self._run, args=(root, missing, hash_content), name="CuteLookRelink", daemon=True
+        )
+        self._thread.start()
+
+    def isRunning(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self, timeout: float = None) -> None:
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self, root: pathlib.Path, missing: dict[str, str], hash_content: bool) -> None:
+        index = RelinkIndex(root, hash_content)
+        files = index.build()
+        self.finished.emit(index.relink(missing), files)
+
+
+"""
+Unit Tests
+"""
+import shutil
+
+test_data = {
+    "root": pathlib.Path("./test_relink"),
+}
+
+
+def makeFile(path: pathlib.Path, content: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+
+
+@TestFunction
+def imageLocator_exist():
+    root = test_data["root"]
+    try:
+        makeFile(root / "a.png", b"a")
+        paths = [(root / "a.png").as_posix(), (root / "b.png").as_posix()] * 50
+        exist = ImageLocator.imagesExist(paths)
+        assert exist == [True, False] * 50, "wrong existence check"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+@TestFunction
+def relinkIndex_find():
+    root = test_data["root"]
+    try:
+        makeFile(root / "refs" / "cats" / "cat.png", b"cat")
+        makeFile(root / "refs" / "dogs" / "cat.png", b"not a cat")
+        makeFile(root / "refs" / "dog.png", b"dog")
+        makeFile(root / "copy1" / "fox.png", b"fox")
+        makeFile(root / "copy2" / "fox.png", b"fox")
+        makeFile(root / "v1" / "owl.png", b"owl")
+        makeFile(root / "v2" / "owl.png", b"owl 2")
+        index = RelinkIndex(root)
+        assert index.build() == 7, "wrong number of files indexed"
+        found = index.relink(
+            {
+                "cat": "/home/old/refs/cats/cat.png",
+                "dog": "/home/old/refs/DOG.png",
+                "fox": "/home/old/fox.png",
+                "owl": "/home/old/owl.png",
+                "bird": "/home/old/bird.png",
+            }
+        )
+        assert found["cat"].endswith("refs/cats/cat.png"), f"wrong cat: {found['cat']}"
+        assert found["dog"].endswith("refs/dog.png"), "dog not found"
+        assert "fox" in found, "copies of the same file should match"
+        assert "owl" not in found, "ambiguous owl matched"
+        assert "bird" not in found, "bird matched"
+        hashed_index = RelinkIndex(root, hash_content=True)
+        hashed_index.build()
+        assert hashed_index.find("/home/old/fox.png") is not None, "fox not found by content"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+@TestFunction
+def relinkSearch_background():
+    root = test_data["root"]
+    results = []
+    search = RelinkSearch()
+    search.finished.connect(lambda found, files: results.append((found, files)))
+    try:
+        makeFile(root / "refs" / "cat.png", b"cat")
+        makeFile(root / "refs" / "dog.png", b"dog")
+        search.start(root, {"cat": "/home/old/cat.png", "bird": "/home/old/bird.png"})
+        search.wait(10)
+        QCoreApplication.processEvents()
+        assert len(results) == 1, "search not finished"
+        found, files = results[0]
+        assert files == 2, "wrong number of files indexed"
+        assert list(found) == ["cat"], f"wrong images found {found}"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    app = QCoreApplication([])
+    test_list = [
+        imageLocator_exist,
+        relinkIndex_find,
+        relinkSearch_background,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
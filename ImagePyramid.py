@@ -0,0 +1,222 @@
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtCore import Qt, QSize
+
+from UnitTesting import *
+
+
+# Pre-downscaled copies of an image (each level half the size of the previous
+# one, level 0 being the decoded image). Zooming samples the smallest level
+# still bigger than the requested size, so its cost depends on the displayed
+# size and not on the size of the source image.
+# Levels are QImage: the pyramid can be built outside the GUI thread.
+# Level 0 may be a reduced resolution decode of the source image: the size of
+# the source is kept to tell when the full resolution is needed.
+class ImagePyramid:
+    MIN_LEVEL_SIZE: int = 128
+
+    def __init__(
+        self,
+        image: QImage,
+        min_level_size: int = MIN_LEVEL_SIZE,
+        source_size: QSize = None,
+    ) -> None:
+        self._levels: list[QImage] = [image]
+        self._source_size = source_size if source_size is not None else image.size()
+        self._cache_key = None
+        # see EdgeMap: computed later, in background, when first needed
+        self._edge_map = None
+        # the file has more frames (see AnimatedImage), told by the decoder
+        self._animated = False
+        if image.isNull():
+            return
+        level = image
+        while max(level.width(), level.height()) // 2 >= min_level_size:
+            level = level.scaled(
+                max(level.width() // 2, 1),
+                max(level.height() // 2, 1),
+                Qt.IgnoreAspectRatio,
+                Qt.SmoothTransformation,
+            )
+            self._levels.append(level)
+
+    def cacheKey(self):
+        return self._cache_key
+
+    def setCacheKey(self, key) -> None:
+        self._cache_key = key
+
+    def edgeMap(self):
+        return self._edge_map
+
+    def setEdgeMap(self, edge_map) -> None:
+        self._edge_map = edge_map
+
+    def isAnimated(self) -> bool:
+        return self._animated
+
+    def setAnimated(self, animated: bool) -> None:
+        self._animated = animated
+
+    def isNull(self) -> bool:
+        return self._levels[0].isNull()
+
+    def size(self) -> QSize:
+        return self._levels[0].size()
+
+    def sourceSize(self) -> QSize:
+        return self._source_size
+
+    def isFullResolution(self) -> bool:
+        return self.size() == self._source_size
+
+    def covers(self, size: QSize | None) -> bool:
+        # True if the image can be displayed at size (None: full resolution)
+        # without upscaling
+        if self.isFullResolution():
+            return True
+        if size is None:
+            return False
+        needed = fittedSize(self._source_size, size)
+        level = self._levels[0]
+        return level.width() >= needed.width() and level.height() >= needed.height()
+
+    def levelCount(self) -> int:
+        return len(self._levels)
+
+    def level(self, index: int) -> QImage:
+        return self._levels[index]
+
+    def thumbnail(self, max_size: int) -> QImage:
+        smallest = self._levels[-1]
+        return smallest.scaled(
+            max_size, max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation
+        )
+
+    def reduced(self, index: int) -> "ImagePyramid":
+        # the levels from index on, sharing their pixels: once the pyramid is
+        # dropped the bigger levels are freed (see MemoryGovernor)
+        pyramid = ImagePyramid(QImage(), source_size=self._source_size)
+        pyramid._levels = self._levels[index:]
+        pyramid._cache_key = self._cache_key
+        pyramid._edge_map = self._edge_map
+        pyramid._animated = self._animated
+        return pyramid
+
+    def byteCount(self) -> int:
+        edge_map = self._edge_map.byteCount() if self._edge_map is not None else 0
+        return sum(level.sizeInBytes() for level in self._levels) + edge_map
+
+    def levelFor(self, size: QSize) -> int:
+        # smallest level not smaller than the requested size
+        for index in range(len(self._levels) - 1, 0, -1):
+            level = self._levels[index]
+            if level.width() >= size.width() and level.height() >= size.height():
+                return index
+        return 0
+
+    def scaled(self, size: QSize, smooth: bool = True) -> QPixmap:
+        level = self._levels[self.levelFor(size)]
+        transform = Qt.SmoothTransformation if smooth else Qt.FastTransformation
+        if level.size() != size:
+            level = level.scaled(size, Qt.KeepAspectRatio, transform)
+        return QPixmap.fromImage(level)
+
+
+# size of source once scaled to fit in box (never bigger than source)
+def fittedSize(source: QSize, box: QSize) -> QSize:
+    if source.width() <= box.width() and source.height() <= box.height():
+        return QSize(source)
+    return source.scaled(box, Qt.KeepAspectRatio)
+
+
+"""
+Unit Tests
+"""
+
+
+@TestFunction
+def imagePyramid_levels():
+    image = QImage(1000, 600, QImage.Format_RGB32)
+    image.fill(0xFF808080)
+    pyramid = ImagePyramid(image)
+    try:
+        # 1000, 500, 250 (next would be below the minimum)
+        assert pyramid.levelCount() == 3, f"{pyramid.levelCount()} levels"
+        assert pyramid.level(1).size() == QSize(500, 300), "wrong level size"
+        assert pyramid.levelFor(QSize(1200, 700)) == 0, "zoom in must use level 0"
+        assert pyramid.levelFor(QSize(400, 240)) == 1, "wrong level for 400x240"
+        assert pyramid.levelFor(QSize(250, 150)) == 2, "exact size must be used"
+        assert pyramid.levelFor(QSize(10, 6)) == 2, "smallest level expected"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imagePyramid_scaled():
+    image = QImage(1000, 600, QImage.Format_RGB32)
+    image.fill(0xFF808080)
+    pyramid = ImagePyramid(image)
+    for smooth in [True, False]:
+        pixmap = pyramid.scaled(QSize(330, 198), smooth)
+        if pixmap.size() != QSize(330, 198):
+            print(f"ERROR: wrong scaled size {pixmap.size()}")
+            raise TestFailedException()
+
+
+@TestFunction
+def imagePyramid_covers():
+    image = QImage(500, 300, QImage.Format_RGB32)
+    image.fill(0xFF808080)
+    pyramid = ImagePyramid(image, source_size=QSize(5000, 3000))
+    try:
+        assert not pyramid.isFullResolution(), "reduced image seen as full"
+        assert pyramid.covers(QSize(500, 500)), "500x300 should cover 500x500 box"
+        assert not pyramid.covers(QSize(1000, 600)), "500x300 can't cover 1000x600"
+        full = ImagePyramid(image)
+        assert full.covers(QSize(1000, 600)), "full resolution covers any size"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imagePyramid_reduced():
+    image = QImage(1000, 600, QImage.Format_RGB32)
+    image.fill(0xFF808080)
+    pyramid = ImagePyramid(image)
+    reduced = pyramid.reduced(1)
+    try:
+        assert reduced.size() == QSize(500, 300), f"wrong size {reduced.size()}"
+        assert reduced.sourceSize() == QSize(1000, 600), "source size lost"
+        assert not reduced.covers(QSize(1000, 600)), "reduced image covers the source"
+        assert reduced.levelCount() == 2, f"{reduced.levelCount()} levels"
+        assert reduced.byteCount() < pyramid.byteCount() / 3, "bigger level kept"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imagePyramid_null():
+    pyramid = ImagePyramid(QImage())
+    if not pyramid.isNull() or pyramid.levelCount() != 1:
+        print("ERROR: null image should give a null pyramid")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    from PyQt5.QtWidgets import QApplication
+
+    # QPixmap needs a GUI application
+    app = QApplication([])
+    test_list = [
+        imagePyramid_levels,
+        imagePyramid_scaled,
+        imagePyramid_covers,
+        imagePyramid_reduced,
+        imagePyramid_null,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
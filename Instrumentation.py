@@ -0,0 +1,286 @@
+import sys
+import time
+import typing
+import logging
+import threading
+import contextlib
+from collections import deque
+
+from PyQt5.QtWidgets import QWidget
+from PyQt5.QtGui import QPainter, QColor, QFont, QFontMetrics
+from PyQt5.QtCore import Qt, QRect, QTimer
+
+from UnitTesting import *
+
+
+# Logger of the application: the modules log through it instead of printing
+log = logging.getLogger("cutelook")
+
+LOG_LEVELS: dict[str, int] = {
+    "off": logging.CRITICAL + 1,
+    "error": logging.ERROR,
+    "warning": logging.WARNING,
+    "info": logging.INFO,
+    "debug": logging.DEBUG,
+}
+
+
+def setupLogging(level: str = "warning") -> None:
+    # "off" silences everything
+    if not log.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+        log.addHandler(handler)
+        log.propagate = False
+    log.setLevel(LOG_LEVELS[level])
+
+
+class Span(typing.NamedTuple):
+    name: str
+    detail: str
+    ms: float
+    thread: str
+    # time.monotonic() at the end
+    end: float
+
+
+# Timings of the hot paths (board parse, image decode, scaling on zoom,
+# image widget creation, board save). Spans are recorded from any thread;
+# the last MAX_SPANS are kept for the overlay and each one is logged at
+# debug level. When disabled, measuring a span costs a function call.
+class SpanRecorder:
+    MAX_SPANS: int = 256
+
+    _instance: "SpanRecorder" = None
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._spans: deque[Span] = deque(maxlen=self.MAX_SPANS)
+        self._enabled = False
+
+    @classmethod
+    def instance(cls) -> "SpanRecorder":
+        if cls._instance is None:
+            cls._instance = SpanRecorder()
+        return cls._instance
+
+    def setEnabled(self, enabled: bool) -> None:
+        self._enabled = enabled
+
+    def isEnabled(self) -> bool:
+        return self._enabled
+
+    def record(self, name: str, detail: str, ms: float) -> None:
+        span = Span(name, detail, ms, threading.current_thread().name, time.monotonic())
+        with self._lock:
+            self._spans.append(span)
+        log.debug(f"span {name} {ms:.2f} ms {detail}")
+
+    def recent(self, count: int) -> list[Span]:
+        # most recent last
+        with self._lock:
+            return list(self._spans)[-count:]
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        # {span name: count, mean and max [ms]} of the spans kept
+        with self._lock:
+            spans = list(self._spans)
+        summary = {}
+        for span in spans:
+            entry = summary.setdefault(span.name, {"count": 0, "mean": 0.0, "max": 0.0})
+            entry["count"] += 1
+            entry["mean"] += (span.ms - entry["mean"]) / entry["count"]
+            entry["max"] = max(entry["max"], span.ms)
+        return summary
+
+    def clear(self) -> None:
+        with self._lock:
+            self._spans.clear()
+
+
+class _Span:
+    __slots__ = ("_recorder", "_name", "_detail", "_start")
+
+    def __init__(self, recorder: SpanRecorder, name: str, detail: str) -> None:
+        self._recorder = recorder
+        self._name = name
+        self._detail = detail
+
+    def __enter__(self) -> "_Span":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        ms = (time.perf_counter() - self._start) * 1000
+        self._recorder.record(self._name, self._detail, ms)
+
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+def span(name: str, detail: str = ""):
+    # with span("decode", path): ...
+    recorder = SpanRecorder.instance()
+    if not recorder.isEnabled():
+        return _NO_SPAN
+    return _Span(recorder, name, str(detail))
+
+
+# Time from the launch of CuteLook to each step of its startup
+class StartupReport:
+    def __init__(self, launched: float) -> None:
+        # launched: time.perf_counter() when CuteLook was launched
+        self._launched = launched
+        self._steps: list[tuple[str, float]] = []
+
+    def mark(self, step: str) -> None:
+        self._steps.append((step, time.perf_counter()))
+
+    def lines(self) -> list[str]:
+        lines = []
+        previous = self._launched
+        for step, at in self._steps:
+            lines.append(
+                f"{(at - self._launched) * 1000:8.1f} ms  (+{(at - previous) * 1000:7.1f} ms)  {step}"
+            )
+            previous = at
+        return lines
+
+
+# Overlay listing the last spans and the memory used by the images of a
+# board, refreshed while visible. memory returns [(label, bytes)].
+class InstrumentationOverlay(QWidget):
+    LINES: int = 12
+    REFRESH_MS: int = 500
+
+    def __init__(
+        self, memory: typing.Callable[[], list[tuple[str, int]]], parent: QWidget = None
+    ) -> None:
+        super().__init__(parent)
+        self._memory = memory
+        self._lines: list[str] = []
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self._font = QFont("monospace", 8)
+        self._font.setStyleHint(QFont.Monospace)
+        metrics = QFontMetrics(self._font)
+        self.setFixedSize(
+            metrics.horizontalAdvance("x" * 56) + 12, metrics.height() * (self.LINES + 3) + 12
+        )
+        self._timer = QTimer(self)
+        self._timer.setInterval(self.REFRESH_MS)
+        self._timer.timeout.connect(self.refresh)
+        self.hide()
+
+    def showEvent(self, event):
+        self.refresh()
+        self._timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self._timer.stop()
+        super().hideEvent(event)
+
+    def refresh(self) -> None:
+        memory = "  ".join(f"{label}: {size / (1024 * 1024):.1f} MB" for label, size in self._memory())
+        lines = [memory, ""]
+        for s in reversed(SpanRecorder.instance().recent(self.LINES)):
+            lines.append(f"{s.name:<8} {s.ms:8.2f} ms  {s.detail[-34:]}")
+        if not SpanRecorder.instance().isEnabled():
+            lines.append("(timings not recorded)")
+        self._lines = lines
+        # over the images added meanwhile
+        self.raise_()
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor(0, 0, 0, 180))
+        painter.setPen(QColor("white"))
+        painter.setFont(self._font)
+        height = QFontMetrics(self._font).height()
+        for i, line in enumerate(self._lines):
+            painter.drawText(QRect(6, 6 + i * height, self.width() - 12, height), Qt.AlignLeft, line)
+
+
+"""
+Unit Tests
+"""
+
+
+@TestFunction
+def spans_disabled():
+    recorder = SpanRecorder.instance()
+    recorder.setEnabled(False)
+    recorder.clear()
+    with span("decode", "a.png"):
+        pass
+    if recorder.recent(10):
+        print("ERROR: span recorded while disabled")
+        raise TestFailedException()
+
+
+@TestFunction
+def spans_recorded():
+    recorder = SpanRecorder.instance()
+    recorder.setEnabled(True)
+    recorder.clear()
+    try:
+        for i in range(SpanRecorder.MAX_SPANS + 10):
+            with span("scale", i):
+                pass
+        with span("save", "board.refboard"):
+            time.sleep(0.01)
+        recent = recorder.recent(2)
+        assert [s.name for s in recent] == ["scale", "save"], f"wrong spans {recent}"
+        assert recent[1].ms >= 10, f"wrong duration {recent[1].ms}"
+        summary = recorder.summary()
+        assert summary["scale"]["count"] == SpanRecorder.MAX_SPANS - 1, "spans not bounded"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        recorder.setEnabled(False)
+        recorder.clear()
+
+
+@TestFunction
+def logging_levels():
+    setupLogging("off")
+    try:
+        assert not log.isEnabledFor(logging.ERROR), "errors logged while off"
+        setupLogging("info")
+        assert log.isEnabledFor(logging.INFO), "info not logged"
+        assert not log.isEnabledFor(logging.DEBUG), "debug logged"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        setupLogging("warning")
+
+
+@TestFunction
+def startup_report():
+    report = StartupReport(time.perf_counter())
+    report.mark("imports")
+    time.sleep(0.01)
+    report.mark("board window")
+    lines = report.lines()
+    try:
+        assert len(lines) == 2, f"wrong report {lines}"
+        assert lines[1].endswith("board window"), f"wrong step {lines[1]}"
+        assert float(lines[1].split()[0]) >= 10, f"wrong time {lines[1]}"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    test_list = [
+        spans_disabled,
+        spans_recorded,
+        logging_levels,
+        startup_report,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
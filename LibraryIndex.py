@@ -0,0 +1,507 @@
+import os
+import json
+import hashlib
+import sqlite3
+import pathlib
+import typing
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import numpy as np
+from PyQt5.QtGui import QImage
+from PyQt5.QtCore import Qt, QObject, QSize, pyqtSignal
+
+from AutoColorSwatch import imageArray, ARRAY_FORMATS
+from ImagePyramid import fittedSize
+from BoardPack import *
+from Instrumentation import *
+from UnitTesting import *
+
+
+# side of the luminance sample an image is hashed from
+SAMPLE_SIZE: int = 32
+# the lowest HASH_SIZE x HASH_SIZE frequencies make the 64 bits of the hash
+HASH_SIZE: int = 8
+# images are decoded at most this big to be hashed
+DECODE_SIZE: int = 256
+
+
+def dctMatrix(n: int) -> np.ndarray:
+    # orthonormal DCT-II: dct(x) = D @ x
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    d = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    d[0] /= np.sqrt(2)
+    return d.astype(np.float32)
+
+
+DCT = dctMatrix(SAMPLE_SIZE)
+
+
+def hashSample(image: QImage) -> np.ndarray:
+    # (SAMPLE_SIZE, SAMPLE_SIZE) luminance of image, squeezed whatever its shape
+    sample = image.scaled(SAMPLE_SIZE, SAMPLE_SIZE, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+    if sample.format() not in ARRAY_FORMATS:
+        sample = sample.convertToFormat(QImage.Format_RGB32)
+    bgr = imageArray(sample)[..., :3].astype(np.float32)
+    return bgr @ np.array([0.114, 0.587, 0.299], np.float32)
+
+
+def perceptualHashes(samples: np.ndarray) -> np.ndarray:
+    # 64 bits hashes (uint64) of a stack of samples (n, SAMPLE_SIZE, SAMPLE_SIZE),
+    # all at once: a bit is set where a low frequency is over their median
+    coefficients = DCT @ samples @ DCT.T
+    low = coefficients[:, :HASH_SIZE, :HASH_SIZE].reshape(len(samples), HASH_SIZE * HASH_SIZE)
+    # the DC term (average brightness) is left out of the median
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    bits = np.packbits(low > median, axis=1, bitorder="little")
+    return bits.view("<u8").ravel().astype(np.uint64)
+
+
+def hammingDistances(hashes: np.ndarray, image_hash: int) -> np.ndarray:
+    # differing bits between image_hash and each of hashes
+    different = np.bitwise_xor(hashes, np.uint64(image_hash))
+    return np.unpackbits(different.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def decodeSample(path: str) -> tuple[np.ndarray, QSize] | None:
+    # (hash sample, source size) from a reduced decode, None if unreadable
+    reader, device = openImageReader(path)
+    if reader is None:
+        return None
+    source_size = reader.size()
+    if source_size.isValid():
+        reader.setScaledSize(fittedSize(source_size, QSize(DECODE_SIZE, DECODE_SIZE)))
+    image = reader.read()
+    if image.isNull():
+        return None
+    if not source_size.isValid():
+        source_size = image.size()
+    return hashSample(image), source_size
+
+
+# SQLite stores integers as signed 64 bits
+def toSigned(image_hash: int) -> int:
+    return image_hash - (1 << 64) if image_hash >= 1 << 63 else image_hash
+
+
+def toUnsigned(stored: int) -> int:
+    return stored + (1 << 64) if stored < 0 else stored
+
+
+# Per user index of the images of all the known boards (opened, saved or
+# indexed from the command line), with their perceptual hash: the same
+# picture saved under other paths and names, resized or recompressed, has a
+# hash a few bits apart. Boards and images are indexed again only when their
+# modification time (or size) changes. Queries compare a hash with all the
+# hashes at once, kept in memory as an array.
+class LibraryIndex:
+    # differing bits of the same picture, resized or recompressed
+    DUPLICATE_DISTANCE: int = 4
+    SIMILAR_DISTANCE: int = 12
+    DECODE_WORKERS: int = 2
+
+    _instance: "LibraryIndex" = None
+    _updater: ThreadPoolExecutor = None
+    _decoders: ThreadPoolExecutor = None
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER,
+            width INTEGER, height INTEGER, hash INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS boards (path TEXT PRIMARY KEY, mtime_ns INTEGER);
+        CREATE TABLE IF NOT EXISTS board_images (board TEXT, image TEXT);
+        CREATE INDEX IF NOT EXISTS board_images_image ON board_images (image);
+        -- bumped on every change of the images
+        CREATE TABLE IF NOT EXISTS version (images INTEGER);
+        INSERT INTO version SELECT 0 WHERE NOT EXISTS (SELECT * FROM version);
+    """
+
+    def __init__(self, path: pathlib.Path = None, enabled: bool = True) -> None:
+        self._path = path if path is not None else self.defaultPath()
+        self._enabled = enabled
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        # in memory copy of the hashes, reloaded once the database changes
+        self._loaded_version = None
+        self._paths: list[str] = []
+        self._hashes = np.zeros(0, np.uint64)
+
+    @classmethod
+    def instance(cls) -> "LibraryIndex":
+        if cls._instance is None:
+            cls._instance = LibraryIndex()
+        return cls._instance
+
+    @classmethod
+    def setInstance(cls, index: "LibraryIndex") -> None:
+        cls._instance = index
+
+    @staticmethod
+    def defaultPath() -> pathlib.Path:
+        cache_home = os.environ.get("XDG_CACHE_HOME", "")
+        if cache_home == "":
+            cache_home = pathlib.Path.home() / ".cache"
+        return pathlib.Path(cache_home) / "cutelook" / "library.sqlite"
+
+    @classmethod
+    def decoders(cls) -> ThreadPoolExecutor:
+        # a few workers: indexing runs aside the images being opened
+        if cls._decoders is None:
+            cls._decoders = ThreadPoolExecutor(
+                max_workers=cls.DECODE_WORKERS, thread_name_prefix="CuteLookLibrary"
+            )
+        return cls._decoders
+
+    def isEnabled(self) -> bool:
+        return self._enabled
+
+    def scheduleUpdate(self, board_paths: list[pathlib.Path]) -> Future | None:
+        # updateBoards in background
+        if not self._enabled:
+            return None
+        if LibraryIndex._updater is None:
+            LibraryIndex._updater = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="CuteLookLibraryUpdate"
+            )
+        return LibraryIndex._updater.submit(self.updateBoards, board_paths)
+
+    def updateBoards(self, board_paths: list[pathlib.Path]) -> int:
+        # indexes the boards changed since last time, returns the images hashed
+        if not self._enabled:
+            return 0
+        hashed = 0
+        try:
+            with self._connect() as db:
+                for board_path in board_paths:
+                    hashed += self._updateBoard(db, pathlib.Path(board_path).absolute())
+        except sqlite3.Error as e:
+            log.warning(f"library index not updated: {e}")
+        return hashed
+
+    def _updateBoard(self, db: sqlite3.Connection, board_path: pathlib.Path) -> int:
+        board = board_path.as_posix()
+        try:
+            mtime_ns = board_path.stat().st_mtime_ns
+        except OSError:
+            db.execute("DELETE FROM boards WHERE path = ?", (board,))
+            db.execute("DELETE FROM board_images WHERE board = ?", (board,))
+            return 0
+        row = db.execute("SELECT mtime_ns FROM boards WHERE path = ?", (board,)).fetchone()
+        if row is not None and row[0] == mtime_ns:
+            return 0
+        if BoardPack.isPackFile(board_path):
+            # packed images are read only through an open pack
+            log.info(f"library index: packed board {board_path} skipped")
+            return 0
+        try:
+            with open(board_path, "r", encoding="utf-8") as f:
+                images = json.load(f).get("reference_images", {})
+            paths = sorted({image["path"] for image in images.values() if "path" in image})
+        except (OSError, ValueError, AttributeError, TypeError) as e:
+            log.warning(f"library index: can't read {board_path}: {e}")
+            return 0
+        with span("library", board):
+            hashed = self._updateImages(db, paths)
+        db.execute("DELETE FROM board_images WHERE board = ?", (board,))
+        db.executemany(
+            "INSERT INTO board_images (board, image) VALUES (?, ?)", [(board, p) for p in paths]
+        )
+        db.execute("INSERT OR REPLACE INTO boards (path, mtime_ns) VALUES (?, ?)", (board, mtime_ns))
+        db.commit()
+        return hashed
+
+    def _updateImages(self, db: sqlite3.Connection, paths: list[str]) -> int:
+        stale = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            row = db.execute("SELECT mtime_ns, size FROM images WHERE path = ?", (path,)).fetchone()
+            if row is None or row != (stat.st_mtime_ns, stat.st_size):
+                stale.append((path, stat))
+        # a single image is decoded by the thread asking for it (see imageHash)
+        decode = self.decoders().map if len(stale) > 1 else map
+        samples = list(decode(decodeSample, [path for path, stat in stale]))
+        rows = [(path, stat, s) for (path, stat), s in zip(stale, samples) if s is not None]
+        if not rows:
+            return 0
+        hashes = perceptualHashes(np.stack([sample for path, stat, (sample, size) in rows]))
+        db.executemany(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (path, stat.st_mtime_ns, stat.st_size, size.width(), size.height(), toSigned(int(h)))
+                for (path, stat, (sample, size)), h in zip(rows, hashes)
+            ],
+        )
+        db.execute("UPDATE version SET images = images + 1")
+        return len(rows)
+
+    def imageHash(self, path: str) -> int | None:
+        # hash of an image file, indexed now if not yet (or if changed)
+        if not self._enabled:
+            return None
+        try:
+            with self._connect() as db:
+                self._updateImages(db, [path])
+                db.commit()
+                row = db.execute("SELECT hash FROM images WHERE path = ?", (path,)).fetchone()
+        except sqlite3.Error as e:
+            log.warning(f"library index: {e}")
+            return None
+        return toUnsigned(row[0]) if row is not None else None
+
+    def duplicates(self, path: str, max_distance: int = DUPLICATE_DISTANCE) -> list[tuple[str, int]]:
+        # [(path, differing bits)] of the other images looking the same, closest first
+        image_hash = self.imageHash(path)
+        if image_hash is None:
+            return []
+        return [(p, d) for p, d in self.similar(image_hash, max_distance) if p != path]
+
+    def similar(self, image_hash: int, max_distance: int = SIMILAR_DISTANCE) -> list[tuple[str, int]]:
+        # [(path, differing bits)] of the images within max_distance, closest first
+        paths, hashes = self._loadHashes()
+        if len(paths) == 0:
+            return []
+        distances = hammingDistances(hashes, image_hash)
+        found = np.flatnonzero(distances <= max_distance)
+        found = found[np.argsort(distances[found], kind="stable")]
+        return [(paths[i], int(distances[i])) for i in found]
+
+    def duplicateGroups(self, max_distance: int = DUPLICATE_DISTANCE) -> list[list[str]]:
+        # images looking the same, in groups of 2 or more
+        paths, hashes = self._loadHashes()
+        grouped = np.zeros(len(paths), bool)
+        groups = []
+        for i in range(len(paths)):
+            if grouped[i]:
+                continue
+            same = np.flatnonzero((hammingDistances(hashes, int(hashes[i])) <= max_distance) & ~grouped)
+            if len(same) > 1:
+                grouped[same] = True
+                groups.append([paths[j] for j in same])
+        return groups
+
+    def boardsOf(self, path: str) -> list[str]:
+        with self._connect() as db:
+            rows = db.execute("SELECT board FROM board_images WHERE image = ?", (path,)).fetchall()
+        return sorted(board for (board,) in rows)
+
+    def stats(self) -> dict[str, int | str]:
+        with self._connect() as db:
+            boards = db.execute("SELECT COUNT(*) FROM boards").fetchone()[0]
+            images = db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        return {"path": self._path.as_posix(), "boards": boards, "images": images}
+
+    @staticmethod
+    def sameContent(path: str, other_path: str) -> bool:
+        # byte by byte identical files
+        try:
+            if os.path.getsize(path) != os.path.getsize(other_path):
+                return False
+            digests = []
+            for p in [path, other_path]:
+                with open(p, "rb") as f:
+                    digests.append(hashlib.file_digest(f, "sha256").digest())
+        except OSError:
+            return False
+        return digests[0] == digests[1]
+
+    def _connect(self) -> sqlite3.Connection:
+        # one connection per use: the index is used from more threads
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(self._path, timeout=30)
+        if not self._schema_ready:
+            db.executescript(self.SCHEMA)
+            self._schema_ready = True
+        return db
+
+    def _loadHashes(self) -> tuple[list[str], np.ndarray]:
+        with self._connect() as db:
+            # changed by any connection (this process or another one)
+            version = db.execute("SELECT images FROM version").fetchone()[0]
+            with self._lock:
+                if version == self._loaded_version:
+                    return self._paths, self._hashes
+            rows = db.execute("SELECT path, hash FROM images").fetchall()
+        paths = [path for path, h in rows]
+        hashes = np.array([toUnsigned(h) for path, h in rows], np.uint64)
+        with self._lock:
+            self._loaded_version = version
+            self._paths = paths
+            self._hashes = hashes
+        return paths, hashes
+
+
+# Looks for the images of the library like an image added to a board. Called
+# by the workers checking the images to import (see ImageImporter), before
+# the image is handed to the GUI thread: the image is decoded (small) there,
+# not behind the boards being indexed. A byte identical copy is aliased in
+# the ImageCache to the original before its own decode is queued, sharing
+# its pixels.
+class DuplicateFinder(QObject):
+    # (path, {path of an image like it: [boards using it]})
+    found: typing.ClassVar[pyqtSignal] = pyqtSignal(str, object)
+
+    def __init__(self, library: LibraryIndex) -> None:
+        super().__init__()
+        self._library = library
+
+    def find(self, path: str) -> None:
+        try:
+            duplicates = self._library.duplicates(path)
+            if not duplicates:
+                return
+            for other_path, distance in duplicates:
+                if distance == 0 and LibraryIndex.sameContent(path, other_path):
+                    key = ImageCache.fileKey(path)
+                    same_as = ImageCache.fileKey(other_path)
+                    if key is not None and same_as is not None:
+                        ImageCache.instance().addAlias(key, same_as)
+                    break
+            boards = {other_path: self._library.boardsOf(other_path) for other_path, d in duplicates}
+        except sqlite3.Error as e:
+            log.warning(f"library index: {e}")
+            return
+        self.found.emit(path, boards)
+
+
+"""
+Unit Tests
+"""
+import shutil
+
+from PyQt5.QtGui import QPainter, QColor
+from PyQt5.QtCore import QCoreApplication
+from ImagePyramid import ImagePyramid
+
+test_data = {
+    "directory": pathlib.Path("./test_library"),
+}
+
+
+def makePicture(seed: int, w: int = 400, h: int = 300) -> QImage:
+    # random blocks: pictures of different seeds have nothing in common
+    rng = np.random.default_rng(seed)
+    image = QImage(w, h, QImage.Format_RGB32)
+    painter = QPainter(image)
+    for y in range(0, h, 50):
+        for x in range(0, w, 50):
+            painter.fillRect(x, y, 50, 50, QColor(*[int(c) for c in rng.integers(0, 256, 3)]))
+    painter.end()
+    return image
+
+
+def writeBoard(board_path: pathlib.Path, image_paths: list[pathlib.Path]) -> None:
+    images = {p.stem: {"path": p.absolute().as_posix()} for p in image_paths}
+    with open(board_path, "w", encoding="utf-8") as f:
+        json.dump({"board_name": board_path.stem, "reference_images": images}, f)
+
+
+@TestFunction
+def libraryIndex_hashes():
+    try:
+        pictures = [makePicture(seed) for seed in range(3)]
+        samples = np.stack([hashSample(p) for p in pictures])
+        hashes = perceptualHashes(samples)
+        assert hashes.dtype == np.uint64 and len(hashes) == 3, "wrong hashes"
+        # resized and recompressed: a few bits apart
+        resized = pictures[0].scaled(200, 150, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        resized_hash = int(perceptualHashes(hashSample(resized)[None])[0])
+        distances = hammingDistances(hashes, resized_hash)
+        assert distances[0] <= LibraryIndex.DUPLICATE_DISTANCE, f"resized apart {distances}"
+        assert min(distances[1:]) > LibraryIndex.SIMILAR_DISTANCE, f"different alike {distances}"
+        assert toUnsigned(toSigned(int(hashes[0]))) == int(hashes[0]), "hash not stored as is"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def libraryIndex_boards():
+    directory = test_data["directory"]
+    directory.mkdir(exist_ok=True)
+    index = LibraryIndex(directory / "library.sqlite")
+    try:
+        a = directory / "a.png"
+        copy = directory / "copy_of_a.png"
+        smaller = directory / "a_small.jpg"
+        b = directory / "b.png"
+        makePicture(0).save(a.as_posix())
+        shutil.copy(a, copy)
+        makePicture(0).scaled(200, 150).save(smaller.as_posix(), None, 80)
+        makePicture(1).save(b.as_posix())
+        writeBoard(directory / "one.refboard", [a, b])
+        writeBoard(directory / "two.refboard", [copy, smaller])
+
+        boards = [directory / "one.refboard", directory / "two.refboard"]
+        assert index.updateBoards(boards) == 4, "images not hashed"
+        assert index.updateBoards(boards) == 0, "unchanged boards indexed again"
+        assert index.stats()["images"] == 4, f"wrong stats {index.stats()}"
+
+        found = dict(index.duplicates(a.absolute().as_posix()))
+        expected = {copy.absolute().as_posix(), smaller.absolute().as_posix()}
+        assert set(found) == expected, f"wrong duplicates {found}"
+        assert found[copy.absolute().as_posix()] == 0, "copy not identical"
+        assert index.boardsOf(b.absolute().as_posix()) == [(directory / "one.refboard").absolute().as_posix()]
+        assert len(index.duplicateGroups()) == 1, "wrong duplicate groups"
+        assert LibraryIndex.sameContent(a.as_posix(), copy.as_posix()), "copy not the same file"
+        assert not LibraryIndex.sameContent(a.as_posix(), smaller.as_posix()), "resized same file"
+
+        # changed image: hashed again
+        makePicture(2).save(b.as_posix())
+        os.utime(directory / "one.refboard", ns=(1, 1))
+        assert index.updateBoards(boards) == 1, "changed image not hashed again"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@TestFunction
+def libraryIndex_duplicate_finder():
+    directory = test_data["directory"]
+    directory.mkdir(exist_ok=True)
+    index = LibraryIndex(directory / "library.sqlite")
+    finder = DuplicateFinder(index)
+    found = []
+    finder.found.connect(lambda path, boards: found.append((path, boards)))
+    try:
+        a = directory / "a.png"
+        copy = directory / "copy_of_a.png"
+        makePicture(0).save(a.as_posix())
+        shutil.copy(a, copy)
+        writeBoard(directory / "one.refboard", [a])
+        index.updateBoards([directory / "one.refboard"])
+
+        finder.find(copy.absolute().as_posix())
+        QCoreApplication.processEvents()
+        assert len(found) == 1, "duplicate not notified"
+        assert found[0][1] == {
+            a.absolute().as_posix(): [(directory / "one.refboard").absolute().as_posix()]
+        }, f"wrong duplicates {found[0][1]}"
+        key = ImageCache.fileKey(copy.as_posix())
+        original = ImageCache.instance().getOrDecode(
+            ImageCache.fileKey(a.as_posix()), lambda: ImagePyramid(QImage(a.as_posix()))
+        )
+        assert ImageCache.instance().lookup(key) is original, "copy doesn't share the original"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    app = QCoreApplication([])
+    test_list = [
+        libraryIndex_hashes,
+        libraryIndex_boards,
+        libraryIndex_duplicate_finder,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
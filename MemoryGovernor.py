@@ -0,0 +1,230 @@
+from PyQt5.QtCore import QObject, QTimer
+
+from ImageCache import *
+from ReferenceImageView import heldMemory
+from TiledImage import TileMemory
+from Instrumentation import *
+from UnitTesting import *
+
+
+# Process wide budget of the memory held by the images of all the open
+# boards, owned by CuteLook: the decoded images and the pixmaps shown by the
+# board views, plus the decoded images the cache keeps for later.
+# Each board view is registered with its id and its images are accounted to
+# it; once the board is closed they are released (and dropped from the cache
+# unless another board shows them).
+# Over budget, memory is freed starting from the least recently viewed images:
+# first the decoded images no board uses, then the pyramid levels bigger than
+# the views need, then the images are replaced by thumbnails (but those of
+# the board viewed last). Degraded images are decoded again when viewed.
+class MemoryGovernor(QObject):
+    # the budget is enforced once loads and zooms in a row are over
+    CHECK_DELAY_MS: int = 250
+    READOUT_INTERVAL_MS: int = 1000
+
+    def __init__(self, budget_bytes: int = 0, parent: QObject = None) -> None:
+        # budget_bytes 0: no limit, memory is only accounted
+        super().__init__(parent)
+        self._budget = budget_bytes
+        self._boards: dict[int, "ReferenceBoardView"] = {}
+        self._check_timer = QTimer(self)
+        self._check_timer.setSingleShot(True)
+        self._check_timer.setInterval(self.CHECK_DELAY_MS)
+        self._check_timer.timeout.connect(self.enforce)
+        self._readout_timer = QTimer(self)
+        self._readout_timer.setInterval(self.READOUT_INTERVAL_MS)
+        self._readout_timer.timeout.connect(self.refreshReadout)
+
+    def setBudget(self, budget_bytes: int) -> None:
+        self._budget = budget_bytes
+        self.schedule()
+
+    def budget(self) -> int:
+        return self._budget
+
+    def addBoard(self, board_id: int, view: "ReferenceBoardView") -> None:
+        self._boards[board_id] = view
+        view.memory_changed.connect(self.schedule)
+        self._readout_timer.start()
+
+    def removeBoard(self, board_id: int) -> None:
+        # the board is closed: nothing of it is kept
+        view = self._boards.pop(board_id)
+        view.memory_changed.disconnect(self.schedule)
+        view.releaseImages()
+        if not self._boards:
+            self._readout_timer.stop()
+
+    def boardMemory(self, board_id: int) -> dict[str, int]:
+        # {image name: decoded and pixmap bytes} of a board
+        return {
+            name: sum(heldMemory([image]))
+            for name, image in self._boards[board_id].openedImages().items()
+        }
+
+    def boardBytes(self, board_id: int) -> int:
+        return sum(heldMemory(self._boards[board_id].openedImages().values()))
+
+    def totalBytes(self) -> int:
+        decoded, pixmaps = heldMemory(self._images())
+        # the tiles in memory are bounded by the screens area on their own
+        tiles = TileMemory.instance().byteCount()
+        return decoded + pixmaps + tiles + ImageCache.instance().stats()["unused_bytes"]
+
+    def schedule(self) -> None:
+        if self._budget > 0:
+            self._check_timer.start()
+
+    def enforce(self) -> int:
+        # bytes freed
+        if self._budget <= 0:
+            return 0
+        start = total = self.totalBytes()
+        if total <= self._budget:
+            return 0
+        with span("memory", f"{total / (1024 * 1024):.0f} MB"):
+            ImageCache.instance().clear()
+            total = self.totalBytes()
+            images = sorted(
+                (image for image in self._images() if image.pyramid() is not None),
+                key=lambda image: image.lastViewed(),
+            )
+            for image in images:
+                if total <= self._budget:
+                    break
+                held = sum(heldMemory([image]))
+                if image.reduceImage():
+                    total -= held - sum(heldMemory([image]))
+            # the images of the board viewed last stay as they are
+            last_board = self._lastViewedBoard()
+            for image in images:
+                if total <= self._budget:
+                    break
+                if image.pyramid() is not None and image not in last_board:
+                    held = sum(heldMemory([image]))
+                    image.unloadImage()
+                    total -= held - sum(heldMemory([image]))
+            # decoded images shared by more views are not freed by one of them
+            total = self.totalBytes()
+        log.info(
+            f"memory budget: {start / (1024 * 1024):.1f} -> {total / (1024 * 1024):.1f} MB"
+            f" (budget {self._budget / (1024 * 1024):.0f} MB)"
+        )
+        if total > self._budget:
+            log.warning("memory budget exceeded by the board in use")
+        self.refreshReadout()
+        return start - total
+
+    def refreshReadout(self) -> None:
+        total = self.totalBytes()
+        for board_id, view in self._boards.items():
+            view.showMemory(self.boardBytes(board_id), total, self._budget)
+
+    def _images(self) -> list:
+        return [image for view in self._boards.values() for image in view.openedImages().values()]
+
+    def _lastViewedBoard(self) -> list:
+        # images of the board with the image viewed last
+        boards = [list(view.openedImages().values()) for view in self._boards.values()]
+        boards = [images for images in boards if images]
+        if not boards:
+            return []
+        return max(boards, key=lambda images: max(image.lastViewed() for image in images))
+
+
+"""
+Unit Tests
+"""
+import os
+
+from PyQt5.QtGui import QImage
+from PyQt5.QtCore import QSize, QCoreApplication
+
+from ReferenceBoardView import *
+
+test_data = {
+    "image_file": "./test_memory_governor.png",
+}
+
+
+def showBoard(governor: MemoryGovernor, board_id: int, names: list[str]) -> ReferenceBoardView:
+    view = ReferenceBoardView(board_id, CuteLookSettings(preview_cache_mb=0))
+    governor.addBoard(board_id, view)
+    for name in names:
+        model = ReferenceImageModel(path=test_data["image_file"], view_size={"w": 100, "h": 100})
+        view.addImage(name, model)
+    while view.isLoading():
+        QCoreApplication.processEvents()
+    view.show()
+    return view
+
+
+@TestFunction
+def memoryGovernor_degrades_least_recently_viewed():
+    image = QImage(1600, 1600, QImage.Format_RGB32)
+    image.fill(0xFF406080)
+    image.save(test_data["image_file"])
+    governor = MemoryGovernor()
+    try:
+        old = showBoard(governor, 0, ["a", "b"])
+        for image_view in old.openedImages().values():
+            # the decoded images are not shared by the two boards
+            image_view.setImage(ImagePyramid(image.copy()))
+        new = showBoard(governor, 1, ["c"])
+        new.openedImages()["c"].setImage(ImagePyramid(image.copy()))
+        new.openedImages()["c"].markViewed()
+        before = governor.totalBytes()
+        assert governor.boardBytes(0) > governor.boardBytes(1), "wrong accounting per board"
+        assert set(governor.boardMemory(0).keys()) == {"a", "b"}, "wrong images of board"
+
+        # the biggest levels go first
+        governor.setBudget(before // 2)
+        freed = governor.enforce()
+        assert freed > 0 and governor.totalBytes() <= before // 2, "budget not enforced"
+        assert all(not i.isUnloaded() for i in old.openedImages().values()), "unloaded too soon"
+
+        # then thumbnails, never for the board viewed last
+        governor.setBudget(1)
+        governor.enforce()
+        assert all(i.isUnloaded() for i in old.openedImages().values()), "old board not unloaded"
+        assert not new.openedImages()["c"].isUnloaded(), "board in use unloaded"
+
+        # viewed again: decoded again
+        reloads = []
+        old.openedImages()["a"].reload_needed.connect(lambda: reloads.append(True))
+        old.openedImages()["a"].markViewed()
+        assert reloads == [True], "viewed image not reloaded"
+
+        governor.removeBoard(1)
+        assert not new.openedImages()["c"].isLoaded(), "closed board not released"
+        governor.removeBoard(0)
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        os.remove(test_data["image_file"])
+
+
+@TestFunction
+def memoryGovernor_views_per_board():
+    try:
+        first = ReferenceBoardView(0)
+        second = ReferenceBoardView(1)
+        first.addImage("a", ReferenceImageModel(path="./missing.png"))
+        assert "a" not in second.openedImages(), "images shared by the boards"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    from PyQt5.QtWidgets import QApplication
+
+    app = QApplication([])
+    test_list = [
+        memoryGovernor_degrades_least_recently_viewed,
+        memoryGovernor_views_per_board,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
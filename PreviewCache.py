@@ -0,0 +1,279 @@
+import os
+import hashlib
+import pathlib
+import threading
+
+from PyQt5.QtGui import QImage, QImageReader
+from PyQt5.QtCore import QSize
+
+from ImagePyramid import *
+from ImageCache import ImageKey
+from Instrumentation import *
+from UnitTesting import *
+
+
+# Per user, on disk cache of the display resolution previews of the images.
+# A preview is named after the identity of its source file (path, mtime and
+# size): a modified source gets a new preview while the old one is pruned
+# sooner or later. The modification time of a preview is refreshed on every
+# use and the least recently used are removed once the size cap is exceeded.
+class PreviewCache:
+    DEFAULT_SIZE_MB: int = 512
+    # after pruning the cache is filled up to this fraction of the cap
+    PRUNE_RATIO: float = 0.8
+    SUFFIX: str = ".preview"
+
+    _instance: "PreviewCache" = None
+
+    def __init__(
+        self,
+        directory: pathlib.Path = None,
+        max_bytes: int = DEFAULT_SIZE_MB * 1024 * 1024,
+    ) -> None:
+        self._directory = directory if directory is not None else self.defaultDirectory()
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # computed on first use
+        self._bytes = None
+
+    @classmethod
+    def instance(cls) -> "PreviewCache":
+        if cls._instance is None:
+            cls._instance = PreviewCache()
+        return cls._instance
+
+    @classmethod
+    def setInstance(cls, cache: "PreviewCache") -> None:
+        cls._instance = cache
+
+    @staticmethod
+    def defaultDirectory() -> pathlib.Path:
+        cache_home = os.environ.get("XDG_CACHE_HOME", "")
+        if cache_home == "":
+            cache_home = pathlib.Path.home() / ".cache"
+        return pathlib.Path(cache_home) / "cutelook" / "previews"
+
+    def directory(self) -> pathlib.Path:
+        return self._directory
+
+    def isEnabled(self) -> bool:
+        return self._max_bytes > 0
+
+    def previewPath(self, key: ImageKey) -> pathlib.Path:
+        path, mtime, size = key
+        digest = hashlib.sha1(f"{path}\0{mtime}\0{size}".encode("utf-8")).hexdigest()
+        return self._directory / digest[:2] / f"{digest}{self.SUFFIX}"
+
+    def load(self, key: ImageKey, size: QSize) -> ImagePyramid | None:
+        if not self.isEnabled():
+            return None
+        preview_path = self.previewPath(key)
+        if not preview_path.is_file():
+            return None
+        reader = QImageReader(preview_path.as_posix())
+        source_size = self._parseSize(reader.text("source_size"))
+        # the preview has a single frame: whether the source has more is kept
+        # with it (stored before it was: decoded again)
+        animated = reader.text("animated")
+        if source_size is None or animated not in ["0", "1"]:
+            return None
+        # too small for the requested size: the source must be decoded
+        needed = fittedSize(source_size, size)
+        preview_size = reader.size()
+        if preview_size.width() < needed.width() or preview_size.height() < needed.height():
+            return None
+        image = reader.read()
+        if image.isNull():
+            return None
+        try:
+            os.utime(preview_path)
+        except OSError:
+            pass
+        pyramid = ImagePyramid(image, source_size=source_size)
+        pyramid.setAnimated(animated == "1")
+        return pyramid
+
+    def store(self, key: ImageKey, image: QImage, source_size: QSize, animated: bool = False) -> None:
+        if not self.isEnabled() or image.isNull():
+            return
+        preview_path = self.previewPath(key)
+        preview = QImage(image)
+        preview.setText("source_size", f"{source_size.width()}x{source_size.height()}")
+        preview.setText("animated", "1" if animated else "0")
+        # lossy compression is fine for a preview, not for transparency
+        image_format = "PNG" if preview.hasAlphaChannel() else "JPG"
+        tmp_path = preview_path.with_name(f"{preview_path.name}.{threading.get_ident()}")
+        try:
+            preview_path.parent.mkdir(parents=True, exist_ok=True)
+            if not preview.save(tmp_path.as_posix(), image_format, 90):
+                raise OSError(f"can't write {tmp_path}")
+            # a bigger preview replaces the one stored before
+            try:
+                replaced_bytes = preview_path.stat().st_size
+            except FileNotFoundError:
+                replaced_bytes = 0
+            os.replace(tmp_path, preview_path)
+            stored_bytes = preview_path.stat().st_size - replaced_bytes
+        except OSError as e:
+            log.warning(f"preview not cached: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return
+
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan()[1]
+            else:
+                self._bytes += stored_bytes
+            if self._bytes > self._max_bytes:
+                self._prune(int(self._max_bytes * self.PRUNE_RATIO))
+
+    def stats(self) -> dict[str, int | str]:
+        with self._lock:
+            previews, total_bytes = self._scan()
+            self._bytes = total_bytes
+        return {
+            "directory": self._directory.as_posix(),
+            "entries": len(previews),
+            "bytes": total_bytes,
+            "max_bytes": self._max_bytes,
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._prune(0)
+
+    def _scan(self) -> tuple[list[tuple[float, int, pathlib.Path]], int]:
+        previews = []
+        total_bytes = 0
+        if not self._directory.is_dir():
+            return previews, total_bytes
+        for preview_path in self._directory.glob(f"*/*{self.SUFFIX}"):
+            try:
+                stat = preview_path.stat()
+            except OSError:
+                continue
+            previews.append((stat.st_mtime, stat.st_size, preview_path))
+            total_bytes += stat.st_size
+        return previews, total_bytes
+
+    def _prune(self, max_bytes: int) -> None:
+        previews, total_bytes = self._scan()
+        # least recently used first
+        previews.sort(key=lambda p: p[0])
+        for mtime, size, preview_path in previews:
+            if total_bytes <= max_bytes:
+                break
+            try:
+                preview_path.unlink()
+                total_bytes -= size
+            except OSError:
+                pass
+        self._bytes = total_bytes
+
+    @staticmethod
+    def _parseSize(text: str) -> QSize | None:
+        try:
+            w, h = text.split("x")
+            return QSize(int(w), int(h))
+        except ValueError:
+            return None
+
+
+"""
+Unit Tests
+"""
+import shutil
+
+test_data = {
+    "cache_dir": pathlib.Path("./test_preview_cache"),
+}
+
+
+def makeImage(w: int, h: int) -> QImage:
+    image = QImage(w, h, QImage.Format_RGB32)
+    image.fill(0xFF336699)
+    return image
+
+
+@TestFunction
+def previewCache_store_load():
+    cache = PreviewCache(test_data["cache_dir"])
+    key = ("/images/a.png", 1, 2)
+    try:
+        assert cache.load(key, QSize(100, 100)) is None, "unexpected preview"
+        cache.store(key, makeImage(100, 50), QSize(1000, 500))
+        preview = cache.load(key, QSize(100, 100))
+        assert preview is not None, "preview not found"
+        assert preview.size() == QSize(100, 50), "wrong preview size"
+        assert preview.sourceSize() == QSize(1000, 500), "wrong source size"
+        assert not preview.isAnimated(), "still image reported animated"
+        animated_key = ("/images/a.gif", 1, 2)
+        cache.store(animated_key, makeImage(100, 50), QSize(1000, 500), animated=True)
+        assert cache.load(animated_key, QSize(100, 100)).isAnimated(), "animation not kept"
+        assert cache.load(key, QSize(400, 400)) is None, "preview too small"
+        assert cache.load(("/images/a.png", 3, 2), QSize(100, 100)) is None, (
+            "modified source should miss"
+        )
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        shutil.rmtree(test_data["cache_dir"], ignore_errors=True)
+
+
+@TestFunction
+def previewCache_replace_bytes():
+    cache = PreviewCache(test_data["cache_dir"])
+    key = ("/images/a.png", 1, 2)
+    try:
+        cache.store(("/images/b.png", 1, 2), makeImage(64, 64), QSize(1000, 1000))
+        for side in [64, 128, 256]:
+            cache.store(key, makeImage(side, side), QSize(1000, 1000))
+        counted = cache._bytes
+        assert counted == cache.stats()["bytes"], f"{counted} bytes counted, {cache._bytes} stored"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        shutil.rmtree(test_data["cache_dir"], ignore_errors=True)
+
+
+@TestFunction
+def previewCache_prune_lru():
+    cache = PreviewCache(test_data["cache_dir"])
+    try:
+        for i in range(4):
+            cache.store((f"/images/{i}.png", 1, 1), makeImage(64, 64), QSize(640, 640))
+            # distinct modification times
+            os.utime(cache.previewPath((f"/images/{i}.png", 1, 1)), (i, i))
+        # use the oldest one
+        cache.load(("/images/0.png", 1, 1), QSize(64, 64))
+        one_preview = cache.stats()["bytes"] // 4
+        cache._max_bytes = one_preview * 3
+        cache.store(("/images/4.png", 1, 1), makeImage(64, 64), QSize(640, 640))
+        stats = cache.stats()
+        assert stats["bytes"] <= cache._max_bytes, "cache over its cap"
+        assert cache.previewPath(("/images/0.png", 1, 1)).exists(), (
+            "recently used preview pruned"
+        )
+        assert not cache.previewPath(("/images/1.png", 1, 1)).exists(), (
+            "least recently used preview not pruned"
+        )
+        cache.clear()
+        assert cache.stats()["entries"] == 0, "cache not cleared"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        shutil.rmtree(test_data["cache_dir"], ignore_errors=True)
+
+
+if __name__ == "__main__":
+    test_list = [
+        previewCache_store_load,
+        previewCache_replace_bytes,
+        previewCache_prune_lru,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
@@ -1,42 +1,120 @@
 import json
+import typing
 import pathlib
 
+from PyQt5.QtCore import QTimer, QPoint, QSize
+
 from UnitTesting import *
 
 from ReferenceBoardModels import *
 from ReferenceBoardView import *
+from BoardWriter import *
+from BoardJournal import *
+from BoardReader import *
+from ImageLocator import *
+from ImageImporter import *
+from Instrumentation import *
 
 
 # Reference Board controller
 class ReferenceBoard:
+    # images added to the view at each step of the loading
+    LOAD_BATCH: int = 64
+    # offset between imported images and number of images in a cascade
+    IMPORT_OFFSET: int = 24
+    IMPORT_CASCADE: int = 16
+
     _reference_board: ReferenceBoardModel = None
     _board_window: ReferenceBoardView = None
 
     _board_path: pathlib.Path = "./unknown.refboard"
     _modified: bool = False
+    _journal: BoardJournal = None
 
     def __init__(
-        self, board_id: int, model: ReferenceBoardModel, view: ReferenceBoardView
+        self,
+        board_id: int,
+        model: ReferenceBoardModel,
+        view: ReferenceBoardView,
+        writer: BoardWriter = None,
+        pack: BoardPack = None,
+        report: BoardLoadReport = None,
     ) -> None:
         self._board_id = board_id
         self._reference_board = model
         self._board_window = view
+        self._board_writer = writer if writer is not None else BoardWriter()
+        # packed board the images are read from
+        self._pack = pack
+        # image entries read from the board file are validated when loaded
+        self._load_report = report if report is not None else BoardLoadReport()
+        self._unvalidated: set[str] = set(model.reference_images.keys())
+        self._images_to_load: list[str] = []
+        # images whose file was not found {name: path}
+        self._missing_images: dict[str, str] = {}
+        # next suffix to try for each image name stem (see _uniqueImageName)
+        self._name_counters: dict[str, int] = {}
+        self._importer: ImageImporter = None
+        self._imported = 0
+        self._relink_search: RelinkSearch = None
+        # images added are looked up in the library in background
+        self._duplicate_finder = None
+        self._closed = False
+        self._board_writer.board_saved.connect(self._onBoardSaved)
+        self._board_writer.save_failed.connect(self._onSaveFailed)
+        # journal records saved by each pending save
+        self._pending_checkpoints: list[int] = []
         self._board_window.setWindowTitle(model.board_name)
         # self._board_window.installEventFilter()
 
-        self._board_window.add_image.connect(self.addNewImage)
         self._board_window.close_image.connect(self.deleteImage)
+        self._board_window.image_changed.connect(self.imageChanged)
         self._board_window.save_board.connect(self.save)
+        self._board_window.relink_images.connect(self.relinkImages)
+        self._board_window.import_images.connect(self.importImages)
+        self._board_window.import_cancelled.connect(self.cancelImport)
 
-        self.loadRefImages()
-
+        # the window shows up before the images are added
         self._board_window.show()
+        self.loadRefImages()
 
     def view(self) -> ReferenceBoardView:
         return self._board_window
 
-    def setBoardPath(self, path: pathlib.Path) -> None:
+    def boardId(self) -> int:
+        return self._board_id
+
+    def isSaving(self) -> bool:
+        return bool(self._pending_checkpoints)
+
+    def isLoading(self) -> bool:
+        # images still to be added to the view, or being decoded
+        return bool(self._images_to_load) or self._board_window.isLoading()
+
+    def setBoardPath(self, path: pathlib.Path, journal: BoardJournal = None) -> None:
+        if self._journal is not None:
+            # saved somewhere else: changes are not pending for the old board
+            self._journal.truncate()
         self._board_path = path
+        self._journal = journal
+        if journal is None and path != pathlib.Path("") and BoardJournal.compact_records:
+            self._journal = BoardJournal(path)
+
+    def _record(self, change: typing.Callable[[BoardJournal], None]) -> None:
+        if self._journal is None:
+            return
+        try:
+            change(self._journal)
+        except OSError as e:
+            log.warning(f"journal not written: {e}")
+            return
+        if self._journal.records() >= BoardJournal.compact_records:
+            self.compact()
+
+    def compact(self) -> None:
+        # write the journal into the board
+        log.info(f"compacting journal: {self._journal.path()}")
+        self._writeBoard(self._board_path)
 
     def updateModifiedStatus(self, modified: bool) -> None:
         title = self._reference_board.board_name
@@ -46,28 +124,45 @@ class ReferenceBoard:
         self._board_window.setWindowTitle(title)
 
     def save(self, change_name: bool = False) -> None:
-        print(f"saving board: {self._reference_board.board_name}")
-        print(f"...to: {self._board_path}")
-
         save_to = self._board_path
         if save_to == pathlib.Path("") or change_name:
             save_to = pathlib.Path(self._board_window.openSaveDialog())
-            print(f"(now) saving to: {save_to}")
             if save_to == pathlib.Path(""):
                 # abort
                 return
             else:
-                self._board_path = save_to
+                self.setBoardPath(save_to)
                 self._modified = True
 
-        # throw if error/fails
         if self._modified:
-            # Exceptions will be farwarded to the caller
-            print(f"...to: {self._board_path}")
-            with open(save_to, "w", encoding="utf-8") as f:
-                json_output = self._reference_board.model_dump_json(indent=4)
-                f.write(json_output)
-            self.updateModifiedStatus(False)
+            log.info(f'saving board "{self._reference_board.board_name}" to: {save_to}')
+            self._writeBoard(save_to)
+
+    def _writeBoard(self, path: pathlib.Path) -> None:
+        # written in background: see _onBoardSaved and _onSaveFailed
+        for image_name in list(self._unvalidated):
+            self._validImage(image_name)
+        checkpoint = self._journal.records() if self._journal is not None else 0
+        self._pending_checkpoints.append(checkpoint)
+        self._board_writer.save(self._reference_board, path)
+        self.updateModifiedStatus(False)
+
+    def _onBoardSaved(self, path: str, written: bool) -> None:
+        checkpoint = self._pending_checkpoints.pop(0)
+        if self._journal is not None:
+            self._journal.truncate(checkpoint)
+            self._pending_checkpoints = [c - checkpoint for c in self._pending_checkpoints]
+        if written:
+            self._indexBoard(pathlib.Path(path))
+
+    def _onSaveFailed(self, path: str, error: str) -> None:
+        self._pending_checkpoints.pop(0)
+        if self._closed:
+            # the view is gone (the journal, if any, still has the changes)
+            log.error(f"board not saved to {path}: {error}")
+            return
+        self.updateModifiedStatus(True)
+        self._board_window.showSaveError(path, error)
 
     # need unit test
     # def saveAs(self, new_path: pathlib.Path) -> None:
@@ -78,70 +173,230 @@ class ReferenceBoard:
 
     # need unit test
     def close(self) -> bool:
-        print("ReferenceBoard - closeBoard")
+        discarded = False
         if self._modified:
             reply = self._board_window.confirmClose()
-            print(f"reply: {reply}")
             self._modified = not reply
+            discarded = reply
 
-        print(f"_modified: {self._modified}")
         close_ok = not self._modified
         if close_ok:
-            print("call close")
+            log.info(f'closing board "{self._reference_board.board_name}"')
+            self._closed = True
+            self.cancelImport()
+            if self._journal is not None:
+                if discarded:
+                    self._journal.truncate()
+                self._journal.close()
+            self._board_window.releaseImages()
+            self._board_window.hideInstrumentationOverlay()
+            if self._pack is not None:
+                self._pack.close()
             # self._board_window.close()  # may be a loop here
             self._board_window.deleteLater()
 
         return close_ok
 
     def loadRefImages(self) -> None:
-        for image_name, image_model in self._reference_board.reference_images.items():
-            # assert image_name not in self._reference_board.reference_images.keys()
-            path = pathlib.Path(image_model.path)
-            if path.exists() and path.is_file():
+        # a batch at a time: the board shows up and responds while thousands of
+        # images are still being loaded
+        self._images_to_load = list(self._reference_board.reference_images.keys())
+        QTimer.singleShot(0, self._loadNextImages)
+
+    def _loadNextImages(self) -> None:
+        if self._closed:
+            return
+        batch = self._images_to_load[: self.LOAD_BATCH]
+        del self._images_to_load[: self.LOAD_BATCH]
+        images = {}
+        for image_name in batch:
+            image_model = self._validImage(image_name)
+            # None: broken entry, or deleted meanwhile
+            if image_model is not None:
+                images[image_name] = image_model
+        # the files of a batch are checked all together
+        paths = [image_model.path for image_model in images.values()]
+        for (image_name, image_model), exists in zip(
+            images.items(), ImageLocator.imagesExist(paths)
+        ):
+            if exists:
                 # create view
                 self._board_window.addImage(image_name, image_model)
             else:
-                # show warning
-                self._board_window.showMissingImageWarning(image_name, image_model.path)
-
-    # need unit test
-    def addNewImage(self, image_path: pathlib.Path) -> None:
-        # check file path
-        if not (image_path.exists() and image_path.is_file()):
-            print(f"ERROR: invalid path: {pathlib.Path}")
-            raise Exception("invalid path")
-        print(f'adding image "{image_path}"')
-
+                self._missing_images[image_name] = image_model.path
+        if self._images_to_load:
+            QTimer.singleShot(0, self._loadNextImages)
+            return
+        # a single summary of the problems, once the loading is done
+        if not self._load_report.isEmpty():
+            self._board_window.showLoadReport(self._load_report)
+        if self._missing_images:
+            self._board_window.showMissingImages(self._missing_images)
+        # once its images are loaded: indexing decodes them too
+        self._indexBoard(self._board_path)
+
+    # look for the missing images under root_dir (in background)
+    def relinkImages(self, root_dir: str, hash_content: bool = False) -> None:
+        if self._relink_search is not None and self._relink_search.isRunning():
+            log.warning("relink already running")
+            return
+        images = self._reference_board.reference_images
+        # deleted or renamed meanwhile
+        missing = {n: p for n, p in self._missing_images.items() if n in images}
+        self._relink_search = RelinkSearch()
+        self._relink_search.finished.connect(self._onRelinkFinished)
+        self._relink_search.start(pathlib.Path(root_dir), missing, hash_content)
+
+    def _onRelinkFinished(self, found: dict[str, str], files: int) -> None:
+        log.info(f"relink: {files} files indexed")
+        if self._closed:
+            return
+        images = self._reference_board.reference_images
+        # deleted or renamed while searching
+        missing = {n: p for n, p in self._missing_images.items() if n in images}
+        found = {n: p for n, p in found.items() if n in missing}
+        for image_name, path in found.items():
+            log.info(f'relink: "{image_name}" found in {path}')
+            image_model = images[image_name]
+            image_model.path = path
+            self._board_window.addImage(image_name, image_model)
+            self._record(lambda journal: journal.setImage(image_name, image_model))
+        self._missing_images = {n: p for n, p in missing.items() if n not in found}
+        if found:
+            self.updateModifiedStatus(True)
+        self._board_window.showRelinkResult(len(found), self._missing_images)
+
+    def _validImage(self, image_name: str) -> ReferenceImageModel | None:
+        images = self._reference_board.reference_images
+        if image_name not in self._unvalidated:
+            return images.get(image_name)
+        self._unvalidated.discard(image_name)
+        if image_name not in images:
+            # renamed or deleted before being loaded
+            return None
+        try:
+            image_model = images[image_name] = validateImage(images[image_name])
+        except ValidationError as e:
+            # dropped from the board
+            del images[image_name]
+            self._load_report.add(image_name, validationError(e))
+            self.updateModifiedStatus(True)
+            return None
+        return image_model
+
+    def _duplicatesCheck(self) -> typing.Callable[[pathlib.Path], None] | None:
+        # the images imported already in the library (see LibraryIndex), None:
+        # library index disabled
+        from LibraryIndex import LibraryIndex, DuplicateFinder
+
+        library = LibraryIndex.instance()
+        if not library.isEnabled():
+            return None
+        if self._duplicate_finder is None:
+            self._duplicate_finder = DuplicateFinder(library)
+            self._duplicate_finder.found.connect(self._onDuplicatesFound)
+        finder = self._duplicate_finder
+        return lambda image_path: finder.find(image_path.absolute().as_posix())
+
+    def _onDuplicatesFound(self, path: str, duplicates: dict[str, list[str]]) -> None:
+        log.warning(f'"{path}" looks like: {", ".join(duplicates)}')
+        if not self._closed:
+            self._board_window.showDuplicateImages(path, duplicates)
+
+    def _indexBoard(self, path: pathlib.Path) -> None:
+        # the boards opened and saved are known to the library index
+        from LibraryIndex import LibraryIndex
+
+        if path != pathlib.Path(""):
+            LibraryIndex.instance().scheduleUpdate([path])
+
+    def _addImage(
+        self, image_path: pathlib.Path, image_size: QSize, position: QPoint = None
+    ) -> str:
         # get a valid image name
-        image_name = image_path.stem
-        i = 1
-        while image_name in self._reference_board.reference_images.keys():
-            image_name = f"{image_name}-{i}"
-            i += 1
+        image_name = self._uniqueImageName(image_path.stem)
 
         # create the image model and initialize it
         image_model = ReferenceImageModel()
         image_model.path = image_path.absolute().as_posix()
+        if image_size.isValid():
+            image_model.view_size = {"w": image_size.width(), "h": image_size.height()}
+        if position is not None:
+            image_model.view_position = {"w": position.x(), "h": position.y()}
 
         # create the view
         self._board_window.addImage(image_name, image_model)
 
-        # add the image to the board and set it to modified
+        # add the image to the board
         self._reference_board.reference_images[image_name] = image_model
+        self._record(lambda journal: journal.addImage(image_name, image_model))
+        return image_name
+
+    def _uniqueImageName(self, stem: str) -> str:
+        # "stem", "stem-1", "stem-2"... the counter of a stem only moves
+        # forward: names are not searched again from the start for each image
+        images = self._reference_board.reference_images
+        i = self._name_counters.get(stem, 0)
+        image_name = stem if i == 0 else f"{stem}-{i}"
+        while image_name in images:
+            i += 1
+            image_name = f"{stem}-{i}"
+        self._name_counters[stem] = i + 1
+        return image_name
+
+    # add many images at once (image files and directories)
+    def importImages(self, paths: list[pathlib.Path], recursive: bool = False) -> None:
+        if self._importer is not None and self._importer.isRunning():
+            log.warning("import already running")
+            return
+        # checked before being added: a copy shares the pixels of the original
+        self._importer = ImageImporter(self._duplicatesCheck())
+        self._importer.images_ready.connect(self._onImagesImported)
+        self._importer.progress.connect(self._board_window.showImportProgress)
+        self._importer.finished.connect(self._onImportFinished)
+        self._imported = 0
+        self._importer.start(paths, recursive)
+
+    def cancelImport(self) -> None:
+        if self._importer is not None:
+            self._importer.cancel()
+
+    def _onImagesImported(self, images: list[tuple[pathlib.Path, QSize]]) -> None:
+        if self._closed:
+            return
+        for image_path, image_size in images:
+            # a cascade, not all the images one on top of the other
+            offset = self.IMPORT_OFFSET * (self._imported % self.IMPORT_CASCADE)
+            self._addImage(image_path, image_size, QPoint(offset, offset))
+            self._imported += 1
         self.updateModifiedStatus(True)
-        print(f'added image "{image_name}"')
+
+    def _onImportFinished(self, imported: int, failed: list, cancelled: bool) -> None:
+        log.info(f"imported {imported} images ({len(failed)} failed, cancelled: {cancelled})")
+        if not self._closed:
+            self._board_window.finishImport(imported, failed, cancelled)
 
     # need unit test
     def deleteImage(self, name: str) -> None:
         # exception shall be handled by caller
         del self._reference_board.reference_images[name]
         self.updateModifiedStatus(True)
+        self._record(lambda journal: journal.deleteImage(name))
+
+    # position, size or visibility of the image changed in the model
+    def imageChanged(self, name: str) -> None:
+        image_model = self._reference_board.reference_images.get(name)
+        if image_model is None:
+            return
+        self.updateModifiedStatus(True)
+        self._record(lambda journal: journal.setImage(name, image_model))
 
     # need unit test
-    def rename(new_name: str) -> None:
+    def rename(self, new_name: str) -> None:
         self._reference_board.board_name = new_name
         self._board_window.setWindowTitle(new_name)
         self.updateModifiedStatus(True)
+        self._record(lambda journal: journal.rename(new_name))
 
     def name(self) -> str:
         return self._reference_board.board_name
@@ -159,7 +414,14 @@ class ReferenceBoard:
         # do rename (exception shall be handled by caller)
         refImage = self._reference_board.reference_images.pop(old_name, None)
         self._reference_board.reference_images[new_name] = refImage
+        # not loaded yet: validated (and loaded) with its new name
+        if old_name in self._unvalidated:
+            self._unvalidated.discard(old_name)
+            self._unvalidated.add(new_name)
+        self._images_to_load = [new_name if n == old_name else n for n in self._images_to_load]
+        self._board_window.renameImage(old_name, new_name)
         self.updateModifiedStatus(True)
+        self._record(lambda journal: journal.renameImage(old_name, new_name))
 
     # need unit test
     def getImageModel(self, img_name: str) -> ReferenceImageModel:
@@ -243,11 +505,40 @@ def refBoard_default():
         raise TestFailedException()
 
 
+@TestFunction
+def refBoard_rename_before_load():
+    from PyQt5.QtWidgets import QApplication
+
+    app = QApplication.instance() or QApplication([])
+    path = pathlib.Path("./test_rename.refboard")
+    json_board = '{"board_name": "test", "reference_images": {"pippo": {"path": "./pippo.png", "zoom": "big"}}}'
+    report = BoardLoadReport()
+    writer = BoardWriter()
+    board = ReferenceBoard(0, parseBoard(json_board, report), ReferenceBoardView(0), writer, report=report)
+    try:
+        # renamed before its entry is validated (loaded)
+        board.renameImage("pippo", "pluto")
+        board._writeBoard(path)
+        writer._executor.submit(lambda: None).result()
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        assert saved["reference_images"] == {}, f"broken entry saved {saved['reference_images']}"
+        assert [name for name, error in report.errors] == ["pluto"], f"wrong report {report.errors}"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        board.close()
+        if path.exists():
+            os.remove(path)
+
+
 if __name__ == "__main__":
     test_list = [
         refBoard_from_json_ok,
         refBoard_from_file_ok,
         refBoard_default,
+        refBoard_rename_before_load,
     ]
 
     p, f = RunTest(test_list)
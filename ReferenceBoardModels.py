@@ -5,6 +5,24 @@ from pydantic import BaseModel, ValidationError
 from UnitTesting import *
 
 
+# Main colors of (a region of) an image, see AutoColorSwatch
+class ColorSwatchModel(BaseModel):
+    # normalized (0..1) region of the image
+    region: dict[str, float] = {"x": 0, "y": 0, "w": 1, "h": 1}
+    # "#rrggbb", most used first
+    colors: list[str] = []
+    # fraction of the region of each color
+    weights: list[float] = []
+
+
+# Detail of an image shown on its own, see ImageClip
+class ImageClipModel(BaseModel):
+    # normalized (0..1) region of the image
+    region: dict[str, float] = {"x": 0.25, "y": 0.25, "w": 0.5, "h": 0.5}
+    view_size: dict[str, float] = {"w": 256, "h": 256}
+    view_position: dict[str, float] = {"w": 0, "h": 0}
+
+
 # Reference Image model
 class ReferenceImageModel(BaseModel):
     path: str = ""
@@ -14,6 +32,8 @@ class ReferenceImageModel(BaseModel):
     view_size: dict[str, float] = {"w": 512, "h": 512}
     view_position: dict[str, float] = {"w": 0, "h": 0}
     view_hidden: bool = False
+    color_swatch: ColorSwatchModel | None = None
+    clips: list[ImageClipModel] = []
 
 
 # Reference Board model and serialization
@@ -29,7 +49,7 @@ test_data = {
     "json_refimage_1": '{"path": "./pippo.png", "zoom": "2"}',
     "json_refimage_2": '{"path": "./pluto.png", "zoom": "1", "image_center": {"x": 256.0, "y": 256.0}, "view_size": {"w": 512.0, "h": 512.0} }',
     "json_refimage_bad": '{"id": "123", "nome": "Alice"}',
-    "json_refimage_full": '{"path":"./pippo.png","z_order":-1,"zoom":2.0,"image_center":{"x":256.0,"y":256.0},"view_size":{"w":512.0,"h":512.0},"view_position":{"w":0.0,"h":0.0},"view_hidden":false}',
+    "json_refimage_full": '{"path":"./pippo.png","z_order":-1,"zoom":2.0,"image_center":{"x":256.0,"y":256.0},"view_size":{"w":512.0,"h":512.0},"view_position":{"w":0.0,"h":0.0},"view_hidden":false,"color_swatch":null,"clips":[]}',
 }
 
 
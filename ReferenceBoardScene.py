@@ -0,0 +1,423 @@
+import time
+import typing
+from PyQt5.QtWidgets import (
+    QGraphicsObject,
+    QGraphicsScene,
+    QGraphicsView,
+    QGraphicsItem,
+    QStyleOptionGraphicsItem,
+    QWidget,
+)
+from PyQt5.QtGui import QPixmap, QPainter, QColor, QPen, QBrush, QFont
+from PyQt5.QtCore import Qt, QRectF, QPointF, QSize, QTimer, pyqtSignal
+
+from ReferenceBoardModels import *
+from ReferenceImageView import savedViewSize, hasViewSize, initialViewSize
+from ImagePyramid import *
+from ImageCache import *
+from Instrumentation import *
+from UnitTesting import *
+
+
+# Scene item drawing a reference image: the alternative to FloatingImageWidget
+# used by the "scene" render mode. All the images of a board are painted by a
+# single QGraphicsView: only the visible ones are drawn, each item caches its
+# rendering and the control buttons are painted (and hit tested) only while
+# the pointer is over the image.
+class ReferenceImageItem(QGraphicsObject):
+    SMOOTH_ZOOM_DELAY_MS: int = 150
+    RELEASE_HIDDEN_DELAY_MS: int = 30000
+    THUMBNAIL_SIZE: int = 64
+    BUTTON_SIZE: int = 25
+    BUTTON_MARGIN: int = 5
+    SWATCH_HEIGHT: int = 16
+
+    _pyramid: ImagePyramid = None
+    _pixmap: QPixmap = None
+    _pixmap_size: QSize = None
+
+    _image_model: ReferenceImageModel = None
+    _image_name: str = ""
+
+    full_resolution_needed: typing.ClassVar[pyqtSignal] = pyqtSignal()
+    reload_needed: typing.ClassVar[pyqtSignal] = pyqtSignal()
+    image_changed: typing.ClassVar[pyqtSignal] = pyqtSignal(str)
+    close_image: typing.ClassVar[pyqtSignal] = pyqtSignal(str)
+    image_hidden: typing.ClassVar[pyqtSignal] = pyqtSignal()
+
+    def __init__(self, image_name: str, image_model: ReferenceImageModel) -> None:
+        super().__init__()
+        self._image_model = image_model
+        self._image_name = image_name
+        self._hovered = False
+        self._full_resolution_requested = False
+
+        self.setFlag(QGraphicsItem.ItemIsMovable)
+        self.setFlag(QGraphicsItem.ItemSendsGeometryChanges)
+        self.setAcceptHoverEvents(True)
+        # repainted only when the image (or the hover state) changes
+        self.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+
+        self._smooth_zoom_timer = QTimer(self)
+        self._smooth_zoom_timer.setSingleShot(True)
+        self._smooth_zoom_timer.setInterval(self.SMOOTH_ZOOM_DELAY_MS)
+        self._smooth_zoom_timer.timeout.connect(self._onZoomFinished)
+
+        self._thumbnail: QImage = None
+        self._unloaded = False
+        # see MemoryGovernor
+        self._last_viewed = time.monotonic()
+        self._release_timer = QTimer(self)
+        self._release_timer.setSingleShot(True)
+        self._release_timer.setInterval(self.RELEASE_HIDDEN_DELAY_MS)
+        self._release_timer.timeout.connect(self.unloadImage)
+
+        # placeholder as big as the last saved view
+        self._size = savedViewSize(image_model).expandedTo(QSize(50, 50))
+        self.setPos(image_model.view_position["w"], image_model.view_position["h"])
+
+    def setImage(self, pyramid: ImagePyramid) -> None:
+        self.releaseImage()
+        self._pyramid = pyramid
+        ImageCache.instance().acquire(pyramid)
+        self._full_resolution_requested = False
+        self._thumbnail = None
+        self._unloaded = False
+
+        if pyramid.isNull():
+            self._pixmap_size = None
+            self._resize(QSize(200, 100))
+            self.update()
+        else:
+            if self._pixmap_size is None:
+                self._pixmap_size = initialViewSize(self._image_model, pyramid.sourceSize())
+            self._updatePixmap()
+
+    def releaseImage(self, evict: bool = False) -> None:
+        if self._pyramid is not None:
+            ImageCache.instance().release(self._pyramid, evict)
+            self._pyramid = None
+            self._pixmap = None
+
+    def setReleaseHiddenDelay(self, delay_ms: int) -> None:
+        self._release_timer.setInterval(delay_ms)
+
+    def unloadImage(self) -> None:
+        # keep only a thumbnail: the image is decoded again when shown (or
+        # viewed, if unloaded while shown)
+        if self._pyramid is not None and not self._pyramid.isNull():
+            self._thumbnail = self._pyramid.thumbnail(self.THUMBNAIL_SIZE)
+        self.releaseImage(evict=True)
+        self._unloaded = True
+        self.update()
+
+    def isUnloaded(self) -> bool:
+        return self._unloaded
+
+    def reduceImage(self) -> bool:
+        # drop the levels bigger than the view needs; False: nothing to drop
+        if self._pyramid is None or self._pyramid.isNull() or not hasViewSize(self._image_model):
+            # shown at the natural size: the whole image is needed
+            return False
+        level = self._pyramid.levelFor(savedViewSize(self._image_model))
+        if level == 0:
+            return False
+        reduced = self._pyramid.reduced(level)
+        self.releaseImage(evict=True)
+        self.setImage(reduced)
+        return True
+
+    def markViewed(self) -> None:
+        self._last_viewed = time.monotonic()
+        if self._unloaded and self.isVisible():
+            self._unloaded = False
+            self.reload_needed.emit()
+
+    def lastViewed(self) -> float:
+        return self._last_viewed
+
+    def pyramid(self) -> ImagePyramid | None:
+        return self._pyramid
+
+    def imageModel(self) -> ReferenceImageModel:
+        return self._image_model
+
+    def isLoaded(self) -> bool:
+        return self._pyramid is not None
+
+    def imageName(self) -> str:
+        return self._image_name
+
+    def setImageName(self, image_name: str) -> None:
+        self._image_name = image_name
+
+    def pixmapBytes(self) -> int:
+        if self._pixmap is None or self._pixmap.isNull():
+            return 0
+        return self._pixmap.width() * self._pixmap.height() * self._pixmap.depth() // 8
+
+    def _updatePixmap(self, smooth: bool = True) -> None:
+        with span("scale", self._image_name):
+            self._pixmap = self._pyramid.scaled(self._pixmap_size, smooth)
+        self._resize(self._pixmap_size)
+        self.update()
+
+    def _resize(self, size: QSize) -> None:
+        if size != self._size:
+            self.prepareGeometryChange()
+            self._size = QSize(size)
+
+    def boundingRect(self) -> QRectF:
+        return QRectF(0, 0, self._size.width(), self._size.height())
+
+    def _buttonRects(self) -> tuple[QRectF, QRectF, QRectF]:
+        # close, hide, color swatch
+        size = self.BUTTON_SIZE
+        xc = self._size.width() - size - self.BUTTON_MARGIN
+        xh = xc - size - self.BUTTON_MARGIN
+        xs = xh - size - self.BUTTON_MARGIN
+        y = self.BUTTON_MARGIN
+        return (
+            QRectF(xc, y, size, size),
+            QRectF(xh, y, size, size),
+            QRectF(xs, y, size, size),
+        )
+
+    # main colors of the image: computed once, then saved with the board
+    def toggleColorSwatch(self) -> None:
+        if self._image_model.color_swatch is not None:
+            self._image_model.color_swatch = None
+        elif self._pyramid is not None and not self._pyramid.isNull():
+            # numpy is imported on first use, see ReferenceImageView
+            from AutoColorSwatch import AutoColorSwatch
+
+            self._image_model.color_swatch = AutoColorSwatch.instance().swatch(self._pyramid)
+        else:
+            return
+        self.update()
+        self.image_changed.emit(self._image_name)
+
+    def paint(
+        self, painter: QPainter, option: QStyleOptionGraphicsItem, widget: QWidget = None
+    ) -> None:
+        rect = self.boundingRect()
+        if self._pixmap is not None:
+            painter.drawPixmap(rect.toRect(), self._pixmap)
+        elif self._thumbnail is not None:
+            painter.drawImage(rect, self._thumbnail)
+        else:
+            painter.fillRect(rect, QColor("lightgray"))
+            if self._pyramid is not None:
+                painter.setPen(QColor("red"))
+                painter.drawText(rect, Qt.AlignCenter, "Errore caricamento immagine")
+            else:
+                painter.setPen(QColor("gray"))
+                painter.drawText(rect, Qt.AlignCenter, "...")
+
+        if self._image_model.color_swatch is not None:
+            from AutoColorSwatch import paintColorSwatch
+
+            margin = self.BUTTON_MARGIN
+            swatch_rect = QRectF(
+                margin,
+                rect.height() - self.SWATCH_HEIGHT - margin,
+                rect.width() - 2 * margin,
+                self.SWATCH_HEIGHT,
+            )
+            paintColorSwatch(painter, swatch_rect, self._image_model.color_swatch)
+
+        if self._hovered:
+            self._paintButtons(painter)
+
+    def _paintButtons(self, painter: QPainter) -> None:
+        # same look as FloatingControlButton
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(QPen(QColor("white"), 1))
+        painter.setBrush(QBrush(QColor(255, 0, 0, 150)))
+        font = QFont(painter.font())
+        font.setBold(True)
+        painter.setFont(font)
+        for rect, label in zip(self._buttonRects(), ["X", "-", "C"]):
+            painter.drawEllipse(rect)
+            painter.drawText(rect, Qt.AlignCenter, label)
+
+    def hoverEnterEvent(self, event):
+        self.markViewed()
+        self._hovered = True
+        self.update()
+        super().hoverEnterEvent(event)
+
+    def hoverLeaveEvent(self, event):
+        self._hovered = False
+        self.update()
+        super().hoverLeaveEvent(event)
+
+    def mousePressEvent(self, event):
+        close_rect, hide_rect, swatch_rect = self._buttonRects()
+        if event.button() == Qt.LeftButton and close_rect.contains(event.pos()):
+            self.close_image.emit(self._image_name)
+            event.accept()
+        elif event.button() == Qt.LeftButton and hide_rect.contains(event.pos()):
+            self.hide()
+            self.image_hidden.emit()
+            event.accept()
+        elif event.button() == Qt.LeftButton and swatch_rect.contains(event.pos()):
+            self.toggleColorSwatch()
+            event.accept()
+        else:
+            super().mousePressEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        super().mouseReleaseEvent(event)
+        # position is updated in the model while moving: notify once moved
+        if event.buttonDownScenePos(Qt.LeftButton) != event.scenePos():
+            self.image_changed.emit(self._image_name)
+
+    def itemChange(self, change, value):
+        if change == QGraphicsItem.ItemVisibleHasChanged:
+            if self._image_model.view_hidden == value:
+                self._image_model.view_hidden = not value
+                self.image_changed.emit(self._image_name)
+            if not value:
+                self._release_timer.start()
+            else:
+                self._release_timer.stop()
+                if self._unloaded:
+                    self._unloaded = False
+                    self.reload_needed.emit()
+        elif change == QGraphicsItem.ItemPositionHasChanged:
+            self._image_model.view_position["w"] = value.x()
+            self._image_model.view_position["h"] = value.y()
+        return super().itemChange(change, value)
+
+    def _onZoomFinished(self) -> None:
+        if self._pyramid is None or self._pyramid.isNull():
+            # released meanwhile (board closed)
+            return
+        self._updatePixmap()
+        # only the sizes set by the user are saved, not those of the loading
+        self._image_model.view_size = {"w": self._size.width(), "h": self._size.height()}
+        self.image_changed.emit(self._image_name)
+
+    def wheelEvent(self, event):
+        if self._pyramid is None or self._pyramid.isNull():
+            event.ignore()
+            return
+        zoom_factor = 1.1 if event.delta() > 0 else 1 / 1.1
+        self._pixmap_size = self._pixmap_size * zoom_factor
+        if not self._pyramid.covers(self._pixmap_size):
+            if not self._full_resolution_requested:
+                self._full_resolution_requested = True
+                self.full_resolution_needed.emit()
+
+        # fast scaling while the wheel is moving, smooth once it stops
+        self._updatePixmap(smooth=False)
+        self._smooth_zoom_timer.start()
+        event.accept()
+
+
+# Single canvas showing all the images of a board
+class ReferenceBoardCanvas(QGraphicsView):
+    def __init__(self, parent: QWidget = None) -> None:
+        super().__init__(parent)
+        scene = QGraphicsScene(self)
+        # default BSP index: painting and hit testing only visit visible items
+        scene.setItemIndexMethod(QGraphicsScene.BspTreeIndex)
+        self.setScene(scene)
+        self.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+        self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
+        self.setOptimizationFlags(
+            QGraphicsView.DontSavePainterState | QGraphicsView.DontAdjustForAntialiasing
+        )
+        self.setRenderHint(QPainter.SmoothPixmapTransform)
+        self.setBackgroundBrush(QColor(48, 48, 48))
+
+    def addImage(self, image_item: ReferenceImageItem) -> None:
+        self.scene().addItem(image_item)
+
+    def removeImage(self, image_item: ReferenceImageItem) -> None:
+        self.scene().removeItem(image_item)
+
+
+"""
+Unit Tests
+"""
+
+
+def makePyramid(w: int, h: int) -> ImagePyramid:
+    image = QImage(w, h, QImage.Format_RGB32)
+    image.fill(0xFF204060)
+    return ImagePyramid(image)
+
+
+@TestFunction
+def imageItem_placeholder_and_load():
+    model = ReferenceImageModel(view_size={"w": 300, "h": 300})
+    item = ReferenceImageItem("test", model)
+    try:
+        assert item.boundingRect().width() == 300, "placeholder not sized from model"
+        item.setImage(makePyramid(600, 300))
+        assert item.isLoaded(), "image not loaded"
+        assert item.boundingRect().size().toSize() == QSize(300, 150), (
+            f"wrong size {item.boundingRect()}"
+        )
+        assert model.view_size == {"w": 300, "h": 300}, "view size rewritten on load"
+        # zoomed with the wheel
+        item._pixmap_size = QSize(200, 100)
+        item._onZoomFinished()
+        assert model.view_size == {"w": 200, "h": 100}, "model view size not updated"
+        item.releaseImage()
+        assert not item.isLoaded(), "image not released"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imageItem_release_hidden():
+    model = ReferenceImageModel(view_size={"w": 300, "h": 300})
+    item = ReferenceImageItem("test", model)
+    reloads = []
+    item.reload_needed.connect(lambda: reloads.append(True))
+    item.setImage(makePyramid(600, 600))
+    try:
+        item.hide()
+        assert model.view_hidden, "hidden state not saved"
+        item.unloadImage()
+        assert not item.isLoaded() and item._thumbnail is not None, "not unloaded"
+        item.show()
+        assert len(reloads) == 1 and not model.view_hidden, "reload not requested"
+        item.setImage(makePyramid(600, 600))
+        assert item._thumbnail is None, "thumbnail kept after reload"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def imageItem_position_in_model():
+    model = ReferenceImageModel(view_position={"w": 10, "h": 20})
+    canvas = ReferenceBoardCanvas()
+    item = ReferenceImageItem("test", model)
+    canvas.addImage(item)
+    try:
+        assert item.pos() == QPointF(10, 20), "position not read from model"
+        item.setPos(30, 40)
+        assert model.view_position == {"w": 30, "h": 40}, "position not saved"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+if __name__ == "__main__":
+    from PyQt5.QtWidgets import QApplication
+
+    app = QApplication([])
+    test_list = [
+        imageItem_placeholder_and_load,
+        imageItem_release_hidden,
+        imageItem_position_in_model,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
@@ -10,35 +10,67 @@ from PyQt5.QtWidgets import (
     QPushButton,
     QFileDialog,
     QMessageBox,
+    QCheckBox,
+    QProgressDialog,
+    QShortcut,
 )
-from PyQt5.QtGui import QPixmap, QCloseEvent
-from PyQt5.QtCore import Qt, QPoint, pyqtSignal
+from PyQt5.QtGui import QPixmap, QImage, QCloseEvent, QDragEnterEvent, QDropEvent, QKeySequence
+from PyQt5.QtCore import Qt, QEvent, QPoint, QSize, pyqtSignal
 
 from ReferenceImageView import *
+from ReferenceBoardScene import *
+from ImageLoader import *
+from CuteLookSettings import *
+from BoardReader import BoardLoadReport
+from Instrumentation import *
 
 # from ReferenceBoard import *
 from ReferenceBoardModels import *
 from UnitTesting import *
 
 
+ImageView = FloatingImageWidget | ReferenceImageItem
+
+
 class ReferenceBoardView(QMainWindow):
-    _opened_images: dict[str, ReferenceImageModel] = {}
     _image_hidden: bool = False
     board_id: int = 0
+    # boards showing the instrumentation overlay
+    _overlays_shown: typing.ClassVar[set[int]] = set()
 
-    add_image: typing.ClassVar[pyqtSignal] = pyqtSignal(pathlib.Path)
     close_image: typing.ClassVar[pyqtSignal] = pyqtSignal(str)
+    # image moved, zoomed, shown or hidden (image name)
+    image_changed: typing.ClassVar[pyqtSignal] = pyqtSignal(str)
+    # look for the missing images in (directory, compare file contents)
+    relink_images: typing.ClassVar[pyqtSignal] = pyqtSignal(str, bool)
+    # image files and directories to add ([pathlib.Path], recursive)
+    import_images: typing.ClassVar[pyqtSignal] = pyqtSignal(object, bool)
+    import_cancelled: typing.ClassVar[pyqtSignal] = pyqtSignal()
 
     save_board: typing.ClassVar[pyqtSignal] = pyqtSignal(bool)
     # open_board: typing.ClassVar[pyqtSignal] = pyqtSignal()
     close_board: typing.ClassVar[pyqtSignal] = pyqtSignal(int)
     new_board: typing.ClassVar[pyqtSignal] = pyqtSignal(str)
+    # images decoded, zoomed or released (see MemoryGovernor)
+    memory_changed: typing.ClassVar[pyqtSignal] = pyqtSignal()
 
     # def __init__(self, ctl: ReferenceBoard):
-    def __init__(self, board_id: int):
+    def __init__(self, board_id: int, settings: CuteLookSettings = None):
         super().__init__()
 
         self._board_id = board_id
+        self._settings = settings if settings is not None else CuteLookSettings()
+        # the images of this board only: released when it is closed
+        self._opened_images: dict[str, ImageView] = {}
+
+        # images are decoded in background: track the widgets waiting for them
+        self._image_loader = ImageLoader()
+        self._image_loader.image_loaded.connect(self._onImageLoaded)
+        self._loading_images: dict[int, ImageView] = {}
+        self._import_progress: QProgressDialog = None
+
+        # images and directories can be dropped on the board
+        self.setAcceptDrops(True)
 
         self.setGeometry(100, 100, 800, 600)
 
@@ -69,23 +101,43 @@ class ReferenceBoardView(QMainWindow):
 
         # reference images
         open_button = QPushButton("open image")
+        open_folder_button = QPushButton("open folder")
         show_hide_button = QPushButton("show/hide")
 
         open_button.clicked.connect(self.openImage)
+        open_folder_button.clicked.connect(self.openImageFolder)
         show_hide_button.clicked.connect(self.showHideImages)
 
         main_button_layout.addWidget(open_button)
+        main_button_layout.addWidget(open_folder_button)
         main_button_layout.addWidget(show_hide_button)
 
-        main_layout.addStretch(1)
+        if self._settings.render_mode == "scene":
+            self._canvas = ReferenceBoardCanvas(central_widget)
+            # drops are handled by the window
+            self._canvas.setAcceptDrops(False)
+            main_layout.addWidget(self._canvas, 1)
+        else:
+            self._canvas = None
+            main_layout.addStretch(1)
         main_button_layout.addStretch(1)
 
+        # see showMemory
+        self._memory_label = QLabel("")
+        main_button_layout.addWidget(self._memory_label)
+
+        # timings and image memory, over the board
+        self._overlay = InstrumentationOverlay(self.imageMemory, self)
+        QShortcut(QKeySequence(Qt.Key_F12), self, self.toggleInstrumentationOverlay)
+        if self._settings.instrumentation_overlay:
+            self.toggleInstrumentationOverlay()
+
     def openBoard(self) -> None:
         file_path, _ = QFileDialog.getOpenFileName(
             self,
             "Select a Reference Board",
             "",
-            "Reference Boards (*.refboard)",
+            "Reference Boards (*.refboard *.refpack)",
         )
         if file_path != "":
             self.new_board.emit(file_path)
@@ -100,7 +152,6 @@ class ReferenceBoardView(QMainWindow):
 
     # TODO manage close event
     def closeEvent(self, event: QCloseEvent):
-        print(f"closeEvent - board window: {self._board_id}")
         self.close_board.emit(self._board_id)
         event.ignore()
 
@@ -112,9 +163,6 @@ class ReferenceBoardView(QMainWindow):
             QMessageBox.Yes | QMessageBox.No,
             QMessageBox.No,
         )
-        print(f"reply: {reply}")
-        print(f"NO: {QMessageBox.No}")
-        print(f"Yes: {QMessageBox.Yes}")
         return reply == QMessageBox.Yes
 
     def saveBoard(self) -> None:
@@ -124,44 +172,308 @@ class ReferenceBoardView(QMainWindow):
         self.save_board.emit(True)
 
     def openSaveDialog(self) -> str:
-        file_name, _ = QFileDialog.getSaveFileName(
+        file_name, selected_filter = QFileDialog.getSaveFileName(
             self,
             "Save Reference Board",
             "",
-            "Reference Boards (*.refboard)",
+            "Reference Boards (*.refboard);;Packed Reference Boards (*.refpack)",
         )
+        # the format is chosen by the extension
+        if file_name != "" and BoardPack.SUFFIX in selected_filter:
+            if not file_name.endswith(BoardPack.SUFFIX):
+                file_name = f"{file_name}{BoardPack.SUFFIX}"
         return file_name
 
     def openImage(self):
-        file_path, _ = QFileDialog.getOpenFileName(
+        file_paths, _ = QFileDialog.getOpenFileNames(
             self,
-            "Select an Image",
+            "Select Images",
             "",
             "Immagini (*.png *.jpg *.jpeg *.bmp *.gif)",
         )
-        # build image model
-        if file_path != "":
-            path = pathlib.Path(file_path)
-            self.add_image.emit(path)
+        if file_paths:
+            self.import_images.emit([pathlib.Path(p) for p in file_paths], False)
+
+    def openImageFolder(self):
+        dir_path = QFileDialog.getExistingDirectory(self, "Select a Folder of Images")
+        if dir_path == "":
+            return
+        path = pathlib.Path(dir_path)
+        recursive = False
+        if any(p.is_dir() for p in path.iterdir()):
+            reply = QMessageBox.question(
+                self,
+                "Import Folder",
+                "Import the images in the subfolders too?",
+                QMessageBox.Yes | QMessageBox.No,
+                QMessageBox.No,
+            )
+            recursive = reply == QMessageBox.Yes
+        self.import_images.emit([path], recursive)
+
+    def dragEnterEvent(self, event: QDragEnterEvent) -> None:
+        if any(url.isLocalFile() for url in event.mimeData().urls()):
+            event.acceptProposedAction()
+
+    def dropEvent(self, event: QDropEvent) -> None:
+        paths = [
+            pathlib.Path(url.toLocalFile())
+            for url in event.mimeData().urls()
+            if url.isLocalFile()
+        ]
+        if paths:
+            event.acceptProposedAction()
+            # dropped directories are imported with their subdirectories
+            self.import_images.emit(paths, True)
+
+    def showImportProgress(self, done: int, total: int) -> None:
+        if self._import_progress is None:
+            self._import_progress = QProgressDialog(
+                "Importing images...", "Cancel", 0, total, self
+            )
+            # only shown for long imports
+            self._import_progress.setMinimumDuration(500)
+            self._import_progress.canceled.connect(self.import_cancelled)
+        self._import_progress.setMaximum(total)
+        self._import_progress.setValue(done)
+
+    def finishImport(self, imported: int, failed: list, cancelled: bool) -> None:
+        if self._import_progress is not None:
+            self._import_progress.canceled.disconnect(self.import_cancelled)
+            self._import_progress.close()
+            self._import_progress.deleteLater()
+            self._import_progress = None
+        if not failed:
+            return
+        # not modal: the images imported are already on the board
+        message_box = QMessageBox(
+            QMessageBox.Warning,
+            "Images not imported",
+            f"{imported} images imported, {len(failed)} can't be opened.",
+            QMessageBox.Close,
+            self,
+        )
+        message_box.setDetailedText(
+            "\n".join(f"{path}: {error}" for path, error in failed)
+        )
+        message_box.setAttribute(Qt.WA_DeleteOnClose)
+        message_box.setModal(False)
+        message_box.show()
+
+    def toggleInstrumentationOverlay(self) -> None:
+        if self._overlay.isVisible():
+            self.hideInstrumentationOverlay()
+            return
+        # shown: timings are recorded from now on
+        ReferenceBoardView._overlays_shown.add(self._board_id)
+        SpanRecorder.instance().setEnabled(True)
+        self._overlay.move(10, self.height() - self._overlay.height() - 10)
+        self._overlay.show()
+        self._overlay.raise_()
+
+    def hideInstrumentationOverlay(self) -> None:
+        # timings recorded while an overlay is shown, else as in the settings
+        self._overlay.hide()
+        ReferenceBoardView._overlays_shown.discard(self._board_id)
+        SpanRecorder.instance().setEnabled(
+            bool(ReferenceBoardView._overlays_shown)
+            or self._settings.instrumentation
+            or self._settings.instrumentation_overlay
+        )
+
+    def imageMemory(self) -> list[tuple[str, int]]:
+        decoded, pixmaps = heldMemory(self._opened_images.values())
+        return [("pixmaps", pixmaps), ("decoded", decoded)]
+
+    def showMemory(self, board_bytes: int, total_bytes: int, budget_bytes: int) -> None:
+        # images of this board, of all the boards (and the budget, if any)
+        mb = 1024 * 1024
+        text = f"images: {board_bytes / mb:.0f} MB, all boards: {total_bytes / mb:.0f}"
+        if budget_bytes > 0:
+            text = f"{text} / {budget_bytes / mb:.0f}"
+        self._memory_label.setText(f"{text} MB")
+
+    def changeEvent(self, event):
+        # activated: its images are the ones viewed last
+        if event.type() == QEvent.ActivationChange and self.isActiveWindow():
+            for image in self._opened_images.values():
+                if image.isVisible():
+                    image.markViewed()
+        super().changeEvent(event)
+        if event.type() == QEvent.WindowStateChange:
+            # minimized or restored
+            self.updateAnimations()
+
+    def resizeEvent(self, event):
+        self._overlay.move(10, self.height() - self._overlay.height() - 10)
+        super().resizeEvent(event)
+        self.updateAnimations()
+
+    def updateAnimations(self) -> None:
+        # animated images play only while in sight (the scene shows their
+        # first frame)
+        if self._canvas is None:
+            for image in self._opened_images.values():
+                image.updateAnimation()
 
     def addImage(self, image_name: str, image_model: ReferenceImageModel):
-        floating_image = FloatingImageWidget(image_name, image_model, parent=self)
+        with span("widget", image_name):
+            if self._canvas is not None:
+                floating_image = ReferenceImageItem(image_name, image_model)
+                floating_image.close_image.connect(self.closeImage)
+                floating_image.image_hidden.connect(self.setImageHide)
+                self._canvas.addImage(floating_image)
+            else:
+                floating_image = FloatingImageWidget(image_name, image_model, parent=self)
 
         self._opened_images[image_name] = floating_image
+        floating_image.full_resolution_needed.connect(
+            lambda: self._loadImage(floating_image)
+        )
+        floating_image.image_changed.connect(self.image_changed)
+        floating_image.image_changed.connect(lambda name: self.memory_changed.emit())
+        floating_image.reload_needed.connect(
+            lambda: self._loadImage(floating_image, savedImageSize(image_model))
+        )
+        floating_image.setReleaseHiddenDelay(
+            int(self._settings.release_hidden_image_s * 1000)
+        )
+
+        if image_model.view_hidden:
+            # decoded only when shown
+            floating_image.unloadImage()
+            floating_image.hide()
+            self.setImageHide()
+            return
+
+        # decode only what is needed to fill the saved views of the image and its clips
+        self._loadImage(floating_image, savedImageSize(image_model))
 
         floating_image.show()
 
+    def _loadImage(self, floating_image: ImageView, size: QSize = None):
+        job_id = self._image_loader.load(floating_image.imageModel().path, size)
+        self._loading_images[job_id] = floating_image
+
+    def _onImageLoaded(self, job_id: int, image: QImage) -> None:
+        floating_image = self._loading_images.pop(job_id, None)
+        if floating_image is None:
+            # closed (or board closed) while decoding
+            return
+        floating_image.setImage(image)
+        self.memory_changed.emit()
+
+    def isLoading(self) -> bool:
+        return bool(self._loading_images)
+
+    def openedImages(self) -> dict[str, ImageView]:
+        return dict(self._opened_images)
+
+    def releaseImages(self) -> None:
+        self._image_loader.cancelAll()
+        self._loading_images.clear()
+        # dropped from the cache too, unless another board uses them
+        for floating_image in self._opened_images.values():
+            floating_image.releaseImage(evict=True)
+
     def closeImage(self, image_name: str):
         img = self._opened_images.pop(image_name)
+        for job_id, floating_image in list(self._loading_images.items()):
+            if floating_image is img:
+                self._image_loader.cancel(job_id)
+                del self._loading_images[job_id]
+        img.releaseImage(evict=True)
+        if self._canvas is not None:
+            self._canvas.removeImage(img)
         img.deleteLater()
         self.close_image.emit(image_name)
 
-    def showMissingImageWarning(self, name: str, path: str) -> None:
-        title = "Image file not found"
-        message = (
-            f'Can\'t open image "{name}".\n Please check if the path is valid:\n{path}'
+    def renameImage(self, old_name: str, new_name: str) -> None:
+        img = self._opened_images.pop(old_name, None)
+        if img is not None:
+            img.setImageName(new_name)
+            self._opened_images[new_name] = img
+
+    def showMissingImages(self, missing: dict[str, str]) -> None:
+        self._showMissingImages(
+            "Image files not found",
+            f"{len(missing)} images of this board can't be found.\n"
+            "Relink them looking for the files in a directory?",
+            missing,
+        )
+
+    def showRelinkResult(self, found: int, missing: dict[str, str]) -> None:
+        self.unsetCursor()
+        if not missing:
+            QMessageBox.information(self, "Images relinked", f"{found} images relinked.")
+            return
+        self._showMissingImages(
+            "Images relinked",
+            f"{found} images relinked, {len(missing)} still missing.",
+            missing,
+        )
+
+    def _showMissingImages(self, title: str, message: str, missing: dict[str, str]) -> None:
+        # not modal: the images found are already on the board
+        message_box = QMessageBox(QMessageBox.Warning, title, message, QMessageBox.Close, self)
+        relink_button = message_box.addButton("Relink...", QMessageBox.AcceptRole)
+        hash_check = QCheckBox("compare file contents (slower)")
+        message_box.setCheckBox(hash_check)
+        message_box.setDetailedText(
+            "\n".join(f'"{name}": {path}' for name, path in missing.items())
+        )
+        message_box.setAttribute(Qt.WA_DeleteOnClose)
+        message_box.setModal(False)
+        relink_button.clicked.connect(
+            lambda: self._chooseRelinkDirectory(hash_check.isChecked())
+        )
+        message_box.show()
+
+    def _chooseRelinkDirectory(self, hash_content: bool) -> None:
+        root_dir = QFileDialog.getExistingDirectory(self, "Look for the missing images in")
+        if root_dir != "":
+            # searching in background, until showRelinkResult
+            self.setCursor(Qt.BusyCursor)
+            self.relink_images.emit(root_dir, hash_content)
+
+    def showLoadReport(self, report: BoardLoadReport) -> None:
+        # not modal: the board stays usable
+        message_box = QMessageBox(
+            QMessageBox.Warning,
+            "Board not fully loaded",
+            f"{len(report.errors)} images can't be loaded and will be removed "
+            "from the board when saved.",
+            QMessageBox.Ok,
+            self,
+        )
+        message_box.setDetailedText(report.summary(max_lines=100))
+        message_box.setAttribute(Qt.WA_DeleteOnClose)
+        message_box.setModal(False)
+        message_box.show()
+
+    def showDuplicateImages(self, path: str, duplicates: dict[str, list[str]]) -> None:
+        # {image path: boards using it} of the images looking like path
+        # not modal: the image is added anyway
+        details = []
+        for other_path, boards in duplicates.items():
+            details.append(other_path)
+            details += [f"    in {board}" for board in boards]
+        message_box = QMessageBox(
+            QMessageBox.Information,
+            "Image already in the library",
+            f"{pathlib.Path(path).name} looks like {len(duplicates)} images of your boards.",
+            QMessageBox.Ok,
+            self,
         )
-        dialog = QMessageBox.warning(self, title, message)
+        message_box.setDetailedText("\n".join(details))
+        message_box.setAttribute(Qt.WA_DeleteOnClose)
+        message_box.setModal(False)
+        message_box.show()
+
+    def showSaveError(self, path: str, error: str) -> None:
+        title = "Board not saved"
+        message = f'Can\'t save the board to:\n{path}\n\n{error}'
+        QMessageBox.warning(self, title, message)
 
     def showHideImages(self):
         if self._image_hidden:
@@ -1,4 +1,5 @@
 import sys
+import time
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -8,11 +9,64 @@ from PyQt5.QtWidgets import (
     QWidget,
     QPushButton,
     QFileDialog,
+    QRubberBand,
 )
-from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt, QPoint, QSize
+from PyQt5.QtGui import QPixmap, QImage, QPainter, QColor, QGuiApplication
+from PyQt5.QtCore import Qt, QPoint, QSize, QRect, QRectF, QTimer, pyqtSignal
+import typing
 
 from ReferenceBoardModels import *
+from ImagePyramid import *
+from ImageCache import *
+from ImageClip import *
+from AnimatedImage import *
+from TiledImage import *
+from Instrumentation import *
+
+# the numpy based modules (AutoColorSwatch, ColorPicker, EdgeMap) are imported
+# where they are used, after the first board window is shown
+
+
+def savedViewSize(image_model: ReferenceImageModel) -> QSize:
+    return QSize(int(image_model.view_size["w"]), int(image_model.view_size["h"]))
+
+
+def hasViewSize(image_model: ReferenceImageModel) -> bool:
+    # boards saved before the view size was kept have the default one: their
+    # images are shown at their natural size
+    return image_model.view_size != ReferenceImageModel.model_fields["view_size"].default
+
+
+def initialViewSize(image_model: ReferenceImageModel, source_size: QSize) -> QSize:
+    # size an image is shown at once decoded
+    if not hasViewSize(image_model):
+        return QSize(source_size)
+    return source_size.scaled(savedViewSize(image_model), Qt.KeepAspectRatio)
+
+
+def savedImageSize(image_model: ReferenceImageModel) -> QSize | None:
+    # image size needed by the saved view of the image (zoomed in its frame)
+    # and by its clips, None: full resolution
+    if not hasViewSize(image_model):
+        return None
+    size = savedViewSize(image_model) * max(image_model.zoom, 1.0)
+    for clip in image_model.clips:
+        clip_size = QSize(int(clip.view_size["w"]), int(clip.view_size["h"]))
+        size = size.expandedTo(clipImageSize(clip.region, clip_size))
+    return size
+
+
+def heldMemory(images: typing.Iterable) -> tuple[int, int]:
+    # (decoded, pixmaps) bytes held by image views (FloatingImageWidget or
+    # ReferenceImageItem); a decoded image shared by more views counts once
+    pyramids = {}
+    pixmaps = 0
+    for image in images:
+        pyramid = image.pyramid()
+        if pyramid is not None:
+            pyramids[id(pyramid)] = pyramid
+        pixmaps += image.pixmapBytes()
+    return sum(p.byteCount() for p in pyramids.values()), pixmaps
 
 
 class FloatingControlButton(QPushButton):
@@ -34,8 +88,159 @@ class FloatingControlButton(QPushButton):
         """)
 
 
+# Color swatch shown over the bottom of an image
+class ColorSwatchStrip(QWidget):
+    HEIGHT: int = 16
+
+    def __init__(self, parent: QWidget = None) -> None:
+        super().__init__(parent)
+        self._swatch: ColorSwatchModel = None
+        self.setFixedHeight(self.HEIGHT)
+        self.hide()
+
+    def setSwatch(self, swatch: ColorSwatchModel | None) -> None:
+        self._swatch = swatch
+        self.setVisible(swatch is not None)
+        self.update()
+
+    def paintEvent(self, event):
+        if self._swatch is not None:
+            from AutoColorSwatch import paintColorSwatch
+
+            painter = QPainter(self)
+            rect = QRectF(0, 0, self.width() - 1, self.height() - 1)
+            paintColorSwatch(painter, rect, self._swatch)
+
+
+# A region of an image shown on its own window. The clip draws from the
+# pixels of its image: it can be moved, zoomed (wheel) and resized around its
+# center (ctrl + wheel), but not panned.
+class ImageClipWidget(QWidget):
+    MIN_SIZE: int = 16
+    # delay after the last wheel step before the change is notified
+    CHANGED_DELAY_MS: int = 150
+
+    # moved, zoomed or resized
+    clip_changed: typing.ClassVar[pyqtSignal] = pyqtSignal()
+    # shown at a size the loaded image can't provide
+    full_resolution_needed: typing.ClassVar[pyqtSignal] = pyqtSignal()
+    close_clip: typing.ClassVar[pyqtSignal] = pyqtSignal(object)
+
+    def __init__(self, clip_model: ImageClipModel, parent: QWidget = None) -> None:
+        super().__init__(parent)
+        self._clip_model = clip_model
+        self._pyramid: ImagePyramid = None
+        self._drag_position = QPoint()
+
+        self._changed_timer = QTimer(self)
+        self._changed_timer.setSingleShot(True)
+        self._changed_timer.setInterval(self.CHANGED_DELAY_MS)
+        self._changed_timer.timeout.connect(self.clip_changed)
+
+        self._close_button = FloatingControlButton("X", self)
+        self._close_button.clicked.connect(lambda: self.close_clip.emit(self))
+        self._close_button.hide()
+
+        self._resize(QSize(int(clip_model.view_size["w"]), int(clip_model.view_size["h"])))
+        self.move(int(clip_model.view_position["w"]), int(clip_model.view_position["h"]))
+
+    def clipModel(self) -> ImageClipModel:
+        return self._clip_model
+
+    def setImage(self, pyramid: ImagePyramid) -> None:
+        # shares the pixels of the image: only a reference more in the cache
+        self.releaseImage()
+        self._pyramid = pyramid
+        ImageCache.instance().acquire(pyramid)
+        self.update()
+
+    def releaseImage(self) -> None:
+        if self._pyramid is not None:
+            ImageCache.instance().release(self._pyramid)
+            self._pyramid = None
+
+    def _resize(self, size: QSize) -> None:
+        size = size.expandedTo(QSize(self.MIN_SIZE, self.MIN_SIZE))
+        self.setFixedSize(size)
+        self._clip_model.view_size = {"w": size.width(), "h": size.height()}
+        self._close_button.move(self.width() - self._close_button.width() - 5, 5)
+        if self._pyramid is not None and not self._pyramid.isNull():
+            if not self._pyramid.covers(clipImageSize(self._clip_model.region, size)):
+                self.full_resolution_needed.emit()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        if self._pyramid is None or self._pyramid.isNull():
+            painter.fillRect(event.rect(), Qt.lightGray)
+            return
+        # only the exposed part: moving the clip over others redraws little
+        paintClip(
+            painter, QRectF(self.rect()), self._pyramid, self._clip_model.region, QRectF(event.rect())
+        )
+
+    def enterEvent(self, event):
+        self._close_button.show()
+        super().enterEvent(event)
+
+    def leaveEvent(self, event):
+        self._close_button.hide()
+        super().leaveEvent(event)
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self._drag_position = event.globalPos() - self.frameGeometry().topLeft()
+            event.accept()
+
+    def mouseMoveEvent(self, event):
+        if event.buttons() == Qt.LeftButton:
+            self.move(event.globalPos() - self._drag_position)
+            event.accept()
+
+    def mouseReleaseEvent(self, event):
+        self._drag_position = QPoint()
+        position = {"w": self.x(), "h": self.y()}
+        if position != self._clip_model.view_position:
+            self._clip_model.view_position = position
+            self.clip_changed.emit()
+        event.accept()
+
+    def wheelEvent(self, event):
+        factor = 1.1 if event.angleDelta().y() > 0 else 1 / 1.1
+        if event.modifiers() & Qt.ControlModifier:
+            # same magnification, bigger (smaller) region
+            region = self._clip_model.region
+            resized = resizedRegion(region, factor)
+            self._clip_model.region = resized
+            self._resize(
+                QSize(
+                    round(self.width() * resized["w"] / region["w"]),
+                    round(self.height() * resized["h"] / region["h"]),
+                )
+            )
+        else:
+            self._resize(self.size() * factor)
+        self.update()
+        self._changed_timer.start()
+        event.accept()
+
+
 class FloatingImageWidget(QWidget):
-    _pixmap: QPixmap = None
+    # delay after the last wheel step before the smooth re-scaling
+    SMOOTH_ZOOM_DELAY_MS: int = 150
+    # hidden images give back their pixels after this delay, keeping a thumbnail
+    RELEASE_HIDDEN_DELAY_MS: int = 30000
+    THUMBNAIL_SIZE: int = 64
+    # color picker smoothing: side of the averaged square is 2 * radius + 1
+    PICKER_RADIUS: int = 2
+    PICKER_MAX_RADIUS: int = 64
+    # new clips are placed on the right of the image
+    CLIP_OFFSET: int = 10
+    # clip sides closer than this to a strong edge snap to it (shift: no snap)
+    CLIP_SNAP_DISTANCE: int = 8
+    # zoomed in its frame (ctrl + wheel), a source pixel is at most this big
+    MAX_PIXEL_ZOOM: int = 8
+
+    _pyramid: ImagePyramid = None
     _pixmap_size: QSize = None
 
     _image_model: ReferenceImageModel = None
@@ -43,6 +248,16 @@ class FloatingImageWidget(QWidget):
 
     _close_button: FloatingControlButton = None
     _hide_button: FloatingControlButton = None
+    _swatch_button: FloatingControlButton = None
+    _picker_button: FloatingControlButton = None
+    _clip_button: FloatingControlButton = None
+
+    # zoomed in past the resolution of the loaded image
+    full_resolution_needed: typing.ClassVar[pyqtSignal] = pyqtSignal()
+    # shown after its pixels were released
+    reload_needed: typing.ClassVar[pyqtSignal] = pyqtSignal()
+    # position, size or visibility changed in the model (image name)
+    image_changed: typing.ClassVar[pyqtSignal] = pyqtSignal(str)
 
     def __init__(
         self, image_name: str, image_model: ReferenceImageModel, parent: QWidget = None
@@ -58,34 +273,454 @@ class FloatingImageWidget(QWidget):
         self.setWindowFlags(Qt.FramelessWindowHint)
 
         self._drag_position = QPoint()
+        # panning the image zoomed in its frame (ctrl or middle button drag)
+        self._pan_position: QPoint = None
 
-        self._pixmap = QPixmap(image_model.path)
-        self._pixmap_size = self._pixmap.size()
+        self._smooth_zoom_timer = QTimer(self)
+        self._smooth_zoom_timer.setSingleShot(True)
+        self._smooth_zoom_timer.setInterval(self.SMOOTH_ZOOM_DELAY_MS)
+        self._smooth_zoom_timer.timeout.connect(self._onZoomFinished)
 
-        if self._pixmap.isNull():
-            self.image_label = QLabel("Errore caricamento immagine", self)
-            self.image_label.setAlignment(Qt.AlignCenter)
+        self._thumbnail: QImage = None
+        self._unloaded = False
+        # see MemoryGovernor: the least recently viewed images are degraded first
+        self._last_viewed = time.monotonic()
+        self._release_timer = QTimer(self)
+        self._release_timer.setSingleShot(True)
+        self._release_timer.setInterval(self.RELEASE_HIDDEN_DELAY_MS)
+        self._release_timer.timeout.connect(self.unloadImage)
+
+        # animated images (see AnimatedImage): played while in sight, the
+        # pyramid holds the first frame
+        self._animation: AnimatedImage = None
+        self._frame: QImage = None
+        # very large images: zoomed in past the decoded image, the part in
+        # sight is drawn from tiles (see TiledImage)
+        self._tiled: TiledImage = None
+
+        self._image_model = image_model
+        self._image_name = image_name
+
+        # the image is decoded in background (see setImage):
+        # meanwhile show a placeholder as big as the last saved view
+        self.image_label = QLabel("...", self)
+        self.image_label.setAlignment(Qt.AlignCenter)
+        self.image_label.setStyleSheet("background-color: lightgray; color: gray;")
+        self.setFixedSize(savedViewSize(image_model).expandedTo(QSize(50, 50)))
+        self.image_label.setGeometry(0, 0, self.width(), self.height())
+
+        self._swatch_strip = ColorSwatchStrip(self)
+        self._swatch_strip.setSwatch(image_model.color_swatch)
+
+        self._picking = False
+        self._picker_radius = self.PICKER_RADIUS
+        self._picker_table: "SummedAreaTable" = None
+        self._picker_image: QImage = None
+        self._magnifier: "MagnifierWidget" = None
+
+        self._selecting_clip = False
+        self._clip_origin = QPoint()
+        self._rubber_band: QRubberBand = None
+        self._clips: list[ImageClipWidget] = []
+        for clip_model in image_model.clips:
+            self._addClipWidget(clip_model)
+
+        self.addControlButtons()
+
+        self.move(int(image_model.view_position["w"]), int(image_model.view_position["h"]))
+
+    def setImage(self, pyramid: ImagePyramid) -> None:
+        self.releaseImage()
+        self._pyramid = pyramid
+        ImageCache.instance().acquire(pyramid)
+        for clip in self._clips:
+            clip.setImage(pyramid)
+        self._full_resolution_requested = False
+        self._thumbnail = None
+        self._unloaded = False
+
+        if pyramid.isNull():
+            self._pixmap_size = None
+            self.image_label.setText("Errore caricamento immagine")
             self.image_label.setStyleSheet("background-color: lightgray; color: red;")
             self.setFixedSize(200, 100)
+            self.image_label.setGeometry(0, 0, self.width(), self.height())
+            self._reposition_buttons()
         else:
-            self.image_label = QLabel(self)
-            self.image_label.setPixmap(self._pixmap)
+            self.image_label.setText("")
+            self.image_label.setStyleSheet("")
             self.image_label.setScaledContents(True)
-            self.setFixedSize(self._pixmap_size)
+            if self._pixmap_size is None:
+                # first load: restore the saved view size
+                self._pixmap_size = initialViewSize(self._image_model, pyramid.sourceSize())
+            if self._animation is None and pyramid.isAnimated():
+                self._animation = AnimatedImage(self._image_model.path, self)
+                self._animation.frame_ready.connect(self._onFrame)
+            if self._tiled is None and TiledImage.isLarge(pyramid.sourceSize()):
+                self._tiled = TiledImage.forPath(self._image_model.path, self)
+                if self._tiled is not None:
+                    self._tiled.tile_ready.connect(self.update)
+                    self._tiled.tiles_ready.connect(self.update)
+            self._updatePixmap()
+            self.updateAnimation()
 
-            self.image_label.setGeometry(0, 0, self.width(), self.height())
+    def releaseImage(self, evict: bool = False) -> None:
+        self.stopColorPicker()
+        self.stopClipSelection()
+        if self._animation is not None:
+            self._animation.pause()
+            self._frame = None
+        # before the image: evict only once the clips are done with it
+        for clip in self._clips:
+            clip.releaseImage()
+        if self._pyramid is not None:
+            ImageCache.instance().release(self._pyramid, evict)
+            self._pyramid = None
 
-        self._image_model = image_model
+    def setReleaseHiddenDelay(self, delay_ms: int) -> None:
+        self._release_timer.setInterval(delay_ms)
+
+    def unloadImage(self) -> None:
+        # keep only a thumbnail: the image is decoded again when shown (or
+        # viewed, if unloaded while shown)
+        if self._pyramid is not None and not self._pyramid.isNull():
+            self._thumbnail = self._pyramid.thumbnail(self.THUMBNAIL_SIZE)
+        self.releaseImage(evict=True)
+        if self.isVisible() and self._thumbnail is not None:
+            # stretched by the label
+            self.image_label.setPixmap(QPixmap.fromImage(self._thumbnail))
+        else:
+            self.image_label.clear()
+        self._unloaded = True
+
+    def isUnloaded(self) -> bool:
+        return self._unloaded
+
+    def reduceImage(self) -> bool:
+        # drop the levels bigger than the image and its clips need;
+        # False: nothing to drop
+        needed_size = savedImageSize(self._image_model)
+        if self._pyramid is None or self._pyramid.isNull() or needed_size is None:
+            return False
+        level = self._pyramid.levelFor(needed_size)
+        if level == 0:
+            return False
+        reduced = self._pyramid.reduced(level)
+        self.releaseImage(evict=True)
+        self.setImage(reduced)
+        return True
+
+    def markViewed(self) -> None:
+        self._last_viewed = time.monotonic()
+        if self._unloaded and self.isVisible():
+            self._unloaded = False
+            self.reload_needed.emit()
+
+    def lastViewed(self) -> float:
+        return self._last_viewed
+
+    def pyramid(self) -> ImagePyramid | None:
+        return self._pyramid
+
+    def imageModel(self) -> ReferenceImageModel:
+        return self._image_model
+
+    def isLoaded(self) -> bool:
+        return self._pyramid is not None
+
+    def imageName(self) -> str:
+        return self._image_name
+
+    def setImageName(self, image_name: str) -> None:
         self._image_name = image_name
 
-        self.addControlButtons()
+    def pixmapBytes(self) -> int:
+        pixmap = self.image_label.pixmap()
+        frames = self._animation.frameBytes() if self._animation is not None else 0
+        if pixmap is None or pixmap.isNull():
+            return frames
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8 + frames
+
+    def updateAnimation(self) -> None:
+        # play only while some of the image is in sight
+        if self._animation is None:
+            return
+        if self._pyramid is not None and self.isVisible() and not self.visibleRegion().isEmpty():
+            self._animation.play()
+        else:
+            self._animation.pause()
+
+    def isAnimating(self) -> bool:
+        return self._animation is not None and self._animation.isPlaying()
+
+    def _onFrame(self, frame: QImage) -> None:
+        if self._pyramid is None:
+            return
+        self._frame = frame
+        # decoded at the size shown, stretched by the label while zooming
+        self.image_label.setPixmap(QPixmap.fromImage(self._framePart(frame)))
+
+    def _framePart(self, frame: QImage) -> QImage:
+        # the part of the frame in sight (frames are decoded at the frame size)
+        if self._image_model.zoom <= 1:
+            return frame
+        return frame.copy(regionRect(self.viewRegion(), frame.size()).toRect())
+
+    def usesTiles(self) -> bool:
+        return (
+            self._tiled is not None
+            and self._pyramid is not None
+            and not self._pyramid.covers(self.shownImageSize())
+        )
+
+    # Zoomed in its frame (zoom > 1) the widget keeps its size and shows only
+    # a region of the image, around image_center (in source pixels): the
+    # pixmap is as big as the frame whatever the zoom.
+    def viewRegion(self) -> dict[str, float]:
+        # normalized region of the image in sight
+        if self._image_model.zoom <= 1 or self._pyramid is None or self._pyramid.isNull():
+            return {"x": 0.0, "y": 0.0, "w": 1.0, "h": 1.0}
+        source = self._pyramid.sourceSize()
+        center = (
+            self._image_model.image_center["x"] / source.width(),
+            self._image_model.image_center["y"] / source.height(),
+        )
+        return zoomedRegion(center, self._image_model.zoom)
+
+    def _setViewRegion(self, region: dict[str, float]) -> None:
+        source = self._pyramid.sourceSize()
+        self._image_model.image_center = {
+            "x": (region["x"] + region["w"] / 2) * source.width(),
+            "y": (region["y"] + region["h"] / 2) * source.height(),
+        }
+
+    def shownImageSize(self) -> QSize:
+        # size of the whole image at the zoom shown
+        return self._pixmap_size * max(self._image_model.zoom, 1.0)
+
+    def zoomInFrame(self, factor: float, pos: QPoint) -> None:
+        # the image point at pos stays there
+        source = self._pyramid.sourceSize()
+        max_zoom = max(source.width() * self.MAX_PIXEL_ZOOM / self._pixmap_size.width(), 1.0)
+        zoom = min(max(self._image_model.zoom * factor, 1.0), max_zoom)
+        region = self.viewRegion()
+        fx = pos.x() / self.width()
+        fy = pos.y() / self.height()
+        side = 1.0 / zoom
+        center = (
+            region["x"] + fx * region["w"] - fx * side + side / 2,
+            region["y"] + fy * region["h"] - fy * side + side / 2,
+        )
+        self._image_model.zoom = zoom
+        self._setViewRegion(zoomedRegion(center, zoom))
+
+    def panInFrame(self, delta: QPoint) -> None:
+        region = self.viewRegion()
+        center = (
+            region["x"] + region["w"] / 2 - delta.x() / self.width() * region["w"],
+            region["y"] + region["h"] / 2 - delta.y() / self.height() * region["h"],
+        )
+        self._setViewRegion(zoomedRegion(center, self._image_model.zoom))
+        # fast while dragging, smooth (and saved) once it stops
+        self._updatePixmap(smooth=False)
+        self._smooth_zoom_timer.start()
+
+    def _updatePixmap(self, smooth: bool = True) -> None:
+        with span("scale", self._image_name):
+            if self.usesTiles():
+                # no pixmap as big as the zoomed image: see paintEvent
+                self.image_label.clear()
+                self.update()
+            elif self._frame is not None:
+                # only the frame shown is stretched (by the label), the next
+                # ones are decoded at the new size
+                self.image_label.setPixmap(QPixmap.fromImage(self._framePart(self._frame)))
+            elif self._image_model.zoom > 1:
+                # only the region in sight, scaled to the frame
+                pixmap = QPixmap(self._pixmap_size)
+                pixmap.fill(Qt.transparent)
+                painter = QPainter(pixmap)
+                paintClip(
+                    painter, QRectF(pixmap.rect()), self._pyramid, self.viewRegion(), smooth=smooth
+                )
+                painter.end()
+                self.image_label.setPixmap(pixmap)
+            else:
+                self.image_label.setPixmap(self._pyramid.scaled(self._pixmap_size, smooth))
+            if self._animation is not None:
+                self._animation.setSize(self._pixmap_size)
+        self.setFixedSize(self._pixmap_size)
+        self.image_label.setGeometry(0, 0, self.width(), self.height())
+        self._reposition_buttons()
+
+    # main colors of the image: computed once, then saved with the board
+    def toggleColorSwatch(self) -> None:
+        if self._image_model.color_swatch is not None:
+            self._image_model.color_swatch = None
+        elif self._pyramid is not None and not self._pyramid.isNull():
+            from AutoColorSwatch import AutoColorSwatch
+
+            self._image_model.color_swatch = AutoColorSwatch.instance().swatch(self._pyramid)
+        else:
+            return
+        self._swatch_strip.setSwatch(self._image_model.color_swatch)
+        self.image_changed.emit(self._image_name)
+
+    # magnified color picker: the picked color is the average of the square
+    # around the pointer, read from the summed area table of the level shown
+    def startColorPicker(self) -> None:
+        from ColorPicker import ColorPicker, MagnifierWidget
+
+        if self._pyramid is None or self._pyramid.isNull():
+            return
+        self.requestEdgeMap()
+        # zoomed in, the level shown may be the whole decoded image: the table
+        # of a level at most as big as the screen is built in a blink
+        screen = self.screen()
+        screen_size = screen.size() * screen.devicePixelRatio()
+        level = self._pyramid.levelFor(fittedSize(self.shownImageSize(), screen_size))
+        self._picker_image = self._pyramid.level(level)
+        self._picker_table = ColorPicker.instance().table(self._pyramid, level)
+        if self._magnifier is None:
+            self._magnifier = MagnifierWidget(self.window())
+        self._picking = True
+        self.hide_buttons()
+        # the label would take the mouse events
+        self.image_label.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setMouseTracking(True)
+        self.setCursor(Qt.CrossCursor)
+
+    def stopColorPicker(self) -> None:
+        if not self._picking:
+            return
+        self._picking = False
+        self._picker_table = None
+        self._picker_image = None
+        self._magnifier.hide()
+        self.image_label.setAttribute(Qt.WA_TransparentForMouseEvents, False)
+        self.setMouseTracking(False)
+        self.unsetCursor()
+
+    def isPicking(self) -> bool:
+        return self._picking
+
+    def pickedColor(self, pos: QPoint) -> tuple[QPoint, QColor]:
+        # (pixel of the picker image, its averaged color) under pos
+        from ColorPicker import ColorPicker
+
+        table = self._picker_table
+        region = self.viewRegion()
+        x = int((region["x"] + pos.x() / self.width() * region["w"]) * table.width())
+        y = int((region["y"] + pos.y() / self.height() * region["h"]) * table.height())
+        x = min(max(x, 0), table.width() - 1)
+        y = min(max(y, 0), table.height() - 1)
+        color = ColorPicker.instance().pick(table, x, y, self._picker_radius)
+        return QPoint(x, y), color
+
+    def _updateMagnifier(self, pos: QPoint, global_pos: QPoint) -> None:
+        from ColorPicker import MagnifierWidget, magnifiedClip
+
+        pixel, color = self.pickedColor(pos)
+        clip = magnifiedClip(
+            self._picker_image, pixel, MagnifierWidget.CLIP_PIXELS, MagnifierWidget.MAGNIFICATION
+        )
+        self._magnifier.setPicked(clip, color, self._picker_radius)
+        self._magnifier.follow(global_pos)
+        self._magnifier.show()
+        self._magnifier.raise_()
+
+    # clips: drag a rectangle on the image to show that region on its own
+    def startClipSelection(self) -> None:
+        if self._pyramid is None or self._pyramid.isNull():
+            return
+        self.requestEdgeMap()
+        self.stopColorPicker()
+        self._selecting_clip = True
+        self.hide_buttons()
+        self.image_label.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setCursor(Qt.CrossCursor)
+
+    def stopClipSelection(self) -> None:
+        if not self._selecting_clip:
+            return
+        self._selecting_clip = False
+        if self._rubber_band is not None:
+            self._rubber_band.hide()
+        self.image_label.setAttribute(Qt.WA_TransparentForMouseEvents, False)
+        self.unsetCursor()
+
+    def addClip(self, rect: QRect) -> ImageClipWidget:
+        # rect: in widget coordinates, shown at the same size
+        clip_model = ImageClipModel(
+            region=subRegion(regionFromRect(QRectF(rect), self.size()), self.viewRegion()),
+            view_size={"w": rect.width(), "h": rect.height()},
+            view_position={"w": self.x() + self.width() + self.CLIP_OFFSET, "h": self.y()},
+        )
+        self._image_model.clips.append(clip_model)
+        clip = self._addClipWidget(clip_model)
+        if self._pyramid is not None:
+            clip.setImage(self._pyramid)
+        clip.show()
+        self.image_changed.emit(self._image_name)
+        return clip
+
+    def requestEdgeMap(self) -> None:
+        # for the clip snapping and the color picker, ready in a while
+        from EdgeMap import EdgeMapService
+
+        EdgeMapService.instance().request(self._pyramid)
+
+    def snappedRect(self, rect: QRect) -> QRect:
+        # rect with its sides on the strong edges nearby, if the edges are known
+        edge_map = self._pyramid.edgeMap() if self._pyramid is not None else None
+        if edge_map is None:
+            return rect
+        view_region = self.viewRegion()
+        region = subRegion(regionFromRect(QRectF(rect), self.size()), view_region)
+        tolerance = self.CLIP_SNAP_DISTANCE / max(self.width(), self.height()) * view_region["w"]
+        snapped = relativeRegion(edge_map.snapRegion(region, tolerance), view_region)
+        return regionRect(snapped, self.size()).toRect()
+
+    def clips(self) -> list[ImageClipWidget]:
+        return list(self._clips)
+
+    def removeClip(self, clip: ImageClipWidget) -> None:
+        self._clips.remove(clip)
+        self._image_model.clips = [c for c in self._image_model.clips if c is not clip.clipModel()]
+        clip.releaseImage()
+        clip.deleteLater()
+        self.image_changed.emit(self._image_name)
+
+    def _addClipWidget(self, clip_model: ImageClipModel) -> ImageClipWidget:
+        # the clips float on the board, as their image
+        clip = ImageClipWidget(clip_model, self.parentWidget())
+        clip.clip_changed.connect(lambda: self.image_changed.emit(self._image_name))
+        clip.close_clip.connect(self.removeClip)
+        clip.full_resolution_needed.connect(self._requestFullResolution)
+        self._clips.append(clip)
+        return clip
+
+    def _requestFullResolution(self) -> None:
+        if self._tiled is not None:
+            # the tiles instead of the whole image (cut the first time)
+            self._tiled.prepare()
+            return
+        if not self._full_resolution_requested:
+            self._full_resolution_requested = True
+            self.full_resolution_needed.emit()
 
     def addControlButtons(self) -> None:
         self._close_button = FloatingControlButton("X", self)
         self._hide_button = FloatingControlButton("-", self)
+        self._swatch_button = FloatingControlButton("C", self)
+        self._picker_button = FloatingControlButton("P", self)
+        self._clip_button = FloatingControlButton("[]", self)
 
         self._close_button.clicked.connect(self.close)
         self._hide_button.clicked.connect(self.hide)
+        self._swatch_button.clicked.connect(self.toggleColorSwatch)
+        self._picker_button.clicked.connect(self.startColorPicker)
+        self._clip_button.clicked.connect(self.startClipSelection)
 
         self._reposition_buttons()
 
@@ -94,58 +729,314 @@ class FloatingImageWidget(QWidget):
     def hide_buttons(self):
         self._close_button.hide()
         self._hide_button.hide()
+        self._swatch_button.hide()
+        self._picker_button.hide()
+        self._clip_button.hide()
 
     def show_buttons(self):
         self._close_button.show()
         self._hide_button.show()
+        self._swatch_button.show()
+        self._picker_button.show()
+        self._clip_button.show()
 
     def hide(self):
         self.parent().setImageHide()
         super().hide()
 
+    def hideEvent(self, event):
+        # not when the board window is hidden or minimized
+        if self.isHidden():
+            self._image_model.view_hidden = True
+            self.image_changed.emit(self._image_name)
+            self._release_timer.start()
+            for clip in self._clips:
+                clip.hide()
+        super().hideEvent(event)
+        self.updateAnimation()
+
+    def showEvent(self, event):
+        if not event.spontaneous():
+            if self._image_model.view_hidden:
+                self._image_model.view_hidden = False
+                self.image_changed.emit(self._image_name)
+            self._release_timer.stop()
+            for clip in self._clips:
+                clip.show()
+            if self._unloaded:
+                self._unloaded = False
+                if self._thumbnail is not None:
+                    # stretched by the label
+                    self.image_label.setPixmap(QPixmap.fromImage(self._thumbnail))
+                self.reload_needed.emit()
+        super().showEvent(event)
+        self.updateAnimation()
+
+    def moveEvent(self, event):
+        # dragged in or out of the board
+        super().moveEvent(event)
+        self.updateAnimation()
+
+    def paintEvent(self, event):
+        if self.usesTiles():
+            painter = QPainter(self)
+            exposed = QRectF(event.rect())
+            region = self.viewRegion()
+            # upscaled from the decoded image until its tiles are loaded
+            paintClip(painter, QRectF(self.rect()), self._pyramid, region, exposed)
+            # the whole image, of which the frame shows region
+            shown = self.shownImageSize()
+            target = QRectF(
+                -region["x"] * shown.width(),
+                -region["y"] * shown.height(),
+                shown.width(),
+                shown.height(),
+            )
+            self._tiled.paint(painter, target, exposed)
+            painter.end()
+        super().paintEvent(event)
+
     def close(self):
+        if self._tiled is not None:
+            self._tiled.close()
         self.parent().closeImage(self._image_name)
+        for clip in self._clips:
+            clip.deleteLater()
+        self._clips = []
         super().close()
 
     def _reposition_buttons(self):
         xc = self.width() - self._close_button.width() - 5
         xh = xc - self._hide_button.width() - 5
+        xs = xh - self._swatch_button.width() - 5
+        xp = xs - self._picker_button.width() - 5
         y = 5
         self._close_button.move(xc, y)
         self._hide_button.move(xh, y)
+        self._swatch_button.move(xs, y)
+        self._picker_button.move(xp, y)
+        self._clip_button.move(xp - self._clip_button.width() - 5, y)
+        strip_height = ColorSwatchStrip.HEIGHT
+        self._swatch_strip.setGeometry(
+            5, self.height() - strip_height - 5, self.width() - 10, strip_height
+        )
 
     def enterEvent(self, event):
+        self.markViewed()
         self.show_buttons()
         super().enterEvent(event)
 
     def leaveEvent(self, event):
         self.hide_buttons()
+        if self._picking:
+            self._magnifier.hide()
         super().leaveEvent(event)
 
     def mousePressEvent(self, event):
+        if self._picking:
+            # left button: copy the color, any button: done
+            if event.button() == Qt.LeftButton:
+                pixel, color = self.pickedColor(event.pos())
+                QGuiApplication.clipboard().setText(color.name())
+            self.stopColorPicker()
+            event.accept()
+            return
+        if self._selecting_clip:
+            if event.button() == Qt.LeftButton:
+                self._clip_origin = event.pos()
+                if self._rubber_band is None:
+                    self._rubber_band = QRubberBand(QRubberBand.Rectangle, self)
+                self._rubber_band.setGeometry(QRect(self._clip_origin, QSize()))
+                self._rubber_band.show()
+            else:
+                self.stopClipSelection()
+            event.accept()
+            return
+        panning = event.button() == Qt.MiddleButton or (
+            event.button() == Qt.LeftButton and event.modifiers() & Qt.ControlModifier
+        )
+        if panning and self._image_model.zoom > 1 and self._pyramid is not None:
+            self._pan_position = event.pos()
+            event.accept()
+            return
         if event.button() == Qt.LeftButton:
             self._drag_position = event.globalPos() - self.frameGeometry().topLeft()
             event.accept()
 
     def mouseMoveEvent(self, event):
+        if self._picking:
+            self._updateMagnifier(event.pos(), event.globalPos())
+            event.accept()
+            return
+        if self._selecting_clip:
+            if self._rubber_band is not None and self._rubber_band.isVisible():
+                self._rubber_band.setGeometry(QRect(self._clip_origin, event.pos()).normalized())
+            event.accept()
+            return
+        if self._pan_position is not None:
+            if self._pyramid is not None:
+                self.panInFrame(event.pos() - self._pan_position)
+            self._pan_position = event.pos()
+            event.accept()
+            return
         if event.buttons() == Qt.LeftButton:
             self.move(event.globalPos() - self._drag_position)
             event.accept()
 
     def mouseReleaseEvent(self, event):
+        if self._selecting_clip:
+            if self._rubber_band is not None and self._rubber_band.isVisible():
+                rect = self._rubber_band.geometry().intersected(self.rect())
+                self.stopClipSelection()
+                if not event.modifiers() & Qt.ShiftModifier:
+                    rect = self.snappedRect(rect)
+                if min(rect.width(), rect.height()) >= ImageClipWidget.MIN_SIZE:
+                    self.addClip(rect)
+            event.accept()
+            return
+        if self._pan_position is not None:
+            # saved once smoothly scaled, see panInFrame
+            self._pan_position = None
+            event.accept()
+            return
         self._drag_position = QPoint()
+        position = {"w": self.x(), "h": self.y()}
+        if position != self._image_model.view_position:
+            self._image_model.view_position = position
+            self.image_changed.emit(self._image_name)
         event.accept()
 
+    def _onZoomFinished(self) -> None:
+        if self._pyramid is None or self._pyramid.isNull():
+            # released meanwhile (board closed)
+            return
+        self._updatePixmap()
+        # only the sizes set by the user are saved, not those of the loading
+        self._image_model.view_size = {"w": self.width(), "h": self.height()}
+        self.image_changed.emit(self._image_name)
+
     def wheelEvent(self, event):
+        if self._pyramid is None or self._pyramid.isNull():
+            event.ignore()
+            return
+        if self._picking:
+            # the wheel changes the smoothing, not the zoom
+            step = 1 if event.angleDelta().y() > 0 else -1
+            self._picker_radius = min(max(self._picker_radius + step, 0), self.PICKER_MAX_RADIUS)
+            self._updateMagnifier(event.pos(), event.globalPos())
+            event.accept()
+            return
         zoom_factor = 1.1 if event.angleDelta().y() > 0 else 1 / 1.1
-        new_size = self._pixmap_size * zoom_factor
-        scaled_pixmap = self._pixmap.scaled(
-            new_size, Qt.KeepAspectRatio, Qt.SmoothTransformation
-        )
+        if event.modifiers() & Qt.ControlModifier:
+            # zoomed in its frame, around the pointer
+            self.zoomInFrame(zoom_factor, event.pos())
+        else:
+            self._pixmap_size = self._pixmap_size * zoom_factor
+        if not self._pyramid.covers(self.shownImageSize()):
+            self._requestFullResolution()
 
-        self.image_label.setPixmap(scaled_pixmap)
-        self.setFixedSize(new_size)
-        # self.image_label.setGeometry(0, 0, new_size.width(), new_size.height())
-        self._reposition_buttons()
-        self._pixmap_size = new_size
+        # fast scaling while the wheel is moving, smooth once it stops
+        self._updatePixmap(smooth=False)
+        self._smooth_zoom_timer.start()
         event.accept()
+
+
+"""
+Unit Tests
+"""
+
+
+@TestFunction
+def imageClip_drag_saves_position():
+    from PyQt5.QtTest import QTest
+    from PyQt5.QtGui import QMouseEvent
+    from PyQt5.QtCore import QEvent
+
+    clip_model = ImageClipModel(view_position={"w": 10, "h": 20})
+    clip = ImageClipWidget(clip_model)
+    changes = []
+    clip.clip_changed.connect(lambda: changes.append(True))
+    clip.show()
+    try:
+        start = QPoint(30, 30)
+        QTest.mousePress(clip, Qt.LeftButton, Qt.NoModifier, start)
+        # QTest.mouseMove sends no buttons held
+        end = start + QPoint(25, 15)
+        QApplication.sendEvent(
+            clip,
+            QMouseEvent(
+                QEvent.MouseMove, end, clip.mapToGlobal(end), Qt.LeftButton, Qt.LeftButton, Qt.NoModifier
+            ),
+        )
+        QTest.mouseRelease(clip, Qt.LeftButton, Qt.NoModifier, end)
+        assert clip_model.view_position != {"w": 10, "h": 20}, "position not saved"
+        assert clip_model.view_position == {"w": clip.x(), "h": clip.y()}, (
+            f"wrong position {clip_model.view_position}"
+        )
+        assert len(changes) == 1, "change not notified"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        clip.close()
+
+
+@TestFunction
+def floatingImage_natural_size():
+    image = QImage(100, 40, QImage.Format_RGB32)
+    image.fill(0xFF204060)
+    # board saved before the view size was kept
+    old_model = ReferenceImageModel(path="./old.png")
+    sized_model = ReferenceImageModel(path="./sized.png", view_size={"w": 300, "h": 300})
+    old = FloatingImageWidget("old", old_model)
+    sized = FloatingImageWidget("sized", sized_model)
+    try:
+        assert savedImageSize(old_model) is None, "old image not decoded whole"
+        old.setImage(ImagePyramid(image))
+        assert old.size() == QSize(100, 40), f"old image not at natural size {old.size()}"
+        sized.setImage(ImagePyramid(image))
+        assert sized.size() == QSize(300, 120), f"saved view size not restored {sized.size()}"
+        assert sized_model.view_size == {"w": 300, "h": 300}, "view size rewritten on load"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        old.releaseImage()
+        sized.releaseImage()
+
+
+@TestFunction
+def floatingImage_picker_level():
+    image = QImage(4000, 3000, QImage.Format_RGB32)
+    image.fill(0xFF204060)
+    model = ReferenceImageModel(path="./large.png", view_size={"w": 400, "h": 300}, zoom=8.0)
+    view = FloatingImageWidget("large", model)
+    try:
+        view.setImage(ImagePyramid(image))
+        screen = view.screen().size() * view.screen().devicePixelRatio()
+        assert view.shownImageSize().width() > screen.width(), "not zoomed past the screen"
+        view.startColorPicker()
+        assert view.isPicking(), "picker not started"
+        table = view._picker_table
+        assert table.width() < 4000, "table of the whole decoded image"
+        assert table.width() >= screen.width() // 2, f"table too coarse {table.width()}"
+        view.stopColorPicker()
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        view.releaseImage()
+
+
+if __name__ == "__main__":
+    from PyQt5.QtWidgets import QApplication
+
+    app = QApplication([])
+    test_list = [
+        imageClip_drag_saves_position,
+        floatingImage_natural_size,
+        floatingImage_picker_level,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
@@ -0,0 +1,147 @@
+import os
+from pathlib import Path
+
+from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtNetwork import QLocalServer, QLocalSocket
+
+from Instrumentation import *
+from UnitTesting import *
+
+
+# one server per user: the instances of different users don't see each other
+def serverName() -> str:
+    user = os.environ.get("USER") or os.environ.get("USERNAME") or "user"
+    return f"cutelook-{user}"
+
+
+# Single instance mode: the first CuteLook listens on a local socket, the
+# next ones send it the board to open and exit, before loading the settings
+# and the boards modules. A request is a UTF-8 absolute board path ending with
+# a newline ("" for a new board), answered with "ok" once received.
+class SingleInstance(QObject):
+    TIMEOUT_MS: int = 1000
+    ACK: bytes = b"ok\n"
+
+    open_board = pyqtSignal(str)
+
+    def __init__(self, name: str = None, parent: QObject = None) -> None:
+        super().__init__(parent)
+        self._name = name if name is not None else serverName()
+        self._server: QLocalServer = None
+
+    @classmethod
+    def sendBoard(cls, board_path: str, name: str = None) -> bool:
+        # False: no running instance took the board
+        socket = QLocalSocket()
+        socket.connectToServer(name if name is not None else serverName())
+        if not socket.waitForConnected(cls.TIMEOUT_MS):
+            return False
+        path = Path(board_path).absolute().as_posix() if board_path != "" else ""
+        socket.write(path.encode("utf-8") + b"\n")
+        if not socket.waitForBytesWritten(cls.TIMEOUT_MS):
+            return False
+        reply = b""
+        while not reply.endswith(b"\n") and socket.waitForReadyRead(cls.TIMEOUT_MS):
+            reply += bytes(socket.readAll())
+        socket.disconnectFromServer()
+        return reply == cls.ACK
+
+    def listen(self) -> bool:
+        self._server = QLocalServer(self)
+        self._server.setSocketOptions(QLocalServer.UserAccessOption)
+        if not self._server.listen(self._name):
+            # left by an instance that crashed: nobody answered on it
+            QLocalServer.removeServer(self._name)
+            if not self._server.listen(self._name):
+                log.warning(f"single instance mode off: {self._server.errorString()}")
+                return False
+        self._server.newConnection.connect(self._onNewConnection)
+        log.info(f"single instance mode: listening on {self._server.fullServerName()}")
+        return True
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+
+    def _onNewConnection(self) -> None:
+        while self._server.hasPendingConnections():
+            socket = self._server.nextPendingConnection()
+            socket.readyRead.connect(lambda socket=socket: self._onReadyRead(socket))
+            socket.disconnected.connect(socket.deleteLater)
+
+    def _onReadyRead(self, socket: QLocalSocket) -> None:
+        if not socket.canReadLine():
+            return
+        path = bytes(socket.readLine()).decode("utf-8").rstrip("\n")
+        # the other instance exits right away, the board opens meanwhile
+        socket.write(self.ACK)
+        socket.flush()
+        socket.disconnectFromServer()
+        log.info(f'single instance mode: board "{path}" handed over')
+        self.open_board.emit(path)
+
+
+"""
+Unit Tests
+"""
+import time
+import threading
+
+from PyQt5.QtCore import QCoreApplication
+
+test_data = {
+    "server_name": f"cutelook-test-{os.getpid()}",
+}
+
+
+@TestFunction
+def single_instance_no_server():
+    start = time.perf_counter()
+    sent = SingleInstance.sendBoard("board.refboard", test_data["server_name"])
+    try:
+        assert not sent, "board sent without a running instance"
+        assert time.perf_counter() - start < 0.5, "waited for a missing instance"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+
+
+@TestFunction
+def single_instance_hand_over():
+    app = QCoreApplication.instance() or QCoreApplication([])
+    instance = SingleInstance(test_data["server_name"])
+    opened = []
+    instance.open_board.connect(opened.append)
+    results = []
+    try:
+        assert instance.listen(), "not listening"
+        # the second instance blocks on the socket: it runs aside
+        for board_path in ["board.refboard", ""]:
+            sender = threading.Thread(
+                target=lambda: results.append(
+                    SingleInstance.sendBoard(board_path, test_data["server_name"])
+                )
+            )
+            sender.start()
+            while sender.is_alive():
+                app.processEvents()
+            sender.join()
+        app.processEvents()
+        assert results == [True, True], f"boards not handed over {results}"
+        expected = [Path("board.refboard").absolute().as_posix(), ""]
+        assert opened == expected, f"wrong boards opened {opened}"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        instance.close()
+
+
+if __name__ == "__main__":
+    test_list = [
+        single_instance_no_server,
+        single_instance_hand_over,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)
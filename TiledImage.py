@@ -0,0 +1,680 @@
+import os
+import json
+import math
+import typing
+import shutil
+import hashlib
+import pathlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtGui import QImage, QImageIOHandler, QPainter, QGuiApplication
+from PyQt5.QtCore import Qt, QObject, QSize, QRect, QRectF, pyqtSignal
+
+from ImageCache import ImageKey
+from BoardPack import *
+from Instrumentation import *
+from UnitTesting import *
+
+
+# (level, column, row) of a tile: level 0 is the full resolution, each next
+# level half the size of the previous one
+TileIndex = tuple[int, int, int]
+
+
+def levelSize(source_size: QSize, level: int) -> QSize:
+    scale = 1 << level
+    return QSize(
+        (source_size.width() + scale - 1) // scale, (source_size.height() + scale - 1) // scale
+    )
+
+
+# Per user, on disk cache of the tiles of the very large images (see
+# TiledImage). The tiles of an image are cut once, in a directory named after
+# the identity of its source file (as in PreviewCache), with an index written
+# last: an image without index is not (completely) tiled yet.
+# The whole tiles of the least recently opened images are removed once the
+# size cap is exceeded.
+class TileStore:
+    DEFAULT_SIZE_MB: int = 4096
+    TILE_SIZE: int = 512
+    # after pruning the cache is filled up to this fraction of the cap
+    PRUNE_RATIO: float = 0.8
+    # memory for the rows decoded at once: images within it are decoded whole
+    BAND_BYTES: int = 1024 * 1024 * 1024
+    INDEX: str = "index.json"
+
+    _instance: "TileStore" = None
+
+    def __init__(
+        self,
+        directory: pathlib.Path = None,
+        max_bytes: int = DEFAULT_SIZE_MB * 1024 * 1024,
+        tile_size: int = TILE_SIZE,
+    ) -> None:
+        self._directory = directory if directory is not None else self.defaultDirectory()
+        self._max_bytes = max_bytes
+        self._tile_size = tile_size
+        self._lock = threading.Lock()
+
+    @classmethod
+    def instance(cls) -> "TileStore":
+        if cls._instance is None:
+            cls._instance = TileStore()
+        return cls._instance
+
+    @classmethod
+    def setInstance(cls, store: "TileStore") -> None:
+        cls._instance = store
+
+    @staticmethod
+    def defaultDirectory() -> pathlib.Path:
+        cache_home = os.environ.get("XDG_CACHE_HOME", "")
+        if cache_home == "":
+            cache_home = pathlib.Path.home() / ".cache"
+        return pathlib.Path(cache_home) / "cutelook" / "tiles"
+
+    def directory(self) -> pathlib.Path:
+        return self._directory
+
+    def isEnabled(self) -> bool:
+        return self._max_bytes > 0
+
+    def tilesDirectory(self, key: ImageKey) -> pathlib.Path:
+        path, mtime, size = key
+        digest = hashlib.sha1(f"{path}\0{mtime}\0{size}".encode("utf-8")).hexdigest()
+        return self._directory / digest[:2] / digest
+
+    def index(self, key: ImageKey) -> dict | None:
+        # {"source": [w, h], "tile": side, "levels": count, "suffix": ".jpg"}
+        index_path = self.tilesDirectory(key) / self.INDEX
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            os.utime(index_path)
+        except (OSError, ValueError):
+            return None
+        return index
+
+    def tilePath(self, key: ImageKey, index: dict, tile: TileIndex) -> pathlib.Path:
+        level, x, y = tile
+        return self.tilesDirectory(key) / f"{level}" / f"{x}_{y}{index['suffix']}"
+
+    def loadTile(self, key: ImageKey, index: dict, tile: TileIndex) -> QImage:
+        return QImage(self.tilePath(key, index, tile).as_posix())
+
+    def generate(
+        self, key: ImageKey, path: str, cancelled: typing.Callable[[], bool] = lambda: False
+    ) -> dict | None:
+        # cuts the tiles of all the levels, None on failure or if cancelled
+        tiles_directory = self.tilesDirectory(key)
+        tmp_directory = tiles_directory.with_name(f"{tiles_directory.name}.{threading.get_ident()}")
+        try:
+            with span("tiles", path):
+                index = self._generate(path, tmp_directory, cancelled)
+            if index is None:
+                shutil.rmtree(tmp_directory, ignore_errors=True)
+                return None
+            with open(tmp_directory / self.INDEX, "w", encoding="utf-8") as f:
+                json.dump(index, f)
+            try:
+                os.replace(tmp_directory, tiles_directory)
+            except OSError:
+                # cut meanwhile by another board (or instance)
+                shutil.rmtree(tmp_directory, ignore_errors=True)
+        except OSError as e:
+            log.warning(f'tiles of "{path}" not cached: {e}')
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            return None
+        with self._lock:
+            total_bytes = self._scan()[1]
+            if total_bytes > self._max_bytes:
+                self._prune(int(self._max_bytes * self.PRUNE_RATIO))
+        return self.index(key)
+
+    def _generate(
+        self, path: str, directory: pathlib.Path, cancelled: typing.Callable[[], bool]
+    ) -> dict | None:
+        side = self._tile_size
+        reader, device = openImageReader(path)
+        if reader is None:
+            log.error(f'can\'t tile "{path}": not in any open pack')
+            return None
+        source_size = reader.size()
+        if not source_size.isValid():
+            log.error(f'can\'t tile "{path}": {reader.errorString()}')
+            return None
+        w, h = source_size.width(), source_size.height()
+        # decoded whole if it fits BAND_BYTES, else in bands of rows of tiles
+        # as tall as fit. A band is decoded from the top of the file (JPEG
+        # can't seek): few tall bands cost less than many thin ones
+        band_height = max(self.BAND_BYTES // (w * 4) // side, 1) * side
+        if band_height < h and not reader.supportsOption(QImageIOHandler.ClipRect):
+            # no region decoding: whole anyway
+            band_height = h
+        suffix = None
+        (directory / "0").mkdir(parents=True, exist_ok=True)
+        for band_y in range(0, h, band_height):
+            if cancelled():
+                return None
+            if band_height < h:
+                reader, device = openImageReader(path)
+                reader.setClipRect(QRect(0, band_y, w, min(band_height, h - band_y)))
+            band = reader.read()
+            if band.isNull():
+                log.error(f'can\'t tile "{path}": {reader.errorString()}')
+                return None
+            if suffix is None:
+                # lossy compression is fine for tiles, not for transparency
+                suffix = ".png" if band.hasAlphaChannel() else ".jpg"
+            for y in range(0, band.height(), side):
+                if cancelled():
+                    return None
+                row = (band_y + y) // side
+                for x in range(0, w, side):
+                    tile = band.copy(x, y, min(side, w - x), min(side, band.height() - y))
+                    self._saveTile(tile, directory / "0" / f"{x // side}_{row}{suffix}")
+            band = None
+
+        # each tile of a level is made of the four tiles below it
+        level = 0
+        size = source_size
+        while size.width() > side or size.height() > side:
+            if cancelled():
+                return None
+            level += 1
+            size = levelSize(source_size, level)
+            below = directory / f"{level - 1}"
+            (directory / f"{level}").mkdir(exist_ok=True)
+            for ty in range(math.ceil(size.height() / side)):
+                for tx in range(math.ceil(size.width() / side)):
+                    parts = [
+                        (QImage((below / f"{2 * tx + dx}_{2 * ty + dy}{suffix}").as_posix()), dx, dy)
+                        for dy in (0, 1)
+                        for dx in (0, 1)
+                    ]
+                    parts = [part for part in parts if not part[0].isNull()]
+                    cw = sum(image.width() for image, dx, dy in parts if dy == 0)
+                    ch = sum(image.height() for image, dx, dy in parts if dx == 0)
+                    merged = QImage(cw, ch, parts[0][0].format())
+                    painter = QPainter(merged)
+                    for image, dx, dy in parts:
+                        painter.drawImage(dx * side, dy * side, image)
+                    painter.end()
+                    tile = merged.scaled(
+                        (cw + 1) // 2, (ch + 1) // 2, Qt.IgnoreAspectRatio, Qt.SmoothTransformation
+                    )
+                    self._saveTile(tile, directory / f"{level}" / f"{tx}_{ty}{suffix}")
+        return {"source": [w, h], "tile": side, "levels": level + 1, "suffix": suffix}
+
+    @staticmethod
+    def _saveTile(tile: QImage, tile_path: pathlib.Path) -> None:
+        if not tile.save(tile_path.as_posix(), None, 90):
+            raise OSError(f"can't write {tile_path}")
+
+    def stats(self) -> dict[str, int | str]:
+        with self._lock:
+            images, total_bytes = self._scan()
+        return {
+            "directory": self._directory.as_posix(),
+            "images": len(images),
+            "bytes": total_bytes,
+            "max_bytes": self._max_bytes,
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._prune(0)
+
+    def _scan(self) -> tuple[list[tuple[float, int, pathlib.Path]], int]:
+        images = []
+        total_bytes = 0
+        if not self._directory.is_dir():
+            return images, total_bytes
+        for index_path in self._directory.glob(f"*/*/{self.INDEX}"):
+            try:
+                last_used = index_path.stat().st_mtime
+                size = sum(f.stat().st_size for f in index_path.parent.rglob("*") if f.is_file())
+            except OSError:
+                continue
+            images.append((last_used, size, index_path.parent))
+            total_bytes += size
+        return images, total_bytes
+
+    def _prune(self, max_bytes: int) -> None:
+        images, total_bytes = self._scan()
+        # least recently used first
+        images.sort(key=lambda i: i[0])
+        for last_used, size, tiles_directory in images:
+            if total_bytes <= max_bytes:
+                break
+            shutil.rmtree(tiles_directory, ignore_errors=True)
+            total_bytes -= size
+
+
+# Process wide, least recently used tiles in memory. Its budget depends on the
+# area of the screens, not on the size of the images: enough tiles to cover
+# them a few times over, the tiles in sight and those loaded ahead.
+class TileMemory:
+    SCREENS: int = 3
+
+    _instance: "TileMemory" = None
+
+    def __init__(self, budget_bytes: int = 0) -> None:
+        # budget_bytes 0: from the screens
+        self._lock = threading.Lock()
+        self._tiles: OrderedDict[tuple, QImage] = OrderedDict()
+        self._bytes = 0
+        self._budget = budget_bytes if budget_bytes > 0 else self.screensBytes()
+
+    @classmethod
+    def instance(cls) -> "TileMemory":
+        if cls._instance is None:
+            cls._instance = TileMemory()
+        return cls._instance
+
+    @classmethod
+    def screensBytes(cls) -> int:
+        area = 0
+        if QGuiApplication.instance() is not None:
+            for screen in QGuiApplication.screens():
+                size = screen.size() * screen.devicePixelRatio()
+                area += size.width() * size.height()
+        if area == 0:
+            area = 1920 * 1080
+        return area * 4 * cls.SCREENS
+
+    def budget(self) -> int:
+        return self._budget
+
+    def byteCount(self) -> int:
+        with self._lock:
+            return self._bytes
+
+    def get(self, key: tuple) -> QImage | None:
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+            return tile
+
+    def put(self, key: tuple, tile: QImage) -> None:
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = tile
+            self._bytes += tile.sizeInBytes()
+            while self._bytes > self._budget and len(self._tiles) > 1:
+                old_key, old_tile = self._tiles.popitem(last=False)
+                self._bytes -= old_tile.sizeInBytes()
+
+
+# A very large image shown through its tiles (see TileStore): at any zoom only
+# the tiles in sight, from the level closest to the zoom, are read from disk
+# and kept in memory (see TileMemory), with a ring of tiles around them loaded
+# ahead for panning and the level above for zooming out. The tiles are cut in
+# background the first time; meanwhile (and for the tiles not loaded yet) the
+# view draws the reduced image it already has.
+class TiledImage(QObject):
+    # source images from this many pixels up are tiled
+    min_pixels: int = 100 * 1000 * 1000
+
+    _executor: ThreadPoolExecutor = None
+    _cutter: ThreadPoolExecutor = None
+
+    # tiles loaded: the view should be painted again
+    tile_ready: typing.ClassVar[pyqtSignal] = pyqtSignal()
+    # tiles cut (or found cut) and ready to be loaded
+    tiles_ready: typing.ClassVar[pyqtSignal] = pyqtSignal()
+
+    def __init__(self, path: str, key: ImageKey, parent: QObject = None) -> None:
+        super().__init__(parent)
+        self._path = path
+        self._key = key
+        self._lock = threading.Lock()
+        self._index: dict = None
+        self._source_size: QSize = None
+        self._generating = False
+        self._closed = False
+        # tiles to load: those not wanted anymore when their turn comes are skipped
+        self._wanted: set[TileIndex] = set()
+        self._queued: set[TileIndex] = set()
+
+    @classmethod
+    def executor(cls) -> ThreadPoolExecutor:
+        # loads the tiles (and the indexes of the images already tiled)
+        if cls._executor is None:
+            cls._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="CuteLookTiles")
+        return cls._executor
+
+    @classmethod
+    def cutter(cls) -> ThreadPoolExecutor:
+        # cuts the tiles of an image at a time, aside the loads: the tiles of
+        # the images already cut keep coming meanwhile
+        if cls._cutter is None:
+            cls._cutter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="CuteLookTileCut")
+        return cls._cutter
+
+    @classmethod
+    def isLarge(cls, source_size: QSize) -> bool:
+        return cls.min_pixels > 0 and source_size.width() * source_size.height() >= cls.min_pixels
+
+    @classmethod
+    def forPath(cls, path: str, parent: QObject = None) -> "TiledImage | None":
+        # None: the tiles can't be cached
+        if not TileStore.instance().isEnabled():
+            return None
+        key = imageFileKey(path)
+        if key is None:
+            return None
+        return TiledImage(path, key, parent)
+
+    def prepare(self) -> None:
+        # tiles_ready is emitted once the tiles can be used
+        if self._index is not None or self._generating:
+            return
+        self._generating = True
+        self.executor().submit(self._prepare)
+
+    def close(self) -> None:
+        # stops cutting the tiles, and loading them
+        with self._lock:
+            self._closed = True
+            self._wanted.clear()
+
+    def isReady(self) -> bool:
+        return self._index is not None
+
+    def sourceSize(self) -> QSize | None:
+        return self._source_size
+
+    def levelCount(self) -> int:
+        return self._index["levels"] if self._index is not None else 0
+
+    def levelFor(self, scale: float) -> int:
+        # smallest level not smaller than the image shown at scale
+        if scale <= 0:
+            return self.levelCount() - 1
+        level = int(math.floor(math.log2(1 / scale))) if scale < 1 else 0
+        return min(max(level, 0), self.levelCount() - 1)
+
+    def paint(self, painter: QPainter, target: QRectF, exposed: QRectF) -> bool:
+        # draws the exposed part of the image shown in target; False: some
+        # tiles are still being loaded (tile_ready follows)
+        if self._index is None:
+            return False
+        exposed = exposed.intersected(target)
+        scale = target.width() / self._source_size.width()
+        level = self.levelFor(scale)
+        visible = self._tilesIn(level, target, exposed)
+        missing = []
+        painter.save()
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        for tile in visible:
+            image = TileMemory.instance().get((self._key, tile))
+            if image is None:
+                missing.append(tile)
+                continue
+            painter.drawImage(self._tileTarget(tile, target), image)
+        painter.restore()
+
+        # loaded ahead: the tiles around, and the level above
+        # a tile of level covers side << level pixels of the source
+        side = self._index["tile"]
+        ring_size = side * (1 << level) * scale
+        around = exposed.adjusted(-ring_size, -ring_size, ring_size, ring_size)
+        ahead = [tile for tile in self._tilesIn(level, target, around) if tile not in visible]
+        if level + 1 < self.levelCount():
+            ahead += self._tilesIn(level + 1, target, exposed)
+        self._request(missing + ahead)
+        return not missing
+
+    def _tilesIn(self, level: int, target: QRectF, area: QRectF) -> list[TileIndex]:
+        # tiles of level under area (in target coordinates), in sight first
+        side = self._index["tile"]
+        size = levelSize(self._source_size, level)
+        scale = size.width() / target.width()
+        x0 = max(int((area.left() - target.left()) * scale) // side, 0)
+        y0 = max(int((area.top() - target.top()) * scale) // side, 0)
+        x1 = min(int(math.ceil((area.right() - target.left()) * scale)) // side, (size.width() - 1) // side)
+        y1 = min(int(math.ceil((area.bottom() - target.top()) * scale)) // side, (size.height() - 1) // side)
+        return [(level, x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+    def _tileTarget(self, tile: TileIndex, target: QRectF) -> QRectF:
+        level, x, y = tile
+        side = self._index["tile"]
+        size = levelSize(self._source_size, level)
+        sx = target.width() / size.width()
+        sy = target.height() / size.height()
+        w = min(side, size.width() - x * side)
+        h = min(side, size.height() - y * side)
+        return QRectF(target.x() + x * side * sx, target.y() + y * side * sy, w * sx, h * sy)
+
+    def _request(self, tiles: list[TileIndex]) -> None:
+        with self._lock:
+            self._wanted = set(tiles)
+            tiles = [t for t in tiles if t not in self._queued]
+            tiles = [t for t in tiles if TileMemory.instance().get((self._key, t)) is None]
+            self._queued.update(tiles)
+        for tile in tiles:
+            self.executor().submit(self._loadTile, tile)
+
+    def _loadTile(self, tile: TileIndex) -> None:
+        with self._lock:
+            if tile not in self._wanted:
+                self._queued.discard(tile)
+                return
+        image = TileStore.instance().loadTile(self._key, self._index, tile)
+        with self._lock:
+            self._queued.discard(tile)
+            closed = self._closed
+        if image.isNull():
+            log.warning(f'tile {tile} of "{self._path}" unreadable')
+            return
+        TileMemory.instance().put((self._key, tile), image)
+        if not closed:
+            self.tile_ready.emit()
+
+    def _prepare(self) -> None:
+        index = TileStore.instance().index(self._key)
+        if index is None:
+            self.cutter().submit(self._cut)
+            return
+        self._setIndex(index)
+
+    def _cut(self) -> None:
+        log.info(f'cutting the tiles of "{self._path}"')
+        self._setIndex(TileStore.instance().generate(self._key, self._path, lambda: self._closed))
+
+    def _setIndex(self, index: dict | None) -> None:
+        self._generating = False
+        if index is None:
+            return
+        self._source_size = QSize(*index["source"])
+        self._index = index
+        if not self._closed:
+            self.tiles_ready.emit()
+
+
+"""
+Unit Tests
+"""
+import time
+
+from PyQt5.QtGui import QColor
+from PyQt5.QtCore import QCoreApplication
+
+test_data = {
+    "image_file": "./test_tiled.png",
+    "tiles_dir": pathlib.Path("./test_tiles"),
+}
+
+
+def makeQuadrants(w: int, h: int) -> QImage:
+    # red, green / blue, white
+    image = QImage(w, h, QImage.Format_RGB32)
+    painter = QPainter(image)
+    painter.fillRect(0, 0, w // 2, h // 2, QColor(255, 0, 0))
+    painter.fillRect(w // 2, 0, w - w // 2, h // 2, QColor(0, 255, 0))
+    painter.fillRect(0, h // 2, w // 2, h - h // 2, QColor(0, 0, 255))
+    painter.fillRect(w // 2, h // 2, w - w // 2, h - h // 2, QColor(255, 255, 255))
+    painter.end()
+    return image
+
+
+def isNear(color: QColor, expected: tuple[int, int, int]) -> bool:
+    return all(abs(c - e) < 16 for c, e in zip(color.getRgb()[:3], expected))
+
+
+@TestFunction
+def tileStore_generate():
+    makeQuadrants(1100, 700).save(test_data["image_file"])
+    store = TileStore(test_data["tiles_dir"], tile_size=256)
+    key = ImageCache.fileKey(test_data["image_file"])
+    try:
+        assert store.index(key) is None, "tiles before cutting them"
+        index = store.generate(key, test_data["image_file"])
+        # 1100, 550, 275, 138 (a single tile)
+        assert index is not None and index["levels"] == 4, f"wrong index {index}"
+        assert len(list(store.tilesDirectory(key).glob("0/*"))) == 5 * 3, "wrong tiles count"
+        corner = store.loadTile(key, index, (0, 4, 2))
+        assert corner.size() == QSize(1100 - 4 * 256, 700 - 2 * 256), f"edge tile {corner.size()}"
+        assert isNear(corner.pixelColor(10, 10), (255, 255, 255)), "wrong tile pixels"
+        top = store.loadTile(key, index, (3, 0, 0))
+        assert top.size() == QSize(138, 88), f"wrong top level {top.size()}"
+        assert isNear(top.pixelColor(100, 10), (0, 255, 0)), "wrong top level pixels"
+        assert store.stats()["images"] == 1, "tiles not cached"
+        store.clear()
+        assert store.index(key) is None, "tiles not cleared"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        os.remove(test_data["image_file"])
+        shutil.rmtree(test_data["tiles_dir"], ignore_errors=True)
+
+
+@TestFunction
+def tileStore_banded():
+    jpeg_file = "./test_tiled.jpg"
+    makeQuadrants(1100, 700).save(jpeg_file, None, 95)
+    store = TileStore(test_data["tiles_dir"], tile_size=256)
+    # two rows of tiles at a time: 2 bands
+    store.BAND_BYTES = 1100 * 4 * 512
+    key = ImageCache.fileKey(jpeg_file)
+    try:
+        index = store.generate(key, jpeg_file)
+        assert index is not None and index["source"] == [1100, 700], f"wrong index {index}"
+        assert len(list(store.tilesDirectory(key).glob("0/*"))) == 5 * 3, "wrong tiles count"
+        bottom = store.loadTile(key, index, (0, 0, 2))
+        assert bottom.size() == QSize(256, 700 - 2 * 256), f"last band tile {bottom.size()}"
+        assert isNear(bottom.pixelColor(10, 10), (0, 0, 255)), "wrong last band pixels"
+        assert isNear(store.loadTile(key, index, (0, 4, 1)).pixelColor(10, 10), (0, 255, 0)), (
+            "wrong first band pixels"
+        )
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        os.remove(jpeg_file)
+        shutil.rmtree(test_data["tiles_dir"], ignore_errors=True)
+
+
+@TestFunction
+def tiledImage_visible_tiles():
+    makeQuadrants(2000, 2000).save(test_data["image_file"])
+    TileStore.setInstance(TileStore(test_data["tiles_dir"], tile_size=256))
+    memory = TileMemory(256 * 256 * 4 * 40)
+    TileMemory._instance = memory
+    tiled = TiledImage.forPath(test_data["image_file"])
+    loaded = []
+    tiled.tile_ready.connect(lambda: loaded.append(True))
+    try:
+        tiled.prepare()
+        start = time.monotonic()
+        while not tiled.isReady() and time.monotonic() - start < 10:
+            time.sleep(0.01)
+        assert tiled.isReady(), "tiles not cut"
+        assert tiled.levelFor(1.0) == 0 and tiled.levelFor(0.3) == 1, "wrong level for zoom"
+
+        # shown at full resolution, only a 300x200 corner in sight
+        canvas = QImage(300, 200, QImage.Format_RGB32)
+        canvas.fill(0)
+        target = QRectF(-1700, 0, 2000, 2000)
+        painter = QPainter(canvas)
+        done = tiled.paint(painter, target, QRectF(canvas.rect()))
+        assert not done, "tiles drawn before being loaded"
+        start = time.monotonic()
+        while not done and time.monotonic() - start < 5:
+            QCoreApplication.processEvents()
+            done = tiled.paint(painter, target, QRectF(canvas.rect()))
+        painter.end()
+        assert done, "visible tiles not loaded"
+        assert isNear(canvas.pixelColor(150, 100), (0, 255, 0)), "wrong tile drawn"
+        # 2 x 1 tiles in sight (and some around): not the 64 of the level
+        assert memory.byteCount() <= memory.budget(), "tiles over budget"
+        assert memory.byteCount() < 20 * 256 * 256 * 4, f"{memory.byteCount()} bytes of tiles"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        tiled.close()
+        TiledImage.cutter().submit(lambda: None).result()
+        TiledImage.executor().submit(lambda: None).result()
+        TileStore.setInstance(None)
+        TileMemory._instance = None
+        os.remove(test_data["image_file"])
+        shutil.rmtree(test_data["tiles_dir"], ignore_errors=True)
+
+
+@TestFunction
+def tiledImage_tiles_ahead():
+    makeQuadrants(2000, 2000).save(test_data["image_file"])
+    TileStore.setInstance(TileStore(test_data["tiles_dir"], tile_size=256))
+    tiled = TiledImage.forPath(test_data["image_file"])
+    requested = []
+    try:
+        tiled.prepare()
+        start = time.monotonic()
+        while not tiled.isReady() and time.monotonic() - start < 10:
+            time.sleep(0.01)
+        assert tiled.isReady(), "tiles not cut"
+        tiled._request = requested.extend
+
+        # zoomed out to level 1 (tiles of 153.6 pixels on screen), a small
+        # area in sight in the middle of the tile (1, 1)
+        canvas = QImage(600, 600, QImage.Format_RGB32)
+        painter = QPainter(canvas)
+        tiled.paint(painter, QRectF(0, 0, 600, 600), QRectF(220, 220, 20, 20))
+        painter.end()
+        assert requested[0] == (1, 1, 1), f"tile in sight not requested first {requested}"
+        # a ring of one tile around the tile in sight
+        ring = sorted(tile for tile in requested if tile[0] == 1)
+        expected = [(1, x, y) for x in range(3) for y in range(3)]
+        assert ring == expected, f"wrong tiles around {ring}"
+        assert [tile for tile in requested if tile[0] == 2] == [(2, 0, 0)], f"wrong level above {requested}"
+    except AssertionError as e:
+        print(f"Assertion Failed: {e}")
+        raise TestFailedException()
+    finally:
+        tiled.close()
+        TiledImage.cutter().submit(lambda: None).result()
+        TileStore.setInstance(None)
+        os.remove(test_data["image_file"])
+        shutil.rmtree(test_data["tiles_dir"], ignore_errors=True)
+
+
+if __name__ == "__main__":
+    from PyQt5.QtWidgets import QApplication
+
+    app = QApplication([])
+    test_list = [
+        tileStore_generate,
+        tileStore_banded,
+        tiledImage_visible_tiles,
+        tiledImage_tiles_ahead,
+    ]
+
+    p, f = RunTest(test_list)
+    exit(f)